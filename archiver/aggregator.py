@@ -0,0 +1,326 @@
+# File: aggregator.py
+# Date: 18-10-2026
+# Author: Saruccio Culmone
+#
+# Ingest-time window aggregation
+
+"""
+Streaming aggregation of readings into the window measures computed by
+dsarchiver, without reading back the raw readings from the database.
+
+For each topic the running state of the current window is kept:
+- count, mean and variance by Welford's algorithm
+- min and max values with their timestamps, first and last timestamps
+- sum of squared device accuracies, giving the accuracy of the mean of
+  uncorrelated readings as sqrt(sum(acc^2)) / n
+
+When a reading of a later window arrives, or the window end has passed,
+the measure document is written to the datastore with the same shape and
+'_id' of dsarchiver ones, 'count' and 'stddev' of the readings included.
+
+The 'store' column of the IoT configuration selects for each topic:
+- raw: readings stored in the realtime database only (default)
+- aggregate: window measures stored in the datastore only
+- both: readings and window measures; dsarchiver, given the [aggregate]
+  section too, deletes the readings of windows whose measure is written
+  and merges the late ones into it
+
+Compression policies are not applied to aggregated topics, so measures are
+computed from all the received readings.
+
+Timestamps with an offset are converted to local time, the one of readings
+without offset, before being assigned to their window.
+
+Readings of a window already written by this run (late readings, QoS 1
+messages replayed after a reconnection) are dropped. A measure of the same
+window already stored by a previous run is merged with the new readings
+instead of being overwritten.
+"""
+
+import sys
+import math
+import time
+import datetime
+import time2relax as relax
+from loguru import logger
+import measures
+import partitions
+import tracing
+
+
+# Store modes of the 'store' column
+STORE_RAW = "raw"
+STORE_AGGREGATE = "aggregate"
+STORE_BOTH = "both"
+STORE_MODES = [STORE_RAW, STORE_AGGREGATE, STORE_BOTH]
+
+# Seconds waited after window end for late readings
+WINDOW_GRACE = 5
+
+# Seconds a device document is cached
+DEVICE_TTL = 3600
+
+
+def store_mode(metadata: dict):
+    """
+    Returns the store mode of a topic from its metadata, None if not valid
+    """
+    store = ((metadata or {}).get('store') or STORE_RAW).strip(" ")
+    return store if store in STORE_MODES else None
+
+
+class WindowState:
+    """
+    Running aggregates of the readings of a window
+    """
+    __slots__ = ['start', 'end', 'count', 'mean', 'm2', 'acc2', 'measure_type',
+                 'min_value', 'min_timestamp', 'max_value', 'max_timestamp',
+                 'first', 'last']
+
+    def __init__(self, start: datetime.datetime, window: int, measure_type: str):
+        self.start = start
+        self.end = start + datetime.timedelta(minutes=window)
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.acc2 = 0.0
+        self.measure_type = measure_type
+        self.min_value = None
+        self.min_timestamp = ""
+        self.max_value = None
+        self.max_timestamp = ""
+        self.first = None
+        self.last = None
+
+    def merge(self, stored: dict):
+        """
+        Merges the aggregates of a measure stored by a previous run.
+        Returns False if the measure has no readings count to merge.
+        """
+        try:
+            count = stored['count']
+            mean = stored['value']
+            m2 = (stored['stddev'] ** 2) * (count - 1)
+            acc2 = (stored['accuracy'] * count) ** 2
+            slot = stored['time_slot']
+            first = (measures.local_time(datetime.datetime.fromisoformat(slot['start'])),
+                     slot['start'])
+            last = (measures.local_time(datetime.datetime.fromisoformat(slot['end'])),
+                    slot['end'])
+            min_value = stored['min_value']
+            max_value = stored['max_value']
+        except:
+            return False
+        if count <= 0:
+            return False
+
+        # Parallel combination of mean and sum of squared deviations
+        total = self.count + count
+        delta = mean - self.mean
+        self.m2 += m2 + delta * delta * self.count * count / total
+        self.mean += delta * count / total
+        self.count = total
+        self.acc2 += acc2
+        if (self.min_value is None) or (min_value['value'] < self.min_value):
+            self.min_value = min_value['value']
+            self.min_timestamp = min_value['timestamp']
+        if (self.max_value is None) or (max_value['value'] > self.max_value):
+            self.max_value = max_value['value']
+            self.max_timestamp = max_value['timestamp']
+        self.first = first if self.first is None else min(self.first, first)
+        self.last = last if self.last is None else max(self.last, last)
+        return True
+
+    def add(self, value: float, timestamp: str, moment: datetime.datetime, acc: float):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+        self.acc2 += acc * acc
+
+        if (self.min_value is None) or (value < self.min_value):
+            self.min_value = value
+            self.min_timestamp = timestamp
+        if (self.max_value is None) or (value > self.max_value):
+            self.max_value = value
+            self.max_timestamp = timestamp
+        if (self.first is None) or (moment < self.first[0]):
+            self.first = (moment, timestamp)
+        if (self.last is None) or (moment > self.last[0]):
+            self.last = (moment, timestamp)
+
+    def measure(self, topic: str):
+        """
+        Returns the measure document of the window without '_id'
+        """
+        stddev = math.sqrt(self.m2 / (self.count - 1)) if self.count > 1 else 0.0
+        middle = self.first[0] + (self.last[0] - self.first[0]) / 2.0
+        return {'topic': topic,
+                'measure_type': self.measure_type,
+                'value_type': "average",
+                'timestamp': middle.isoformat(timespec='seconds'),
+                'value': self.mean,
+                'accuracy': math.sqrt(self.acc2) / self.count,
+                'stddev': stddev,
+                'count': self.count,
+                'min_value': {'value': self.min_value, 'timestamp': self.min_timestamp},
+                'max_value': {'value': self.max_value, 'timestamp': self.max_timestamp},
+                'time_slot': {'start': self.first[1], 'end': self.last[1]}}
+
+
+def merged_measure(meas: dict, stored: dict):
+    """
+    Returns the measure of a window combining a new measure with the stored
+    one, computed from different readings, with the revision of the stored
+    one. None if any of them has no readings count.
+    """
+    try:
+        start = measures.local_time(datetime.datetime.fromisoformat(stored['time_slot']['start']))
+    except:
+        return None
+    state = WindowState(start, 0, stored.get('measure_type'))
+    if not (state.merge(stored) and state.merge(meas)):
+        return None
+    merged = state.measure(stored['topic'])
+    merged['_id'] = stored['_id']
+    merged['_rev'] = stored['_rev']
+    return merged
+
+
+class Aggregator:
+    """
+    Aggregates the readings of topics into window measures written to the
+    datastore. Used by a single thread.
+    """
+    def __init__(self, datastore: relax.CouchDB, devices: relax.CouchDB, window: int):
+        self.datastore = datastore
+        self.devices = devices
+        self.window = window
+        self.partitioned = datastore.partitioned
+        self.states = dict()
+        # topic -> (metadata, store mode, window)
+        self.modes = dict()
+        self.device_cache = dict()
+        # topic -> start of the last written window
+        self.written = dict()
+        self.late = 0
+
+    def mode(self, topic: str, metadata: dict):
+        """
+        Returns the store mode and the window of a topic
+        """
+        cached = self.modes.get(topic)
+        if (cached is not None) and (cached[0] is metadata):
+            return cached[1:]
+
+        store = store_mode(metadata)
+        if store is None:
+            logger.error("Invalid store mode '{}' of topic '{}', using '{}'".format(
+                         metadata.get('store'), topic, STORE_RAW))
+            store = STORE_RAW
+        window = self.window
+        if store != STORE_RAW:
+            window = measures.topic_window({topic: metadata}, topic, self.window)
+        self.modes[topic] = (metadata, store, window)
+        return (store, window)
+
+    def device(self, dev: str):
+        """
+        Returns the cached document of a device, None if not available
+        """
+        now = time.monotonic()
+        cached = self.device_cache.get(dev)
+        if (cached is not None) and (now - cached[0] < DEVICE_TTL):
+            return cached[1]
+        try:
+            device = self.devices.get(dev).json()
+        except:
+            logger.error("Device GET '{}'".format(dev))
+            logger.error("Reason: '{}'".format(sys.exc_info()))
+            device = None
+        self.device_cache[dev] = (now, device)
+        return device
+
+    def add(self, topic: str, data: dict, metadata: dict):
+        """
+        Aggregates a reading if its topic is aggregated.
+        Returns the store mode of the topic.
+        """
+        store, window = self.mode(topic, metadata)
+        if store == STORE_RAW:
+            return store
+
+        value = data.get('value')
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            return store
+        try:
+            moment = measures.local_time(datetime.datetime.fromisoformat(data['timestamp']))
+        except:
+            return store
+        start = measures.align_window(moment, window)
+
+        state = self.states.get(topic)
+        written = self.written.get(topic)
+        if ((state is not None) and (start < state.start)) or \
+           ((written is not None) and (start <= written)):
+            self.late += 1
+            logger.warning("Late reading of '{}' not aggregated: {}".format(topic,
+                                                                            data['timestamp']))
+            return store
+        if (state is not None) and (state.start != start):
+            del self.states[topic]
+            self.write(topic, state)
+            state = None
+        if state is None:
+            state = WindowState(start, window, data.get('type'))
+            self.states[topic] = state
+
+        acc = 0.0
+        if data.get('dev') is not None:
+            acc = measures.accuracy(self.device(data['dev']), state.measure_type, value)
+        state.add(value, data['timestamp'], moment, acc)
+        return store
+
+    def flush(self, force: bool = False):
+        """
+        Writes the windows whose end has passed, all of them if forced
+        """
+        now = datetime.datetime.now()
+        grace = datetime.timedelta(seconds=WINDOW_GRACE)
+        for topic in list(self.states.keys()):
+            state = self.states[topic]
+            if force or (now >= state.end + grace):
+                del self.states[topic]
+                self.write(topic, state)
+
+    def write(self, topic: str, state: WindowState):
+        """
+        Writes the measure of a window to the datastore, merged with the one
+        stored by a previous run
+        """
+        self.written[topic] = state.start
+        meas = state.measure(topic)
+        meas['_id'] = partitions.doc_id(topic, state.start.isoformat(timespec='seconds'),
+                                        self.partitioned)
+        try:
+            try:
+                self.datastore.insert(meas)
+            except relax.ResourceConflict:
+                stored = self.datastore.get(meas['_id']).json()
+                if not state.merge(stored):
+                    logger.error("Measure '{}' already present and not mergeable, kept".format(
+                                 meas['_id']))
+                    return False
+                logger.warning("Merging measure '{}'".format(meas['_id']))
+                rev = stored['_rev']
+                meas = state.measure(topic)
+                meas['_id'] = stored['_id']
+                meas['_rev'] = rev
+                self.datastore.insert(meas)
+            logger.debug("Measure ok: '{}' {} readings", meas['_id'], meas['count'])
+            tracing.event("measure", "Measure ok: {}", meas)
+            return True
+        except:
+            logger.error("Failed measure insert: '{}'".format(meas))
+            logger.error("Reason: '{}'".format(sys.exc_info()))
+            return False
@@ -16,12 +16,28 @@ import time
 import datetime
 import argparse
 import paho.mqtt.client as mqtt
-import time2relax as relax
+from paho.mqtt.properties import Properties
+from paho.mqtt.packettypes import PacketTypes
 import configparser
-import csv
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+import collections
 import json
+import threading
+import signal
+import socket
 from loguru import logger
+import configuration as config
+import dbclient
+import designdocs
+import compression
+import aggregator
+import measures
+import buckets
+import tracing
+import profiling
+import status
+import partitions
+import readings
 
 
 
@@ -30,211 +46,139 @@ PROGNAME = "archiver"
 PROGDESCR = "IoT data archiver"
 VERSION = "0.1.0"
 
-# Directory list to search configuration file other than HOME dir
-CONFIG_DIRS = [os.environ["HOME"], ".", "/etc"]
-CONFIG_FNAME = PROGNAME + ".ini"
-LOG_FNAME = PROGNAME + ".log"
-
-def load_config():
-    """
-    Serarch and load configuration file.
-    Returns an dictionary mapping the INI file of None in error case
-    """
-    logger.info("Searching for '{}' configuration file".format(CONFIG_FNAME))
-    # INI dictionary
-    ini = None
-
-    for configdir in CONFIG_DIRS:
-        configfilepath = os.path.join(configdir, CONFIG_FNAME)
-        logger.debug("Searching for '{}'".format(configfilepath))
-        if os.path.exists(configfilepath):
-            logger.info("Using config file: '{}'".format(configfilepath))
-            ini = configparser.ConfigParser()
-            #try:
-            ini.read(configfilepath)
-            break;
-    if ini is None:
-        logger.error("Configuration file non found.")
-    return ini
-
-
-def verify_params(ini: dict, section: str, req_params: list):
-    """
-    Verify that a list of parameter is present in the section of the
-    loaded INI file
 
-    Parameters:
-    ini : dict
-        dictionary returned by 'load_config' function
-    section : str
-        section string
-    req_params : list
-        list of exepected parameters strings
-
-    Return
-    ------
-    True if all expected parameters are present
-    False otherwise
+def instance_id(ini: dict):
     """
-    # Control if INI file contains [section] section
-    if section not in ini.keys():
-        logger.error("[{}] section not available".format(section))
-        return False
-
-    # Control that INI file contains all required parameters
-    logger.info("Verifying section '{}'".format(section))
-    log_config = ini[section]
-
-    all_params_ok = True
-    for param in req_params:
-        if param not in log_config.keys():
-            logger.error("Parameter '{}' not available".format(param))
-            all_params_ok = False
-    if not all_params_ok:
-        return False
-
-    return True
-
-# Logging confguration
-def config_logging(ini: dict):
-    """
-    Configure logging on file and on screen from parameters taken from
-    configuration INI file.
-
-    Parameters
-    ----------
-    ini : dict
-        Log parameters in in the [config] section are:
-        - logdir
-        - log_rotation
-        - log_rotation_size
-        - log_retention
-        - trace_level
-
-    Return
-    ------
-    True if logging on file is ok
-    False otherwise
-    """
-    # Control if INI file contains [config] section
-    req_params = ['logdir', 'log_rotation', 'log_rotation_size', 'log_retention',
-                  'trace_level']
-    if not verify_params(ini, 'config', req_params):
-        return False
-
-    # All parameters are present, use them
-    log_config = ini['config']
-    logdir = log_config['logdir']
-    if not os.path.exists(logdir):
-        logger.error("Log directory '{}' does not exist".format(logdir))
-        return False
-
-    logger.info("Log directory: '{}'".format(logdir))
-
-    # Setup new logger
-    log_rotation = log_config['log_rotation']
-    log_rotation_size = log_config['log_rotation_size']
-    log_retention = log_config['log_retention']
-    trace_level = log_config['trace_level']
-
-    logfilepath = os.path.join(logdir, LOG_FNAME)
-    logger.info("Logging on file: '{}'".format(logfilepath))
-    logger.remove()
-
-    try:
-        if log_rotation == 'yes':
-            logger.add(logfilepath, rotation=log_rotation_size,
-                    retention=log_retention, level=trace_level)
-        else:
-            logger.add(logfilepath, level=trace_level)
-
-        logger.info("Logging setup on file: '{}'".format(logfilepath))
-        for param in req_params:
-            logger.info("{}= {}".format(param, log_config[param]))
-    except:
-        logger.error("Logging setup on file '{}' failed".format(logfilepath))
-        logger.error("Reason: {}".format(sys.exc_info()))
-        return False
-
-    return True
-
-
-
-
-def load_iot_config(ini: dict):
-    """
-
+    Returns the identity of this archiver instance: the [mqtt] 'instance'
+    parameter or '<hostname>-<pid>' if not set
     """
-    if not verify_params(ini, 'iot', ['file', 'filedir']):
-        return {}
-
-    # Set file directory
-    iot_params = ini['iot']
-    filedir = iot_params['filedir']
-    filedir = filedir.strip(" ")
-    if filedir == "":
-        # HOME directory set
-        filedir = os.environ['HOME']
-    logger.info("IoT configuration dir: '{}'".format(filedir))
-
-    iot_config = iot_params['file']
-    filepath = os.path.join(filedir, iot_config)
-    logger.info("IoT config filepath: '{}'".format(filepath))
-    if not os.path.exists(filepath):
-        logger.error("IoT config file '{}' not found".format(filepath))
-        return {}
-
-    # Load configuration data
-    topics = dict()
-    fieldnames = ["topic", "where", "h", "x", "y", "unit", "notes"]
-    try:
-        csvfd = open(filepath, "r", newline='')
-        reader = csv.DictReader(csvfd, fieldnames=fieldnames,
-                                delimiter=";")
-        for row in reader:
-            topic = row['topic'].strip(" ")
-            if topic == 'topic':
-                logger.debug("Skipping header")
-                continue
-            if topic[0] == "#":
-                logger.warning("Line {} commented out".format(reader.line_num))
-                continue
-            if topic in topics.keys():
-                logger.warning("Topic '{}' at line {} skipped beacause duplicated ".format(topic, reader.line_num))
-                continue
-            # Remove 'topic' key and assign remaining to topics dict
-            row.pop('topic')
-            topics[topic] = row
-            logger.debug("Topic '{}' added: {}".format(topic, topics[topic]))
-    except:
-        logger.error("Loading IoT topics failed")
-        logger.error("Reason: {}".format(sys.exc_info()))
-        return {}
-
-    return topics
+    instance = ini.get('mqtt', 'instance', fallback="").strip(" ")
+    if instance == "":
+        instance = "{}-{}".format(socket.gethostname(), os.getpid())
+    return instance
 
 
 # DataClass definition for data exchange between MQTT client and main
 # loop
 @dataclass
 class MQTTInterface:
-    queue: list
+    # Readings to be written, as compact records
+    queue: collections.deque
     topics: dict
+    # Compression policy of each received topic
+    policies: dict = field(default_factory=dict)
+    # Shared subscription group, empty if not clustered
+    share_group: str = ""
+    # Latest reading of each topic
+    latest: status.LatestValues = field(default_factory=status.LatestValues)
+    # Prefix of republished status topics, empty if not republished
+    status_prefix: str = ""
+    # Ingest-time aggregation enabled: aggregated topics are not compressed
+    aggregating: bool = False
+    # Subscriptions QoS and topics per SUBSCRIBE packet
+    qos: int = 0
+    subscribe_batch: int = 100
+    # Persistent session: subscriptions are kept by the broker
+    persistent: bool = False
+    # Subscriptions to be sent again at next connection
+    resubscribe: bool = True
+    # SUBSCRIBE packets waiting for SUBACK since 'subscribe_start'
+    pending_subacks: set = field(default_factory=set)
+    subscribe_start: float = 0.0
+    # Set to end the insert loop once the queue is drained
+    stop: threading.Event = field(default_factory=threading.Event)
+
+
+def subscription(mqtt_iface: MQTTInterface, topic: str):
+    """
+    Returns the subscription of a topic: a shared subscription if the
+    instance belongs to a group
+    """
+    if mqtt_iface.share_group == "":
+        return topic
+    return "$share/{}/{}".format(mqtt_iface.share_group, topic)
 
 
-def on_connect(client, userdata, flags, rc):
+def subscribe_topics(client, mqtt_iface: MQTTInterface, topics: list):
+    """
+    Subscribes the topics sending SUBSCRIBE packets of 'subscribe_batch'
+    topics each. Returns the list of packets message ids or None if a
+    packet could not be sent.
+    """
+    mids = []
+    for first in range(0, len(topics), mqtt_iface.subscribe_batch):
+        batch = [(subscription(mqtt_iface, topic), mqtt_iface.qos)
+                 for topic in topics[first:first + mqtt_iface.subscribe_batch]]
+        result, mid = client.subscribe(batch)
+        if result != mqtt.MQTT_ERR_SUCCESS:
+            logger.error("Subscription of {} topics failed: {}".format(len(batch),
+                                                                      mqtt.error_string(result)))
+            return None
+        mids.append(mid)
+    return mids
+
+
+def on_connect(client, userdata, flags, rc, properties=None):
     """
     Callback function for MQTT Client
     """
     logger.info("Connected with result code " + str(rc))
+    if rc != 0:
+        return
 
-    # Subscribing loop
-    for topic in userdata.topics.keys():
+    # With a persistent session the broker still has the subscriptions
+    if userdata.persistent and flags.get('session present') and not userdata.resubscribe:
+        logger.info("Session resumed, {} topics still subscribed".format(len(userdata.topics)))
+        return
+
+    # Subscribing current topics
+    topics = list(userdata.topics.keys())
+    userdata.subscribe_start = time.monotonic()
+    mids = subscribe_topics(client, userdata, topics)
+    if mids is None:
+        return
+    userdata.pending_subacks = set(mids)
+    userdata.resubscribe = False
+    logger.info("Subscribing {} topics in {} packets with QoS {}".format(len(topics), len(mids),
+                                                                         userdata.qos))
+
+
+def on_subscribe(client, userdata, mid, granted_qos, properties=None):
+    """
+    Logs refused subscriptions and the time to subscribe all topics
+    """
+    failures = [qos for qos in granted_qos if int(getattr(qos, 'value', qos)) >= 0x80]
+    if failures != []:
+        logger.error("{} subscriptions refused by the broker".format(len(failures)))
+        userdata.resubscribe = True
+    if mid not in userdata.pending_subacks:
+        return
+    userdata.pending_subacks.discard(mid)
+    if userdata.pending_subacks == set():
+        logger.info("All topics subscribed in {:.1f} ms".format(
+                    1000 * (time.monotonic() - userdata.subscribe_start)))
+
+
+def normalize_reading(topic: str, data: dict, arrival: float):
+    """
+    Adds to a reading its timestamp, if missing, a unique '_id' and the
+    topic. Returns the reading time as epoch, 'arrival' if the timestamp
+    isn't in ISO format.
+    """
+    if 'timestamp' not in data.keys():
+        now = datetime.datetime.fromtimestamp(arrival).isoformat()
+        dot = now.rfind(".")
+        data['timestamp'] = now[:dot]
+    else:
         try:
-            client.subscribe(topic)
-            logger.info("Topic '{}' subscribed".format(topic))
+            arrival = datetime.datetime.fromisoformat(data['timestamp']).timestamp()
         except:
-            logger.error("Topic '{}' subscription failed".format(topic))
+            pass
+
+    # Add a unique '_id' to each message
+    data["_id"] = topic + "@" + data["timestamp"]
+    data["topic"] = topic
+    return arrival
 
 
 def on_message(client, userdata, msg):
@@ -242,28 +186,50 @@ def on_message(client, userdata, msg):
     On message receiving the corresponding Json will be pushed into a list
     to be processed later by archiver function
     """
+    profiling.poll()
     if msg.payload is None:
         logger.warning("Empty (None) payload received")
         return
 
+    # Own status messages may match wildcard subscriptions
+    if (userdata.status_prefix != "") and msg.topic.startswith(userdata.status_prefix + "/"):
+        return
+
+    # Topics may be unsubscribed by a configuration reload while
+    # messages are still in flight
+    metadata = config.topic_metadata(userdata.topics, msg.topic)
+    if metadata is None:
+        logger.debug("Topic '{}' no more configured", msg.topic)
+        return
+    arrival = time.time()
+
     try:
-        data = json.loads(msg.payload)
+        with profiling.span("decode"):
+            data = json.loads(msg.payload)
     except:
         logger.error("Conversion msg payload to JSON failed")
         logger.error("Reason: {}".format(sys.exc_info()))
         return
 
-    if 'timestamp' not in data.keys():
-        now = datetime.datetime.now().isoformat()
-        dot = now.rfind(".")
-        data['timestamp'] = now[:dot]
+    arrival = normalize_reading(msg.topic, data, arrival)
+    userdata.latest.update(msg.topic, data, metadata)
 
-    # Add a unique '_id' to each message
-    data["_id"] = msg.topic + "@" + data["timestamp"]
-    data["topic"] = msg.topic
-    tdata = (msg.topic, data)
-    userdata.queue.insert(0, tdata)
-    logger.debug("InQueue: {}".format(tdata))
+    # Compression policy of the topic, recreated if configuration changed
+    spec = (metadata.get('compression') or "").strip(" ")
+    if userdata.aggregating and (aggregator.store_mode(metadata) not in [None, aggregator.STORE_RAW]):
+        # Window measures are computed from all the readings
+        spec = ""
+    policy = userdata.policies.get(msg.topic)
+    if (policy is None) or (policy.spec != spec):
+        policy = compression.create(spec)
+        userdata.policies[msg.topic] = policy
+
+    for point in policy.process(arrival, data.get('value'), data):
+        with profiling.span("enqueue"):
+            reading = readings.Reading(msg.topic, point)
+            userdata.queue.appendleft(reading)
+        logger.debug("InQueue: {}", reading)
+        tracing.event("inqueue", "InQueue: {}", reading)
 
 
 def mqtt_client(ini: dict, mqtt_iface: MQTTInterface):
@@ -273,7 +239,7 @@ def mqtt_client(ini: dict, mqtt_iface: MQTTInterface):
     interface queue.
     """
     # Validate mqtt configuration parameters
-    if not verify_params(ini, 'mqtt', ['server', 'port', 'user', 'password',
+    if not config.verify_params(ini, 'mqtt', ['server', 'port', 'user', 'password',
                                       'keepalive']):
         return False
 
@@ -293,53 +259,363 @@ def mqtt_client(ini: dict, mqtt_iface: MQTTInterface):
         logger.error("MQTT keepalive isn't an integer!")
         return False
 
-    client = mqtt.Client(userdata=mqtt_iface)
+    # Clustered mode: instances of the same group split the messages
+    mqtt_iface.share_group = mqtt_params.get('share_group', "").strip(" ")
+    instance = instance_id(ini)
+    protocol = mqtt.MQTTv311
+    if mqtt_params.get('protocol', "311").strip(" ") == "5":
+        protocol = mqtt.MQTTv5
+    client_id = mqtt_params.get('client_id', "").strip(" ")
+    if mqtt_iface.share_group != "":
+        logger.info("Instance '{}' in shared subscription group '{}'".format(instance,
+                                                                           mqtt_iface.share_group))
+        if any((meta.get('compression') or "").strip(" ") != ""
+               for meta in mqtt_iface.topics.values()):
+            logger.warning("Compression state is kept by each instance on its share of messages")
+
+    # Reconnect optimized mode: the broker keeps the subscriptions and the
+    # QoS 1 messages of a stable client id while it is disconnected
+    try:
+        mqtt_iface.persistent = (mqtt_params.get('persistent_session', 'no').strip(" ") == 'yes')
+        mqtt_iface.qos = mqtt_params.getint('qos', 0)
+        mqtt_iface.subscribe_batch = max(1, mqtt_params.getint('subscribe_batch', 100))
+        session_expiry = mqtt_params.getint('session_expiry', 3600)
+        reconnect_min = mqtt_params.getint('reconnect_min', 1)
+        reconnect_max = mqtt_params.getint('reconnect_max', 120)
+    except:
+        logger.error("Invalid MQTT session parameters")
+        logger.error("Reason: {}".format(sys.exc_info()))
+        return False
+    if mqtt_iface.persistent and (client_id == ""):
+        # Process id would change the client id at each restart
+        client_id = mqtt_params.get('instance', "").strip(" ")
+        if (client_id == "") and (mqtt_iface.share_group != ""):
+            # Instances of a group on the same host would share the default
+            logger.error("Persistent session in a shared group needs 'client_id' or 'instance'")
+            return False
+        if client_id == "":
+            client_id = "{}-{}".format(socket.gethostname(), PROGNAME)
+    if (mqtt_iface.share_group != "") and (client_id == ""):
+        client_id = instance
+
+    clean_session = None
+    if protocol != mqtt.MQTTv5:
+        clean_session = not mqtt_iface.persistent
+    client = mqtt.Client(client_id=client_id, clean_session=clean_session,
+                         userdata=mqtt_iface, protocol=protocol)
     client.on_connect = on_connect
+    client.on_subscribe = on_subscribe
     client.on_message = on_message
-
-    client.connect(mqtt_server, mqtt_port, mqtt_keepalive)
+    client.reconnect_delay_set(reconnect_min, reconnect_max)
+    if mqtt_iface.persistent:
+        logger.info("Persistent session of client '{}', QoS {}".format(client_id, mqtt_iface.qos))
+
+    if (protocol == mqtt.MQTTv5) and mqtt_iface.persistent:
+        properties = Properties(PacketTypes.CONNECT)
+        properties.SessionExpiryInterval = session_expiry
+        client.connect(mqtt_server, mqtt_port, mqtt_keepalive, clean_start=False,
+                       properties=properties)
+    else:
+        client.connect(mqtt_server, mqtt_port, mqtt_keepalive)
 
     # Start MQTT internal loop
     client.loop_start()
+    return client
 
 
-def couchdb_client(ini: dict, mqtt_iface: MQTTInterface):
+def update_topics(client, mqtt_iface: MQTTInterface, topics: dict):
+    """
+    Replaces the configured topics subscribing only the new ones and
+    unsubscribing the removed ones
+    """
+    old_topics = mqtt_iface.topics
+    added = [topic for topic in topics.keys() if topic not in old_topics]
+    removed = [topic for topic in old_topics.keys() if topic not in topics]
+
+    # Atomic swap of the lookup used by 'on_message'
+    mqtt_iface.topics = topics
+
+    if removed != []:
+        result, mid = client.unsubscribe([subscription(mqtt_iface, topic) for topic in removed])
+        if result != mqtt.MQTT_ERR_SUCCESS:
+            # Persistent session would keep them after reconnection
+            mqtt_iface.resubscribe = True
+        logger.info("Topics unsubscribed: {}".format(removed))
+    if added != []:
+        if subscribe_topics(client, mqtt_iface, added) is None:
+            # Subscribed at next connection
+            mqtt_iface.resubscribe = True
+        logger.info("Topics subscribed: {}".format(added))
+    changed = [topic for topic in topics.keys()
+               if (topic in old_topics) and (topics[topic] != old_topics[topic])]
+    if changed != []:
+        logger.info("Topics metadata updated: {}".format(changed))
+
+
+def file_mtime(filepath: str):
+    """
+    Returns the modification time of a file or None if not available
+    """
+    try:
+        return os.stat(filepath).st_mtime_ns
+    except (OSError, TypeError):
+        return None
+
+
+class ConfigWatcher(threading.Thread):
+    """
+    Polls the INI and IoT configuration files and reloads them when changed
+    without stopping ingestion.
+    Changes of MQTT and CouchDB parameters require a restart.
+    """
+    def __init__(self, ini: dict, client, mqtt_iface: MQTTInterface, interval: float,
+                 progname: str = PROGNAME):
+        super().__init__(name="config-watcher", daemon=True)
+        self.ini = ini
+        self.progname = progname
+        self.client = client
+        self.mqtt_iface = mqtt_iface
+        self.interval = interval
+        self.ini_path = config.find_config(progname)
+        self.iot_path = config.iot_config_filepath(ini)
+        self.ini_mtime = file_mtime(self.ini_path)
+        self.iot_mtime = file_mtime(self.iot_path)
+
+    def reload_ini(self):
+        ini = configparser.ConfigParser()
+        try:
+            ini.read(self.ini_path)
+        except:
+            logger.error("Reloading '{}' failed".format(self.ini_path))
+            logger.error("Reason: {}".format(sys.exc_info()))
+            return
+        for section in ['mqtt', 'couchdb']:
+            if (section in ini) and (dict(ini[section]) != dict(self.ini[section])):
+                logger.warning("[{}] changes need a restart".format(section))
+        config.config_logging(ini, self.progname, instance_id(ini))
+        tracing.add_error_sink()
+        self.ini = ini
+        self.iot_path = config.iot_config_filepath(ini)
+        self.iot_mtime = None
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+
+            mtime = file_mtime(self.ini_path)
+            if mtime != self.ini_mtime:
+                self.ini_mtime = mtime
+                logger.info("Reloading '{}'".format(self.ini_path))
+                self.reload_ini()
+
+            mtime = file_mtime(self.iot_path)
+            if (mtime is None) or (mtime == self.iot_mtime):
+                continue
+            self.iot_mtime = mtime
+            logger.info("Reloading '{}'".format(self.iot_path))
+            topics = config.load_iot_config(self.ini)
+            if topics == {}:
+                logger.error("No topics loaded, configuration kept")
+                continue
+            update_topics(self.client, self.mqtt_iface, topics)
+
+
+def couchdb_client(ini: dict, mqtt_iface: MQTTInterface, client: dbclient.CouchDBClient = None):
     """
     Connects the CouchDB server, dequeues data from MQTT interface and
-    store it in the database.
+    store it in the database until stopped: then queued readings, open
+    buckets and windows are written before returning.
+    The client of a runtime hosting other programs is used if given.
     """
     # Validate mqtt configuration parameters
-    if not verify_params(ini, 'couchdb', ['server', 'port', 'user', 'password',
+    if not config.verify_params(ini, 'couchdb', ['server', 'port', 'user', 'password',
                          'dbname']):
         return False
 
     # CouchDB connection
-    couchdb_params = ini['couchdb']
-    user = couchdb_params['user']
-    passwd = couchdb_params['password']
-    server = couchdb_params['server']
-    port = couchdb_params['port']
-    dbname = couchdb_params['dbname']
-    couchdb_url = "http://{}:{}@{}:{}/{}".format(user, passwd,
-                                                 server, port, dbname)
-    couchdb = relax.CouchDB(couchdb_url, create_db=False)
-    logger.debug("CouchDB url: '{}'".format(couchdb_url))
+    if client is None:
+        client = dbclient.connect(ini)
+    if client is None:
+        return False
+    couchdb = client.database(ini['couchdb']['dbname'])
+    logger.info("CouchDB database: '{}'".format(couchdb))
+    if not dbclient.check_partitioning(couchdb):
+        return False
+    partitioned = couchdb.partitioned
+    if partitioned:
+        logger.info("Partitioned database: readings stored as '<topic>:<timestamp>'")
+
+    # Views used by dsarchiver and their warm-up after inserts
+    designdocs.install_design_docs(couchdb)
+    warmer = None
+    warmup_docs = ini['couchdb'].getint('warmup_docs', 1000)
+    if warmup_docs > 0:
+        warmer = designdocs.ViewWarmer(couchdb, warmup_docs,
+                                       ini['couchdb'].getfloat('warmup_idle', 5))
+        warmer.start()
+
+    # Optional layout with readings grouped in per-topic bucket documents
+    writer = None
+    layout = ini['couchdb'].get('layout', 'single')
+    if layout == 'bucket':
+        writer = buckets.BucketWriter(couchdb, ini['couchdb'].getint('bucket_seconds', 60))
+        logger.info("Bucket layout: {} s buckets".format(writer.seconds))
+    elif layout != 'single':
+        logger.error("Unknown layout '{}'".format(layout))
+        return False
+    next_flush = time.monotonic()
+
+    # Optional window measures computed at ingest time
+    aggr = None
+    if ini.has_section('aggregate'):
+        if not config.verify_params(ini, 'aggregate', ['datastore_dbname', 'devices_dbname']):
+            return False
+        if mqtt_iface.share_group != "":
+            # Each instance would write its partial measure of the same window
+            logger.error("Ingest-time aggregation not allowed in shared subscription group '{}'".format(
+                         mqtt_iface.share_group))
+            return False
+        window = measures.default_window(ini, 'aggregate')
+        if window is None:
+            return False
+        datastore = client.database(ini['aggregate']['datastore_dbname'])
+        if not dbclient.check_partitioning(datastore):
+            return False
+        aggr = aggregator.Aggregator(datastore, client.database(ini['aggregate']['devices_dbname']),
+                                     window)
+        logger.info("Ingest-time aggregation: {} min default window".format(aggr.window))
+
+    # Readings held by compression of topics not reporting any more
+    compression_idle = compression.IDLE_TIMEOUT
+    if 'iot' in ini:
+        compression_idle = ini['iot'].getfloat('compression_idle', compression.IDLE_TIMEOUT)
 
     # Insert loop
-    while True:
+    while not (mqtt_iface.stop.is_set() and len(mqtt_iface.queue) == 0):
+        profiling.poll()
+        if time.monotonic() >= next_flush:
+            if compression_idle > 0:
+                flush_policies(mqtt_iface, compression_idle)
+            if writer is not None:
+                writer.flush()
+            if aggr is not None:
+                with profiling.span("aggregate"):
+                    aggr.flush()
+            next_flush = time.monotonic() + 1
+
         try:
-            topic, data = mqtt_iface.queue.pop()
-        except:
-            time.sleep(5)
+            reading = mqtt_iface.queue.pop()
+        except IndexError:
+            mqtt_iface.stop.wait(1 if (writer is not None) or (aggr is not None) else 5)
             continue
+        topic = reading.topic
+        data = reading.to_doc()
+
+        if aggr is not None:
+            with profiling.span("aggregate"):
+                store = aggr.add(topic, data, config.topic_metadata(mqtt_iface.topics, topic))
+            if store == aggregator.STORE_AGGREGATE:
+                continue
+
+        if writer is not None:
+            with profiling.span("write"):
+                bucketed = writer.add(topic, data)
+            if bucketed:
+                if warmer is not None:
+                    warmer.notify(topic=topic)
+                continue
 
+        if partitioned:
+            data['_id'] = partitions.doc_id(topic, data['timestamp'], True)
         try:
-            couchdb.insert(data)
-            logger.debug("Insert ok: '{}'".format(data))
+            with profiling.span("write"):
+                couchdb.insert(data)
+            logger.debug("Insert ok: '{}'", data)
+            tracing.event("insert", "Insert ok: '{}'", data)
+            if warmer is not None:
+                warmer.notify(topic=topic)
         except:
             logger.error("Failed insert: '{}'".format(data))
             logger.error("Reason: '{}'".format(sys.exc_info()))
 
+    # Buckets and windows still open are written as they are
+    if writer is not None:
+        writer.flush(force=True)
+    if aggr is not None:
+        aggr.flush(force=True)
+    logger.info("Insert loop stopped")
+    return True
+
+
+def flush_policies(mqtt_iface: MQTTInterface, idle: float = 0):
+    """
+    Enqueues the readings held by the compression policies, only of topics
+    without readings for 'idle' seconds when given
+    """
+    for topic, policy in list(mqtt_iface.policies.items()):
+        for point in policy.flush(idle):
+            mqtt_iface.queue.appendleft(readings.Reading(topic, point))
+            logger.debug("Held reading of '{}' flushed", topic)
+
+
+def shutdown(client, mqtt_iface: MQTTInterface):
+    """
+    Stops receiving readings and the insert loop, which writes the queued
+    readings, the ones held by compression, the open buckets and windows
+    before returning
+    """
+    logger.info("Stopping, {} readings queued".format(len(mqtt_iface.queue)))
+    client.disconnect()
+    client.loop_stop()
+    flush_policies(mqtt_iface)
+    mqtt_iface.stop.set()
+
+
+def start(ini: dict, progname: str = PROGNAME):
+    """
+    Loads the IoT configuration, connects the MQTT broker and starts the
+    threads feeding the MQTT interface queue.
+    Returns the tuple of MQTT interface and client or None in error case.
+    """
+    # Load IoT configuration
+    topics = config.load_iot_config(ini)
+    if topics == {}:
+        logger.error("No topics to subscribe")
+        return None
+
+    # MQTT connection start
+    mqtt = MQTTInterface(collections.deque(), topics)
+    mqtt.aggregating = ini.has_section('aggregate')
+    if mqtt.aggregating:
+        uncompressed = [topic for topic, meta in topics.items()
+                        if (aggregator.store_mode(meta) not in [None, aggregator.STORE_RAW]) and
+                           ((meta.get('compression') or "").strip(" ") != "")]
+        if uncompressed != []:
+            logger.warning("Compression not applied to aggregated topics: {}".format(uncompressed))
+    else:
+        aggregated = [topic for topic, meta in topics.items()
+                      if aggregator.store_mode(meta) not in [None, aggregator.STORE_RAW]]
+        if aggregated != []:
+            logger.warning("No [aggregate] section, topics stored raw: {}".format(aggregated))
+    publisher = status.configure(ini, mqtt.latest)
+    if publisher is not None:
+        mqtt.status_prefix = publisher.prefix
+    client = mqtt_client(ini, mqtt)
+    if not client:
+        return None
+    if publisher is not None:
+        publisher.start_publishing(client)
+
+    # Compression ratio statistics
+    compression_stats = ini['iot'].getfloat('compression_stats', 300)
+    if compression_stats > 0:
+        compression.start_reporter(mqtt.policies, compression_stats)
+
+    # Configuration files reload
+    reload_interval = ini['iot'].getfloat('reload_interval', 10)
+    if reload_interval > 0:
+        ConfigWatcher(ini, client, mqtt, reload_interval, progname).start()
+    return (mqtt, client)
 
 
 @logger.catch
@@ -353,32 +629,41 @@ def main():
     parser = argparse.ArgumentParser(description = PROGDESCR, prog = PROGNAME)
     parser.add_argument('-v', '--version', help='Print version and exit.',
                         action = 'version', version = VERSION)
+    parser.add_argument('-p', '--profile', metavar='SECONDS',
+                        help='Profile the first SECONDS of execution (SIGUSR2 toggles profiling).',
+                        type = float, default = 0)
 
     args = parser.parse_args()
     logger.debug("CLI arguments: '{}'".format(args))
 
-    ini = load_config()
+    ini = config.load_config(PROGNAME)
     if ini is None:
         return
 
-    # Configure logging on file
-    config_logging(ini)
+    # Configure logging on file and tracing
+    config.config_logging(ini, PROGNAME, instance_id(ini))
+    tracing.configure(ini, PROGNAME)
+    profiling.configure(ini, PROGNAME, args.profile)
     logger.info("---------------------------------------------------------")
     logger.info("| '{}'  START                   ".format(PROGNAME))
     logger.info("---------------------------------------------------------")
 
-    # Load IoT configuration
-    topics = load_iot_config(ini)
-    if topics == {}:
-        logger.error("No topics to subscribe")
+    started = start(ini)
+    if started is None:
         return
+    mqtt, client = started
 
-    # MQTT connection start
-    mqtt = MQTTInterface([], topics)
-    mqtt_client(ini, mqtt)
+    # Shutdown is done out of the signal handler, the interrupted thread may
+    # hold the logging or MQTT client locks
+    for signum in [signal.SIGTERM, signal.SIGINT]:
+        signal.signal(signum, lambda signum, frame: threading.Thread(target=shutdown,
+                                                                     args=(client, mqtt),
+                                                                     name="shutdown").start())
 
     # CouchDB
     couchdb_client(ini, mqtt)
+    profiling.shutdown()
+    logger.info("{} exited".format(PROGNAME))
 
 
 if __name__ == "__main__":
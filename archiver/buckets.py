@@ -0,0 +1,188 @@
+# File: buckets.py
+# Date: 18-10-2026
+# Author: Saruccio Culmone
+#
+# Time-bucketed multi-reading documents
+
+"""
+Storage layout grouping the readings of a topic into one document per time
+bucket instead of one document per reading.
+
+A bucket document holds parallel arrays of the readings received in the
+bucket:
+
+    {
+        "_id": "<topic>@<bucket start>#bucket",  ('<topic>:...' if partitioned)
+        "topic": "<topic>",
+        "type": "<type of first reading>",
+        "bucket": {"start": "<iso timestamp>", "end": "<iso timestamp>"},
+        "timestamps": [...],
+        "values": [...],
+        "devs": [...],
+        "extra": [...]      (only if readings have other keys)
+    }
+
+Buckets are aligned to wall clock multiples of their length and written
+when a reading of a later bucket arrives, when the bucket end has passed or
+at shutdown. The id suffix keeps bucket ids distinct from the ones of single
+readings of the bucket start second, stored before a layout switch.
+"""
+
+import sys
+import time
+import datetime
+import time2relax as relax
+from loguru import logger
+import tracing
+import partitions
+
+
+# Keys of a reading stored in the bucket arrays
+READING_KEYS = ['_id', 'topic', 'timestamp', 'value', 'dev', 'type']
+
+# Seconds waited after bucket end for late readings
+BUCKET_GRACE = 5
+
+# Suffix of bucket document ids
+BUCKET_SUFFIX = "#bucket"
+
+# Attempts of merging a bucket with the stored one updated concurrently
+MERGE_RETRIES = 5
+
+
+def bucket_id(topic: str, start: str, partitioned: bool):
+    """
+    Returns the id of the bucket document of a topic starting at 'start'
+    """
+    return partitions.doc_id(topic, start + BUCKET_SUFFIX, partitioned)
+
+
+class BucketWriter:
+    """
+    Accumulates readings into per-topic buckets and writes closed ones
+    """
+    def __init__(self, db: relax.CouchDB, seconds: int):
+        self.db = db
+        self.seconds = seconds
+        self.partitioned = db.partitioned
+        self.buckets = dict()
+
+    def bucket_start(self, timestamp: str):
+        """
+        Returns the start epoch of the bucket of a timestamp or None if the
+        timestamp is not in ISO format
+        """
+        try:
+            epoch = datetime.datetime.fromisoformat(timestamp).timestamp()
+        except:
+            return None
+        return epoch - (epoch % self.seconds)
+
+    def new_bucket(self, topic: str, start: float, data: dict):
+        start_dt = datetime.datetime.fromtimestamp(start)
+        end_dt = start_dt + datetime.timedelta(seconds=self.seconds)
+        bucket = {'_id': bucket_id(topic, start_dt.isoformat(timespec='seconds'),
+                                   self.partitioned),
+                  'topic': topic,
+                  'type': data.get('type'),
+                  'bucket': {'start': start_dt.isoformat(timespec='seconds'),
+                             'end': end_dt.isoformat(timespec='seconds')},
+                  'timestamps': [],
+                  'values': [],
+                  'devs': []}
+        return (start, bucket)
+
+    def add(self, topic: str, data: dict):
+        """
+        Adds a reading to its bucket.
+        Returns False if the reading can't be bucketed (timestamp not in
+        ISO format).
+        """
+        start = self.bucket_start(data['timestamp'])
+        if start is None:
+            return False
+
+        current = self.buckets.get(topic)
+        if (current is not None) and (current[0] != start):
+            self.write(current[1])
+            current = None
+        if current is None:
+            current = self.new_bucket(topic, start, data)
+            self.buckets[topic] = current
+
+        bucket = current[1]
+        bucket['timestamps'].append(data['timestamp'])
+        bucket['values'].append(data.get('value'))
+        bucket['devs'].append(data.get('dev'))
+        extra = {key: value for key, value in data.items() if key not in READING_KEYS}
+        if (extra != {}) and ('extra' not in bucket):
+            bucket['extra'] = [None] * (len(bucket['values']) - 1)
+        if 'extra' in bucket:
+            bucket['extra'].append(extra if extra != {} else None)
+        return True
+
+    def flush(self, force: bool = False):
+        """
+        Writes buckets whose end has passed, all of them if forced
+        """
+        now = time.time()
+        for topic in list(self.buckets.keys()):
+            start, bucket = self.buckets[topic]
+            if force or (now >= start + self.seconds + BUCKET_GRACE):
+                del self.buckets[topic]
+                self.write(bucket)
+
+    def write(self, bucket: dict):
+        """
+        Inserts a bucket merging it with a document of the same bucket
+        already stored by late readings
+        """
+        try:
+            try:
+                self.db.insert(bucket)
+            except relax.ResourceConflict:
+                self.merge(bucket)
+            logger.debug("Bucket ok: '{}' {} readings", bucket['_id'], len(bucket['values']))
+            tracing.event("bucket", "Bucket ok: '{}' {} readings", bucket['_id'], len(bucket['values']))
+            return True
+        except:
+            logger.error("Failed bucket insert: '{}'".format(bucket))
+            logger.error("Reason: '{}'".format(sys.exc_info()))
+            return False
+
+    def merge(self, bucket: dict):
+        """
+        Appends the bucket readings to the stored document, fetching it again
+        if it was updated in the meantime (by another archiver instance)
+        """
+        logger.warning("Merging bucket '{}'".format(bucket['_id']))
+        for attempt in range(MERGE_RETRIES):
+            stored = self.db.get(bucket['_id']).json()
+            if ('extra' in stored) or ('extra' in bucket):
+                stored['extra'] = (stored.get('extra', [None] * len(stored['values'])) +
+                                   bucket.get('extra', [None] * len(bucket['values'])))
+            for key in ['timestamps', 'values', 'devs']:
+                stored[key].extend(bucket[key])
+            try:
+                self.db.insert(stored)
+                return
+            except relax.ResourceConflict:
+                logger.warning("Bucket '{}' updated meanwhile, attempt {}".format(bucket['_id'],
+                                                                                  attempt + 1))
+        raise relax.ResourceConflict("Bucket '{}' not merged in {} attempts".format(
+            bucket['_id'], MERGE_RETRIES))
+
+
+def expand_bucket(doc: dict):
+    """
+    Returns the readings of a bucket document as view rows of single reading
+    documents
+    """
+    rows = []
+    for index, timestamp in enumerate(doc['timestamps']):
+        reading = {'timestamp': timestamp,
+                   'value': doc['values'][index],
+                   'dev': doc['devs'][index],
+                   'type': doc.get('type')}
+        rows.append({'id': doc['_id'], 'value': reading['value'], 'doc': reading})
+    return rows
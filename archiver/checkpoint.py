@@ -0,0 +1,106 @@
+# File: checkpoint.py
+# Date: 18-10-2026
+# Author: Saruccio Culmone
+#
+# Persistent per-topic checkpoint of the archiving process
+
+"""
+Each topic archived by dsarchiver keeps a '_local' document in the
+datastore database recording the last time window whose aggregate has been
+stored and which raw readings have to be removed from the realtime database.
+
+'_local' documents are never replicated and are not indexed by views, so
+the checkpoint is cheap to update at every window.
+
+The same documents, with a different prefix, record the progress of other
+resumable processes.
+"""
+
+import sys
+import time2relax as relax
+from loguru import logger
+
+
+# Checkpoint states
+# - inserted: aggregate stored in datastore, raw readings still to be deleted
+# - committed: raw readings deleted, window fully archived
+STATE_INSERTED = "inserted"
+STATE_COMMITTED = "committed"
+
+# Prefix of checkpoint document ids
+CHECKPOINT_PREFIX = "_local/dsarchiver@"
+
+
+class Checkpoint:
+    """
+    Checkpoint of a single topic stored as '_local' CouchDB document
+    """
+    def __init__(self, db: relax.CouchDB, topic: str, prefix: str = CHECKPOINT_PREFIX):
+        self.db = db
+        self.topic = topic
+        self.doc = {'_id': prefix + topic, 'topic': topic}
+
+    @property
+    def state(self):
+        return self.doc.get('state')
+
+    def committed_slot(self, window: int):
+        """
+        Returns the start of the last slot of 'window' minutes whose
+        measure has been stored, None if not recorded
+        """
+        if self.doc.get('window') != window:
+            return None
+        return self.doc.get('slot_start')
+
+    def load(self, window: int = None):
+        """
+        Reads the checkpoint from the database.
+        If 'window' (minutes) is given and differs from the stored one, a
+        committed checkpoint is discarded, while the deletion of an inserted
+        slot is still completed since its measure is stored.
+        Returns True if a checkpoint was found, False if missing, discarded
+        or in error case.
+        """
+        try:
+            result = self.db.get(self.doc['_id'])
+        except relax.ResourceNotFound:
+            logger.info("No checkpoint for topic '{}'".format(self.topic))
+            return False
+        except:
+            logger.error("Failed reading checkpoint of '{}'".format(self.topic))
+            logger.error("Reason: {}".format(sys.exc_info()))
+            return False
+
+        self.doc = result.json()
+        logger.info("Checkpoint '{}': state= {}, window= {}".format(self.topic,
+                                                                  self.state,
+                                                                  self.doc.get('window')))
+        if (window is not None) and (self.doc.get('window') != window):
+            if self.state != STATE_INSERTED:
+                logger.warning("Checkpoint '{}' of {} min window discarded".format(
+                               self.topic, self.doc.get('window')))
+                # Next save overwrites it
+                self.doc = {'_id': self.doc['_id'], 'topic': self.topic,
+                            '_rev': self.doc['_rev']}
+                return False
+            logger.warning("Checkpoint '{}' of {} min window, pending deletion completed".format(
+                           self.topic, self.doc.get('window')))
+        return True
+
+    def save(self, **fields):
+        """
+        Updates the checkpoint with the given fields and writes it.
+        Returns True on success, False otherwise.
+        """
+        self.doc.update(fields)
+        try:
+            result = self.db.insert(self.doc)
+        except:
+            logger.error("Failed writing checkpoint of '{}'".format(self.topic))
+            logger.error("Reason: {}".format(sys.exc_info()))
+            return False
+
+        self.doc['_rev'] = result.json()['rev']
+        logger.debug("Checkpoint '{}' saved: state= {}".format(self.topic, self.state))
+        return True
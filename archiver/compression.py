@@ -0,0 +1,227 @@
+# File: compression.py
+# Date: 18-10-2026
+# Author: Saruccio Culmone
+#
+# Readings compression before storage
+
+"""
+Per-topic compression policies applied by archiver before storing readings.
+
+Policies are configured in the 'compression' column of the IoT
+configuration file as '<policy>:<tolerance>[:<max interval>]':
+
+- deadband:<abs>     stores a reading if it differs more than <abs> from the
+                     last stored one
+- deadband%:<perc>   as above with tolerance in percent of last stored value
+- sdt:<abs>          swinging door trending: stores only the readings needed
+                     to rebuild the signal by linear interpolation within
+                     <abs>
+
+<max interval> (seconds) forces a reading to be stored at least that often.
+Readings without a numeric 'value' are always stored.
+With 'sdt' a reading is stored when a later one breaks the corridor, so the
+last reading of a series is held until the next one arrives: it is flushed
+when no reading arrives for IDLE_TIMEOUT seconds ('compression_idle' of
+[iot]) and at shutdown.
+"""
+
+import time
+import threading
+from loguru import logger
+
+
+# Default seconds without readings after which a held reading is stored
+IDLE_TIMEOUT = 60
+
+
+class Policy:
+    """
+    Base policy storing every reading and counting them
+    """
+    def __init__(self, spec: str, tolerance: float = 0.0, max_interval: float = 0.0):
+        self.spec = spec
+        self.tolerance = tolerance
+        self.max_interval = max_interval
+        self.received = 0
+        self.stored = 0
+        self.last_arrival = time.monotonic()
+        # Readings are processed by the MQTT thread and flushed by others
+        self.lock = threading.Lock()
+
+    def process(self, timestamp: float, value, data: dict):
+        """
+        Returns the list of readings to be stored
+        """
+        with self.lock:
+            self.received += 1
+            self.last_arrival = time.monotonic()
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                self.stored += 1
+                return [data]
+            points = self.compress(timestamp, value, data)
+            self.stored += len(points)
+            return points
+
+    def flush(self, idle: float = 0):
+        """
+        Returns the list of held readings to be stored, only if no reading
+        arrived for 'idle' seconds when given
+        """
+        with self.lock:
+            if (idle > 0) and (time.monotonic() - self.last_arrival < idle):
+                return []
+            points = self.release()
+            self.stored += len(points)
+            return points
+
+    def compress(self, timestamp: float, value: float, data: dict):
+        return [data]
+
+    def release(self):
+        return []
+
+
+class Deadband(Policy):
+    """
+    Absolute or relative deadband with heartbeat
+    """
+    def __init__(self, spec: str, tolerance: float, max_interval: float, relative: bool):
+        super().__init__(spec, tolerance, max_interval)
+        self.relative = relative
+        self.last = None
+
+    def compress(self, timestamp: float, value: float, data: dict):
+        if self.last is not None:
+            last_timestamp, last_value = self.last
+            limit = self.tolerance
+            if self.relative:
+                limit = abs(last_value) * self.tolerance / 100.0
+            heartbeat = (self.max_interval > 0) and (timestamp - last_timestamp >= self.max_interval)
+            if (abs(value - last_value) <= limit) and not heartbeat:
+                return []
+        self.last = (timestamp, value)
+        return [data]
+
+
+class SwingingDoor(Policy):
+    """
+    Swinging door trending with heartbeat.
+    The corridor is kept as the range of slopes of the lines starting from
+    last stored reading and passing within tolerance from all readings
+    received since: a reading is stored when the line to the next one falls
+    outside the corridor.
+    """
+    def __init__(self, spec: str, tolerance: float, max_interval: float):
+        super().__init__(spec, tolerance, max_interval)
+        self.archived = None
+        self.held = None
+
+    def restart(self, timestamp: float, value: float):
+        self.archived = (timestamp, value)
+        self.held = None
+        self.slope_min = float("-inf")
+        self.slope_max = float("inf")
+
+    def narrow(self, timestamp: float, value: float):
+        """
+        Narrows the corridor with a reading returning False if the line to
+        the reading leaves previous readings out of tolerance
+        """
+        archived_timestamp, archived_value = self.archived
+        dt = timestamp - archived_timestamp
+        if dt <= 0:
+            return abs(value - archived_value) <= self.tolerance
+        slope = (value - archived_value) / dt
+        if (slope < self.slope_min) or (slope > self.slope_max):
+            return False
+        self.slope_min = max(self.slope_min, (value - archived_value - self.tolerance) / dt)
+        self.slope_max = min(self.slope_max, (value - archived_value + self.tolerance) / dt)
+        return True
+
+    def compress(self, timestamp: float, value: float, data: dict):
+        if self.archived is None:
+            self.restart(timestamp, value)
+            return [data]
+
+        points = []
+        if not self.narrow(timestamp, value):
+            if self.held is None:
+                self.restart(timestamp, value)
+                return [data]
+            # Corridor closed: previous reading becomes the new pivot
+            held_timestamp, held_value, held_data = self.held
+            points.append(held_data)
+            self.restart(held_timestamp, held_value)
+            self.narrow(timestamp, value)
+
+        # The line to this reading is within the corridor, so it can be
+        # stored as heartbeat
+        archived_timestamp, archived_value = self.archived
+        if (self.max_interval > 0) and (timestamp - archived_timestamp >= self.max_interval):
+            points.append(data)
+            self.restart(timestamp, value)
+            return points
+
+        self.held = (timestamp, value, data)
+        return points
+
+    def release(self):
+        # The held reading becomes the pivot of next readings
+        if self.held is None:
+            return []
+        held_timestamp, held_value, held_data = self.held
+        self.restart(held_timestamp, held_value)
+        return [held_data]
+
+
+def create(spec: str):
+    """
+    Creates the policy described by 'spec', a policy storing every reading
+    if the spec is empty or invalid
+    """
+    if (spec is None) or (spec.strip(" ") == ""):
+        return Policy("")
+
+    spec = spec.strip(" ")
+    fields = spec.split(":")
+    try:
+        name = fields[0].strip(" ")
+        tolerance = float(fields[1])
+        max_interval = float(fields[2]) if len(fields) > 2 else 0.0
+        if name == "deadband":
+            return Deadband(spec, tolerance, max_interval, relative=False)
+        if name == "deadband%":
+            return Deadband(spec, tolerance, max_interval, relative=True)
+        if name == "sdt":
+            return SwingingDoor(spec, tolerance, max_interval)
+    except (IndexError, ValueError):
+        pass
+
+    logger.error("Invalid compression policy '{}', readings stored uncompressed".format(spec))
+    return Policy(spec)
+
+
+def start_reporter(policies: dict, interval: float):
+    """
+    Starts a daemon thread logging the compression ratio of each topic every
+    'interval' seconds
+    """
+    def report():
+        while True:
+            time.sleep(interval)
+            received = 0
+            stored = 0
+            for topic, policy in list(policies.items()):
+                if policy.spec == "":
+                    continue
+                received += policy.received
+                stored += policy.stored
+                logger.info("Compression '{}' ({}): {}/{} stored, ratio= {:.1f}".format(
+                            topic, policy.spec, policy.stored, policy.received,
+                            policy.received / max(1, policy.stored)))
+            if received > 0:
+                logger.info("Compression total: {}/{} stored, ratio= {:.1f}".format(
+                            stored, received, received / max(1, stored)))
+
+    thread = threading.Thread(target=report, name="compression-stats", daemon=True)
+    thread.start()
@@ -13,32 +13,47 @@ import time
 import argparse
 import configparser
 import csv
+from paho.mqtt.client import topic_matches_sub
 from loguru import logger
 
 
 # Directory list to search configuration file other than HOME dir
 CONFIG_DIRS = [os.environ["HOME"], ".", "/etc"]
 
+# Log format with the identity of the program instance
+INSTANCE_LOG_FORMAT = ("{time:YYYY-MM-DD HH:mm:ss.SSS} | {level: <8} | {extra[instance]} | "
+                       "{name}:{function}:{line} - {message}")
 
-def load_config(progname: str):
+
+def find_config(progname: str):
     """
-    Serarch and load configuration file.
-    Returns an dictionary mapping the INI file of None in error case
+    Serarch configuration file.
+    Returns its path or None if not found
     """
     config_fname = progname + ".ini"
     logger.info("Searching for '{}' configuration file".format(config_fname))
-    # INI dictionary
-    ini = None
-
     for configdir in CONFIG_DIRS:
         configfilepath = os.path.join(configdir, config_fname)
         logger.debug("Searching for '{}'".format(configfilepath))
         if os.path.exists(configfilepath):
-            logger.info("Using config file: '{}'".format(configfilepath))
-            ini = configparser.ConfigParser()
-            #try:
-            ini.read(configfilepath)
-            break;
+            return configfilepath
+    return None
+
+
+def load_config(progname: str):
+    """
+    Serarch and load configuration file.
+    Returns an dictionary mapping the INI file of None in error case
+    """
+    # INI dictionary
+    ini = None
+
+    configfilepath = find_config(progname)
+    if configfilepath is not None:
+        logger.info("Using config file: '{}'".format(configfilepath))
+        ini = configparser.ConfigParser()
+        #try:
+        ini.read(configfilepath)
     if ini is None:
         logger.error("Configuration file non found.")
     return ini
@@ -82,8 +97,12 @@ def verify_params(ini: dict, section: str, req_params: list):
     return True
 
 
+# Handler id of the log file, replaced when logging is configured again
+file_handler = None
+
+
 # Logging confguration
-def config_logging(ini: dict, progname: str):
+def config_logging(ini: dict, progname: str, instance: str = None):
     """
     Configure logging on file and on screen from parameters taken from
     configuration INI file.
@@ -97,18 +116,24 @@ def config_logging(ini: dict, progname: str):
         - log_rotation_size
         - log_retention
         - trace_level
+        - console_log (optional, default no)
 
     progname : str
         name of the program calling this function
 
+    instance : str
+        identity of the program instance added to each log line, if given
+
     Return
     ------
     True if logging on file is ok
     False otherwise
     """
+    global file_handler
+
     # Control if INI file contains [config] section
     req_params = ['logdir', 'log_rotation', 'log_rotation_size',
-                  'log_retention', 'trace_level', 'console_log']
+                  'log_retention', 'trace_level']
     if not verify_params(ini, 'config', req_params):
         return False
 
@@ -126,7 +151,7 @@ def config_logging(ini: dict, progname: str):
     log_rotation_size = log_config['log_rotation_size']
     log_retention = log_config['log_retention']
     trace_level = log_config['trace_level']
-    console_log = log_config['console_log']
+    console_log = log_config.get('console_log', 'no')
 
     log_fname = progname + ".log"
     logfilepath = os.path.join(logdir, log_fname)
@@ -134,17 +159,28 @@ def config_logging(ini: dict, progname: str):
 
     if console_log == 'no':
         logger.remove()
+    elif file_handler is not None:
+        # Reload of the INI file: only the previous log file is removed
+        try:
+            logger.remove(file_handler)
+        except ValueError:
+            pass
+
+    log_format = dict()
+    if instance is not None:
+        logger.configure(extra={'instance': instance})
+        log_format['format'] = INSTANCE_LOG_FORMAT
 
     try:
         if log_rotation == 'yes':
-            logger.add(logfilepath, rotation=log_rotation_size,
-                    retention=log_retention, level=trace_level)
+            file_handler = logger.add(logfilepath, rotation=log_rotation_size,
+                                      retention=log_retention, level=trace_level, **log_format)
         else:
-            logger.add(logfilepath, level=trace_level)
+            file_handler = logger.add(logfilepath, level=trace_level, **log_format)
 
         logger.info("Logging setup on file: '{}'".format(logfilepath))
-        for param in req_params:
-            logger.info("{}= {}".format(param, log_config[param]))
+        for param in req_params + ['console_log']:
+            logger.info("{}= {}".format(param, log_config.get(param)))
     except:
         logger.error("Logging setup on file '{}' failed".format(logfilepath))
         logger.error("Reason: {}".format(sys.exc_info()))
@@ -153,14 +189,12 @@ def config_logging(ini: dict, progname: str):
     return True
 
 
-
-
-def load_iot_config(ini: dict):
+def iot_config_filepath(ini: dict):
     """
-
+    Returns the path of the IoT configuration file or None in error case
     """
     if not verify_params(ini, 'iot', ['file', 'filedir']):
-        return {}
+        return None
 
     # Set file directory
     iot_params = ini['iot']
@@ -174,35 +208,71 @@ def load_iot_config(ini: dict):
     iot_config = iot_params['file']
     filepath = os.path.join(filedir, iot_config)
     logger.info("IoT config filepath: '{}'".format(filepath))
+    return filepath
+
+
+def load_iot_config(ini: dict):
+    """
+    Loads the IoT configuration file returning a dictionary of topics
+    metadata or an empty dictionary in error case
+    """
+    filepath = iot_config_filepath(ini)
+    if filepath is None:
+        return {}
+
     if not os.path.exists(filepath):
         logger.error("IoT config file '{}' not found".format(filepath))
         return {}
 
     # Load configuration data
-    topics = dict()
-    fieldnames = ["topic", "where", "h", "x", "y", "unit", "notes"]
     try:
-        csvfd = open(filepath, "r", newline='')
-        reader = csv.DictReader(csvfd, fieldnames=fieldnames,
-                                delimiter=";")
-        for row in reader:
-            topic = row['topic'].strip(" ")
-            if topic == 'topic':
-                logger.debug("Skipping header")
-                continue
-            if topic[0] == "#":
-                logger.warning("Line {} commented out".format(reader.line_num))
-                continue
-            if topic in topics.keys():
-                logger.warning("Topic '{}' at line {} skipped beacause duplicated ".format(topic, reader.line_num))
-                continue
-            # Remove 'topic' key and assign remaining to topics dict
-            row.pop('topic')
-            topics[topic] = row
-            logger.debug("Topic '{}' added: {}".format(topic, topics[topic]))
+        with open(filepath, "r", newline='') as csvfd:
+            topics = read_iot_topics(csvfd)
     except:
         logger.error("Loading IoT topics failed")
         logger.error("Reason: {}".format(sys.exc_info()))
         return {}
 
     return topics
+
+
+def read_iot_topics(csvfd):
+    """
+    Parses the IoT configuration CSV returning a dictionary of topics
+    metadata
+    """
+    topics = dict()
+    fieldnames = ["topic", "where", "h", "x", "y", "unit", "notes", "compression", "window",
+                  "store"]
+    reader = csv.DictReader(csvfd, fieldnames=fieldnames, delimiter=";")
+    for row in reader:
+        topic = row['topic'].strip(" ")
+        if topic == 'topic':
+            logger.debug("Skipping header")
+            continue
+        if topic[0] == "#":
+            logger.warning("Line {} commented out".format(reader.line_num))
+            continue
+        if topic in topics.keys():
+            logger.warning("Topic '{}' at line {} skipped beacause duplicated ".format(topic, reader.line_num))
+            continue
+        # Remove 'topic' key and assign remaining to topics dict
+        row.pop('topic')
+        topics[topic] = row
+        logger.debug("Topic '{}' added: {}".format(topic, topics[topic]))
+
+    return topics
+
+
+def topic_metadata(topics: dict, topic: str):
+    """
+    Returns the configuration metadata of a topic, matching wildcard
+    topics too, or None if the topic is not configured
+    """
+    metadata = topics.get(topic)
+    if metadata is not None:
+        return metadata
+    for subscription in topics.keys():
+        if topic_matches_sub(subscription, topic):
+            return topics[subscription]
+    return None
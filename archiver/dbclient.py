@@ -0,0 +1,267 @@
+# File: dbclient.py
+# Date: 18-10-2026
+# Author: Saruccio Culmone
+#
+# Shared CouchDB client layer
+
+"""
+Single CouchDB client shared by all threads and databases of a program.
+
+All databases opened through a client use the same HTTP session, backed by
+a bounded pool of keep-alive connections. Failed requests (connection
+errors, timeouts and 5xx responses) are retried with exponential backoff
+and jitter and every request latency is collected into statistics
+periodically written to the log.
+
+Credentials are passed as HTTP basic authentication, so database URLs never
+contain them and can be logged safely.
+"""
+
+import sys
+import time
+import random
+import threading
+import requests
+import time2relax as relax
+from time2relax import time2relax as api
+from time2relax import utils as relax_utils
+from loguru import logger
+import configuration as config
+
+
+# Default values of the optional [couchdb] parameters
+POOL_SIZE = 10
+TIMEOUT = 30.0
+RETRIES = 5
+BACKOFF = 0.5
+BACKOFF_MAX = 30.0
+STATS_INTERVAL = 300
+
+
+class RequestStats:
+    """
+    Thread safe collection of request latencies grouped by method and
+    database
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.started = time.monotonic()
+        self.counters = dict()
+        self.errors = 0
+        self.retries = 0
+
+    def record(self, key: str, elapsed: float):
+        with self.lock:
+            count, total, maximum = self.counters.get(key, (0, 0.0, 0.0))
+            self.counters[key] = (count + 1, total + elapsed, max(maximum, elapsed))
+
+    def record_error(self, retried: bool):
+        with self.lock:
+            self.errors += 1
+            if retried:
+                self.retries += 1
+
+    def summary(self):
+        """
+        Returns the list of statistic lines since last call and resets
+        counters
+        """
+        with self.lock:
+            period = time.monotonic() - self.started
+            lines = ["CouchDB requests in {:.0f} s: errors= {}, retries= {}".format(period,
+                                                                              self.errors,
+                                                                              self.retries)]
+            for key in sorted(self.counters):
+                count, total, maximum = self.counters[key]
+                lines.append("  {}: n= {}, rate= {:.1f}/s, avg= {:.1f} ms, max= {:.1f} ms".format(
+                             key, count, count / period, 1000 * total / count, 1000 * maximum))
+            self.reset()
+        return lines
+
+
+class Database(relax.CouchDB):
+    """
+    CouchDB database whose requests go through the shared client
+    """
+    def __init__(self, client, dbname: str):
+        super().__init__("{}/{}".format(client.url, dbname), create_db=False)
+        self.client = client
+        self.session = client.session
+        self._partitioned = None
+
+    def request(self, method, path, _init=True, **kwargs):
+        kwargs.setdefault('timeout', self.client.timeout)
+        return self.client.call(super().request, self.name, method, path,
+                                _init=_init, **kwargs)
+
+    @property
+    def partitioned(self):
+        """
+        True if the database is partitioned, read once from database info.
+        Raises the request error if the info can't be read after retries:
+        document ids of an unknown layout would be wrong.
+        """
+        if self._partitioned is None:
+            try:
+                props = self.info().json().get('props', {})
+            except:
+                logger.error("Failed reading '{}' info".format(self.name))
+                logger.error("Reason: {}".format(sys.exc_info()))
+                raise
+            self._partitioned = props.get('partitioned', False)
+        return self._partitioned
+
+    def partition_view(self, partition: str, ddoc_id: str, func_id: str, **kwargs):
+        """
+        Executes a view of a partitioned design document scanning only the
+        shard of the partition
+        """
+        method, path, kwargs = api.ddoc_view(ddoc_id, func_id, **kwargs)
+        path = "_partition/{}/{}".format(relax_utils.encode_uri_component(partition), path)
+        return self.request(method, path, **kwargs)
+
+
+class CouchDBClient:
+    """
+    Connection pool to a CouchDB server
+    """
+    def __init__(self, server: str, port: str, user: str, password: str,
+                 pool_size: int = POOL_SIZE, timeout: float = TIMEOUT,
+                 retries: int = RETRIES, backoff: float = BACKOFF,
+                 backoff_max: float = BACKOFF_MAX):
+        self.url = "http://{}:{}".format(server, port)
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.stats = RequestStats()
+        self.databases = dict()
+        self.lock = threading.Lock()
+
+        # Requests beyond pool size wait for a free connection
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                                pool_maxsize=pool_size,
+                                                pool_block=True)
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.auth = (user, password)
+        self.session.headers["Accept"] = "application/json"
+
+    def __repr__(self):
+        return "<{} [{}]>".format(self.__class__.__name__, self.url)
+
+    def database(self, dbname: str):
+        """
+        Returns the database instance bound to this client
+        """
+        with self.lock:
+            if dbname not in self.databases:
+                self.databases[dbname] = Database(self, dbname)
+            return self.databases[dbname]
+
+    def call(self, func, dbname: str, method: str, path: str, **kwargs):
+        """
+        Executes a request retrying it on connection errors, timeouts and
+        server errors. Other HTTP errors are raised immediately.
+        """
+        key = "{} {}".format(method, dbname)
+        attempt = 0
+        while True:
+            start = time.monotonic()
+            try:
+                result = func(method, path, **kwargs)
+                self.stats.record(key, time.monotonic() - start)
+                return result
+            except (requests.ConnectionError, requests.Timeout) as exc:
+                error = exc
+                reason = exc
+            except relax.HTTPError as exc:
+                response = exc.args[1] if len(exc.args) > 1 else None
+                if (response is None) or (response.status_code < 500):
+                    self.stats.record(key, time.monotonic() - start)
+                    raise
+                error = exc
+                reason = "HTTP {}".format(response.status_code)
+
+            retry = attempt < self.retries
+            self.stats.record_error(retry)
+            if not retry:
+                # Out of the except clause the error must be raised explicitly
+                raise error
+
+            # Exponential backoff with full jitter
+            delay = random.uniform(0, min(self.backoff_max, self.backoff * 2 ** attempt))
+            attempt += 1
+            logger.warning("{} {}/{} failed, retry {} in {:.2f} s".format(method, dbname,
+                                                                         path, attempt, delay))
+            logger.warning("Reason: {}".format(reason))
+            time.sleep(delay)
+
+    def start_stats_reporter(self, interval: float):
+        """
+        Starts a daemon thread logging request statistics every 'interval'
+        seconds
+        """
+        def report():
+            while True:
+                time.sleep(interval)
+                for line in self.stats.summary():
+                    logger.info(line)
+
+        thread = threading.Thread(target=report, name="couchdb-stats", daemon=True)
+        thread.start()
+
+
+def check_partitioning(*databases):
+    """
+    Reads the partitioning of the databases at startup.
+    Returns False if it can't be read for any of them.
+    """
+    for database in databases:
+        try:
+            database.partitioned
+        except:
+            return False
+    return True
+
+
+def connect(ini: dict):
+    """
+    Creates the CouchDB client from the [couchdb] section of the INI file.
+    Returns the client or None in error case.
+
+    Optional parameters are:
+    - pool_size: max number of connections (default 10)
+    - timeout: seconds per request (default 30)
+    - retries: max retries of a failed request (default 5)
+    - backoff: initial retry delay in seconds (default 0.5)
+    - stats_interval: seconds between statistics logs, 0 disables them
+      (default 300)
+    """
+    if not config.verify_params(ini, 'couchdb', ['server', 'port', 'user', 'password']):
+        return None
+
+    couchdb_params = ini['couchdb']
+    try:
+        client = CouchDBClient(couchdb_params['server'],
+                               couchdb_params['port'],
+                               couchdb_params['user'],
+                               couchdb_params['password'],
+                               pool_size=couchdb_params.getint('pool_size', POOL_SIZE),
+                               timeout=couchdb_params.getfloat('timeout', TIMEOUT),
+                               retries=couchdb_params.getint('retries', RETRIES),
+                               backoff=couchdb_params.getfloat('backoff', BACKOFF))
+        stats_interval = couchdb_params.getfloat('stats_interval', STATS_INTERVAL)
+    except:
+        logger.error("Invalid CouchDB client parameters")
+        logger.error("Reason: {}".format(sys.exc_info()))
+        return None
+
+    if stats_interval > 0:
+        client.start_stats_reporter(stats_interval)
+
+    logger.info("CouchDB client: '{}'".format(client.url))
+    return client
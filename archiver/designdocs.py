@@ -0,0 +1,197 @@
+# File: designdocs.py
+# Date: 18-10-2026
+# Author: Saruccio Culmone
+#
+# Design documents of the realtime database
+
+"""
+Design documents used to query the realtime database.
+
+Views use only built-in Erlang reducers so no JavaScript is run at reduce
+time. Each design document carries a 'version' number: at startup the
+installed document is replaced only if its version is older than the one
+shipped here.
+
+In partitioned databases the 'sequences' views, always queried by topic, are
+partitioned: a query scans and updates only the shard of the topic. The
+'counters' views are global.
+
+View indexes are built at query time, so after a burst of inserts the first
+query would wait for the whole index update. The ViewWarmer triggers the
+index update in background with 'update=lazy' queries while data are
+ingested, in partitioned databases on the partitions of the topics inserted
+since the previous warm-up.
+"""
+
+import sys
+import time
+import threading
+import time2relax as relax
+from loguru import logger
+import partitions
+
+
+# Design documents version
+DESIGN_VERSION = 2
+
+DESIGN_DOCS = [
+    {
+        '_id': "_design/counters",
+        'version': DESIGN_VERSION,
+        'language': "javascript",
+        'options': {'partitioned': False},
+        'views': {
+            # Number of documents by topic, queried with 'group=true'
+            'topic_list': {
+                'map': "function (doc) {\n"
+                       "  if (doc.topic && (doc.timestamp || doc.bucket)) {\n"
+                       "    emit(doc.topic, null);\n"
+                       "  }\n"
+                       "}",
+                'reduce': "_count"
+            }
+        }
+    },
+    {
+        '_id': "_design/sequences",
+        'version': DESIGN_VERSION,
+        'language': "javascript",
+        'views': {
+            # Readings value by [topic, timestamp]
+            'by_topic_no_reduce': {
+                'map': "function (doc) {\n"
+                       "  if (doc.topic && doc.timestamp) {\n"
+                       "    emit([doc.topic, doc.timestamp], doc.value);\n"
+                       "  }\n"
+                       "}"
+            },
+            # Bucket documents by [topic, bucket start] with readings count
+            'buckets_by_topic': {
+                'map': "function (doc) {\n"
+                       "  if (doc.topic && doc.bucket) {\n"
+                       "    emit([doc.topic, doc.bucket.start], doc.timestamps.length);\n"
+                       "  }\n"
+                       "}"
+            }
+        }
+    }
+]
+
+# Views kept warm after inserts
+WARM_VIEWS = [('counters', 'topic_list'), ('sequences', 'by_topic_no_reduce'),
+              ('sequences', 'buckets_by_topic')]
+
+# Views kept warm in partitioned databases: partitioned views can't be
+# queried globally and their queries update only the shard of the topic,
+# so they are warmed on the partitions of the topics inserted
+WARM_VIEWS_PARTITIONED = [('counters', 'topic_list')]
+WARM_VIEWS_PARTITION = [('sequences', 'by_topic_no_reduce'), ('sequences', 'buckets_by_topic')]
+
+
+def install_design_docs(db: relax.CouchDB):
+    """
+    Installs or upgrades the design documents into the database.
+    Returns True if all documents are up to date, False otherwise.
+    """
+    all_ok = True
+    for ddoc in DESIGN_DOCS:
+        ddoc = dict(ddoc)
+        if db.partitioned and ('options' not in ddoc):
+            ddoc['options'] = {'partitioned': True}
+        try:
+            installed = db.get(ddoc['_id']).json()
+        except relax.ResourceNotFound:
+            installed = None
+        except:
+            logger.error("Failed reading '{}'".format(ddoc['_id']))
+            logger.error("Reason: {}".format(sys.exc_info()))
+            all_ok = False
+            continue
+
+        if installed is not None:
+            installed_version = installed.get('version', 0)
+            if installed_version >= ddoc['version']:
+                logger.info("Design doc '{}' version {} up to date".format(ddoc['_id'],
+                                                                          installed_version))
+                continue
+            ddoc['_rev'] = installed['_rev']
+
+        try:
+            db.insert(ddoc)
+            logger.info("Design doc '{}' version {} installed".format(ddoc['_id'],
+                                                                     ddoc['version']))
+        except relax.ResourceConflict:
+            # Installed at the same time by another process
+            logger.info("Design doc '{}' already updated".format(ddoc['_id']))
+        except:
+            logger.error("Failed installing '{}'".format(ddoc['_id']))
+            logger.error("Reason: {}".format(sys.exc_info()))
+            all_ok = False
+    return all_ok
+
+
+def warm_views(db: relax.CouchDB, topics: set = frozenset()):
+    """
+    Triggers the background update of the view indexes without waiting
+    for it, in partitioned databases on the partitions of 'topics'
+    """
+    params = {'limit': 0, 'update': 'lazy'}
+    views = WARM_VIEWS_PARTITIONED if db.partitioned else WARM_VIEWS
+    for ddoc, view in views:
+        try:
+            db.ddoc_view(ddoc, view, params=params)
+        except:
+            logger.error("Failed warm-up of view '{}/{}'".format(ddoc, view))
+            logger.error("Reason: {}".format(sys.exc_info()))
+    if not db.partitioned:
+        return
+
+    for partition in set(partitions.partition_key(topic) for topic in topics):
+        for ddoc, view in WARM_VIEWS_PARTITION:
+            try:
+                db.partition_view(partition, ddoc, view, params=params)
+            except:
+                logger.error("Failed warm-up of view '{}/{}' of partition '{}'".format(ddoc, view,
+                                                                                   partition))
+                logger.error("Reason: {}".format(sys.exc_info()))
+
+
+class ViewWarmer(threading.Thread):
+    """
+    Warms up the view indexes after a burst of inserts: when 'burst_docs'
+    documents have been inserted or when inserts stop for 'idle' seconds
+    """
+    def __init__(self, db: relax.CouchDB, burst_docs: int, idle: float):
+        super().__init__(name="view-warmer", daemon=True)
+        self.db = db
+        self.burst_docs = burst_docs
+        self.idle = idle
+        self.pending = 0
+        self.last_insert = time.monotonic()
+        # Topics inserted since last warm-up
+        self.topics = set()
+        self.lock = threading.Lock()
+
+    def notify(self, count: int = 1, topic: str = None):
+        """
+        Records inserted documents of a topic
+        """
+        with self.lock:
+            self.pending += count
+            if topic is not None:
+                self.topics.add(topic)
+        self.last_insert = time.monotonic()
+
+    def run(self):
+        while True:
+            time.sleep(1)
+            if self.pending == 0:
+                continue
+            idle = time.monotonic() - self.last_insert
+            if (self.pending >= self.burst_docs) or (idle >= self.idle):
+                with self.lock:
+                    logger.debug("Views warm-up after {} inserts".format(self.pending))
+                    self.pending = 0
+                    topics = self.topics
+                    self.topics = set()
+                warm_views(self.db, topics)
@@ -22,9 +22,19 @@ from dataclasses import dataclass
 import json
 from loguru import logger
 import configuration as config
+import checkpoint
+import dbclient
+import designdocs
+import buckets
+import tracing
+import partitions
+import profiling
+import measures
+import aggregator
 import uncertainties as uncert
 import statistics as stats
 import threading
+import queue
 
 
 # Program name and version
@@ -32,6 +42,13 @@ PROGNAME = "dsarchiver"
 PROGDESCR = "Measurement data archiver"
 VERSION = "0.1.0"
 
+# Seconds a pipeline stage waits on a full or empty queue before checking
+# for stop
+STAGE_POLL = 1
+
+# Default bucket length of archiver (s)
+BUCKET_SECONDS = 60
+
 
 # DataClass definition storing reading from and writing to database
 @dataclass
@@ -41,69 +58,47 @@ class Databases:
     db_devices: relax.CouchDB
 
 
-def connect_db(ini: dict, db_name):
+def connect_db(client: dbclient.CouchDBClient, ini: dict, db_name):
     """
-    Connects to a DB returning its instance or None in error case
+    Returns the instance of a DB on the shared client
     """
-    # Validate mqtt configuration parameters
-    if not config.verify_params(ini, 'couchdb',
-                         ['server', 'port', 'user', 'password',
-                         'realtime_dbname', 'datastore_dbname',
-                         'devices_dbname']):
-        return None
-
-    # CouchDB connection
-    couchdb_params = ini['couchdb']
-    user = couchdb_params['user']
-    passwd = couchdb_params['password']
-    server = couchdb_params['server']
-    port = couchdb_params['port']
-    dbname = couchdb_params[db_name]
-
-    try:
-        couchdburl = "http://{}:{}@{}:{}/{}".format(user,
-                                                    passwd,
-                                                    server,
-                                                    port,
-                                                    dbname)
-        db = relax.CouchDB(couchdburl, create_db=False)
-        logger.debug("CouchDB url: '{}'".format(couchdburl))
-    except:
-        logger.error("Failed CouchDB connection to: '{}'".format(couchdburl))
-        logger.error("Reason: '{}'".format(sys.exc_info()))
-        return None
-
-    logger.info("Connected CouchDB url: '{}'".format(couchdburl))
+    dbname = ini['couchdb'][db_name]
+    db = client.database(dbname)
+    logger.info("Connected CouchDB database: '{}'".format(db))
     return db
 
 
-def couchdb_client(ini: dict):
+def couchdb_client(ini: dict, client: dbclient.CouchDBClient = None):
     """
-    Connects the CouchDB server and returns a tuple of two database object
-    one for reading from and a second to reading to.
+    Connects the CouchDB server and returns the databases to read from and
+    to write to, all sharing the same connection pool (the one of 'client'
+    if given).
     None in error case
     """
-    # Init return struct
-    dbs = Databases(None, None, None)
-
-    # Read from DB connection
-    dbs.db_realtime = connect_db(ini, "realtime_dbname")
-
-    # Write to DB connection
-    dbs.db_datastore = connect_db(ini, "datastore_dbname")
-
-    # Open devices DB
-    dbs.db_devices = connect_db(ini, "devices_dbname")
+    if not config.verify_params(ini, 'couchdb',
+                         ['realtime_dbname', 'datastore_dbname',
+                         'devices_dbname']):
+        return None
 
-    if ((dbs.db_realtime is None) or
-       (dbs.db_datastore is None) or
-       (dbs.db_devices is None)):
+    if client is None:
+        client = dbclient.connect(ini)
+    if client is None:
         logger.error("Incomplete connection to databases")
         return None
 
+    # Read from DB connection, write to DB connection and devices DB
+    dbs = Databases(connect_db(client, ini, "realtime_dbname"),
+                    connect_db(client, ini, "datastore_dbname"),
+                    connect_db(client, ini, "devices_dbname"))
+
     logger.info("Connetcted to dbs: '{}', '{}', '{}'".format(dbs.db_realtime,
                                                              dbs.db_datastore,
                                                              dbs.db_devices))
+    if not dbclient.check_partitioning(dbs.db_realtime, dbs.db_datastore):
+        return None
+
+    # Views queried on realtime database
+    designdocs.install_design_docs(dbs.db_realtime)
     return dbs
 
 
@@ -118,7 +113,9 @@ def get_topic_list(dbs: Databases):
     """
     raw_query = "curl $STUARTDB/_design/counters/_view/topic_list -G -d 'group=true'"
 
-    params = {'group': True}
+    # Index update is not awaited: topics with readings not yet indexed
+    # will be archived at next run
+    params = {'group': True, 'update': 'lazy'}
     try:
         result = dbs.db_realtime.ddoc_view('counters', 'topic_list',
                                        params=params)
@@ -133,21 +130,29 @@ def get_topic_list(dbs: Databases):
 
 
 
-def get_first_doc(dbs: Databases, topic: str):
+def get_first_doc(dbs: Databases, topic: str, view: str = 'by_topic_no_reduce',
+                  after: datetime.datetime = None):
+    """
+    Returns the timestamp of the first document of the topic in a view
+    keyed by [topic, timestamp], at or after 'after' if given, or None if
+    not available
+    """
+    startkey = [topic] if after is None else [topic, after.isoformat()]
     params = {'group': False,
               'reduce': False,
-              'startkey': [topic],
+              'startkey': startkey,
+              'endkey': [topic, {}],
               'limit': 1}
     result = None
     try:
-        result = dbs.db_realtime.ddoc_view('sequences', 'by_topic_no_reduce', params=params)
+        result = partitions.topic_view(dbs.db_realtime, topic, 'sequences', view, params=params)
     except:
         logger.error("Failed query for {} doc".format(topic))
         logger.error("Reason: {}".format(sys.exc_info()))
         return None
 
     data = result.json()
-    logger.debug("data= {}".format(data))
+    logger.debug("data= {}", data)
     rows = []
     try:
         rows = data['rows']
@@ -156,44 +161,30 @@ def get_first_doc(dbs: Databases, topic: str):
         return None
 
     if rows == []:
-        logger.error("Result has no rows")
+        logger.info("No documents for topic '{}' in '{}'".format(topic, view))
         return None
 
     doc = rows[0]
     key = doc['key']
     timestamp = key[1]
-    return datetime.datetime.fromisoformat(timestamp)
+    return measures.local_time(datetime.datetime.fromisoformat(timestamp))
 
 
-def get_measures_slot(dbs: Databases, topic: str, timespan: int):
+def query_slot(dbs: Databases, topic: str, view: str,
+               start_timestamp: datetime.datetime, end_timestamp: datetime.datetime):
     """
-
-    Return
-    ------
-    a list of measures found in the timespan
-    None if upper limit of the time window is reached
+    Returns the rows with documents of a view keyed by [topic, timestamp]
+    in the time slot, end excluded, or None in error case
     """
-    # Fetch first doc inserted
-    start_timestamp = get_first_doc(dbs, topic)
-
-    # End timestamp
-    end_timestamp = start_timestamp + datetime.timedelta(minutes=timespan)
-
-    now = datetime.datetime.now()
-    if end_timestamp >= now:
-        logger.warning("Less than {} min of measures available".format(timespan))
-        logger.debug("end= '{}', now= '{}'".format(end_timestamp, now))
-        return None
-
-    # Query for measures
     params = {'group': False,
               'include_docs': True,
               'reduce': False,
+              'inclusive_end': False,
               'startkey': [topic, start_timestamp.isoformat()],
               'endkey': [topic, end_timestamp.isoformat()]}
     result = None
     try:
-        result = dbs.db_realtime.ddoc_view('sequences', 'by_topic_no_reduce', params=params)
+        result = partitions.topic_view(dbs.db_realtime, topic, 'sequences', view, params=params)
     except:
         logger.error("Failed query for {} doc".format(topic))
         logger.error("Reason: {}".format(sys.exc_info()))
@@ -201,15 +192,64 @@ def get_measures_slot(dbs: Databases, topic: str, timespan: int):
 
     data = result.json()
     #logger.debug("data= {}".format(data))
-    rows = []
     try:
-        rows = data['rows']
+        return data['rows']
     except:
         logger.error("Result has no rows")
         return None
 
-    logger.info("Query returned '{}' rows".format(len(rows)))
-    return rows
+
+def get_measures_slot(dbs: Databases, topic: str, timespan: int,
+                      after: datetime.datetime = None, grace: float = 0):
+    """
+    Readings are stored as single documents or grouped in bucket documents:
+    both are queried and bucket readings are returned as single document
+    rows. Buckets starting in the slot are taken whole.
+    The slot is the wall-clock aligned window of 'timespan' minutes of the
+    first document, at or after 'after' if given, so the slot start and the
+    measure '_id' depend only on the window. A slot is taken 'grace' seconds
+    after its end, when archiver has written all its readings.
+
+    Return
+    ------
+    a tuple (start, rows, docs, end) with the start timestamp of the slot,
+    the list of measures found in the timespan, the list of [_id, _rev] of
+    their documents and the end of the slot
+    None if upper limit of the time window is reached
+    """
+    # Fetch first doc inserted
+    firsts = [get_first_doc(dbs, topic, view, after)
+              for view in ['by_topic_no_reduce', 'buckets_by_topic']]
+    firsts = [first for first in firsts if first is not None]
+    if firsts == []:
+        return None
+    start_timestamp = measures.align_window(min(firsts), timespan)
+
+    # End timestamp
+    end_timestamp = start_timestamp + datetime.timedelta(minutes=timespan)
+
+    now = datetime.datetime.now()
+    if end_timestamp + datetime.timedelta(seconds=grace) >= now:
+        logger.warning("Less than {} min of measures available".format(timespan))
+        logger.debug("end= '{}', now= '{}'", end_timestamp, now)
+        return None
+
+    # Query for measures
+    rows = query_slot(dbs, topic, 'by_topic_no_reduce', start_timestamp, end_timestamp)
+    bucket_rows = query_slot(dbs, topic, 'buckets_by_topic', start_timestamp, end_timestamp)
+    if (rows is None) or (bucket_rows is None):
+        return None
+
+    docs = [[row['id'], row['doc']['_rev']] for row in rows]
+    for row in bucket_rows:
+        rows.extend(buckets.expand_bucket(row['doc']))
+        docs.append([row['id'], row['doc']['_rev']])
+
+    logger.info("Query returned '{}' rows in {} docs".format(len(rows), len(docs)))
+    tracing.event("slot", "Slot {} {}: {} rows in docs {}", topic, start_timestamp, len(rows), docs)
+    if rows == []:
+        return None
+    return (start_timestamp.isoformat(timespec='seconds'), rows, docs, end_timestamp)
 
 
 def get_device(dbs: Databases, device: str):
@@ -227,35 +267,11 @@ def get_device(dbs: Databases, device: str):
     return dev_data
 
 
-def accuracy(device: dict, value_type: str, reading: float):
+def process_series(dbs: Databases, topic: str, slot_start: str, data: list):
     """
-    Returns the accuracy of the reading depending on device type accuracy
-    ranges
-    """
-    if device is None:
-        return 0.0
-
-    # Get accuracy ranges
-    try:
-        accuracies = device[value_type]['accuracy']
-    except:
-        logger.error("Device has no accuracy data for '{}' values".format(value_type))
-        return 0.0
-
-    accuracy_value = 0.0
-    for accuracy in accuracies:
-        range_inf = accuracy['range_inf']
-        range_sup = accuracy['range_sup']
-        if (reading >= range_inf) and (reading < range_sup):
-            accuracy_value = accuracy['value']
-            break
-    return accuracy_value
-
-
-
-def process_series(dbs: Databases, topic: str, data: list):
-    """
-    Process document series and returns documento to be stored
+    Process document series and returns documento to be stored.
+    The '_id' of the document depends only on topic and slot start so that
+    processing again the same slot always produces the same document.
     """
     # Devices
     devices = dict()
@@ -311,26 +327,26 @@ def process_series(dbs: Databases, topic: str, data: list):
     first_timestamp = min(timestamps)
     last_timestamp = max(timestamps)
 
-    logger.debug("Slot boundaries: {} -- {}".format(first_timestamp, last_timestamp))
-    logger.debug("Min value= {} at {}".format(min_value, min_timestamp))
-    logger.debug("Max value= {} at {}".format(max_value, max_timestamp))
+    logger.debug("Slot boundaries: {} -- {}", first_timestamp, last_timestamp)
+    logger.debug("Min value= {} at {}", min_value, min_timestamp)
+    logger.debug("Max value= {} at {}", max_value, max_timestamp)
 
     # Calculate mean value and standard deviation using device accuracy
     values = [dval[0] for dval in data_values]
     #logger.debug("Values= {}".format(values))
     mean_value = stats.mean(values)
-    stddev_value = stats.stdev(values)
-    logger.debug("Mean value= {}+/-{}".format(mean_value, stddev_value))
+    stddev_value = stats.stdev(values) if len(values) > 1 else 0.0
+    logger.debug("Mean value= {}+/-{}", mean_value, stddev_value)
 
     # Calculate mean value using device accuracy
     uvalues = []
     for value, device in data_values:
         dev = devices[device]
-        acc = accuracy(dev, measure_type, value)
+        acc = measures.accuracy(dev, measure_type, value)
         uvalues.append(uncert.ufloat(value, acc))
 
     uaverage = sum(uvalues)/len(uvalues)
-    logger.debug("Mean value with accuracy: {}".format(uaverage))
+    logger.debug("Mean value with accuracy: {}", uaverage)
 
     # Compose measure json struct ready to be inserted
     meas = dict()
@@ -345,66 +361,428 @@ def process_series(dbs: Databases, topic: str, data: list):
     meas['timestamp'] = measure_timestamp
     meas['value'] = uaverage.nominal_value
     meas['accuracy'] = uaverage.std_dev
+    meas['stddev'] = stddev_value
+    meas['count'] = len(values)
     meas['min_value'] = {'value': min_value, 'timestamp': min_timestamp}
     meas['max_value'] = {'value': max_value, 'timestamp': max_timestamp}
     meas['time_slot'] = {'start': first_timestamp, 'end': last_timestamp}
 
-    # Add '_id' composed as '<topic>@<timestamp>'
-    meas['_id'] = topic + "@" + measure_timestamp
-    logger.debug("Calculated measure: {}".format(meas))
+    # Add '_id' composed as '<topic>@<slot start>' ('<topic>:<slot start>'
+    # in partitioned databases)
+    meas['_id'] = partitions.doc_id(topic, slot_start, dbs.db_datastore.partitioned)
+    logger.debug("Calculated measure: {}", meas)
+    tracing.event("measure", "Calculated measure: {}", meas)
     return meas
 
 
 
-def archive_series(dbs: Databases, topic: str, timespan: int):
+def store_measure(dbs: Databases, meas: dict, late: bool = False):
     """
+    Inserts the measure into the datastore and waits for its confirmation.
+    A measure already present with the same '_id' is:
+    - merged with the new one if 'late', the slot being already committed
+      and its readings deleted: only readings arrived later are in 'meas'
+    - overwritten otherwise (previous run interrupted before completing the
+      slot), the new calculation including the same readings
+
+    Return
+    ------
+    True if the measure is stored
+    False otherwise
     """
-    rows = get_measures_slot(dbs, topic, timespan)
-    #logger.debug(rows)
-    if rows is None:
-        logger.warning("No data to move")
+    try:
+        dbs.db_datastore.insert(meas)
+        return True
+    except relax.ResourceConflict:
+        logger.warning("Measure '{}' already present".format(meas['_id']))
+    except:
+        logger.error("Failed inserting measure: '{}'".format(meas))
+        logger.error("Reason: {}".format(sys.exc_info()))
         return False
 
-    # Calculate value
-    calc_meas = process_series(dbs, topic, rows)
-    logger.info("Moving {} timeslot {}".format(calc_meas['_id'], calc_meas['time_slot']))
+    if late:
+        return merge_measure(dbs, meas)
 
-    # Insert value into the DB
     try:
-        dbs.db_datastore.insert(calc_meas)
+        stored = dbs.db_datastore.get(meas['_id']).json()
+        meas['_rev'] = stored.pop('_rev')
+        if stored == {k: v for k, v in meas.items() if k != '_rev'}:
+            logger.info("Measure '{}' unchanged".format(meas['_id']))
+            return True
+        dbs.db_datastore.insert(meas)
     except:
-        logger.error("Failed inserting measure: '{}'".format(calc_meas))
+        logger.error("Failed updating measure: '{}'".format(meas))
         logger.error("Reason: {}".format(sys.exc_info()))
-    logger.debug("Inserted measure: '{}'".format(calc_meas))
+        return False
+    return True
 
-    # Delete measures fron reltime database
-    for row in rows:
-        id = row['id']
-        result = dbs.db_realtime.get(id).json()
-        dbs.db_realtime.remove(result['_id'], result['_rev'])
+
+def merge_measure(dbs: Databases, meas: dict):
+    """
+    Merges the measure of late readings of a committed slot into the stored
+    one. A stored measure without readings count is kept as it is.
+    Returns True if the stored measure is updated or kept.
+    """
+    try:
+        stored = dbs.db_datastore.get(meas['_id']).json()
+        merged = aggregator.merged_measure(meas, stored)
+        if merged is None:
+            logger.error("Measure '{}' can't be merged, kept: {} late readings discarded".format(
+                         meas['_id'], meas['count']))
+            return True
+        logger.warning("Merging {} late readings into measure '{}'".format(meas['count'],
+                                                                          meas['_id']))
+        dbs.db_datastore.insert(merged)
+    except:
+        logger.error("Failed merging measure: '{}'".format(meas))
+        logger.error("Reason: {}".format(sys.exc_info()))
+        return False
     return True
 
 
+def delete_measures(dbs: Databases, docs: list):
+    """
+    Deletes with a single bulk request the list of '[_id, _rev]' documents
+    from the realtime database. Documents already deleted are ignored.
+
+    Return
+    ------
+    True if all documents are deleted
+    False otherwise
+    """
+    deleted = [{'_id': id, '_rev': rev, '_deleted': True} for id, rev in docs]
+    try:
+        results = dbs.db_realtime.bulk_docs(deleted).json()
+    except:
+        logger.error("Failed deleting {} measures".format(len(deleted)))
+        logger.error("Reason: {}".format(sys.exc_info()))
+        return False
+
+    failed = [res for res in results
+              if res.get('error') not in (None, 'not_found')]
+    if failed != []:
+        logger.error("Failed deleting {} measures: {}".format(len(failed), failed[:5]))
+        return False
+    return True
+
+
+def aggregated_slot(dbs: Databases, topic: str, slot_start: str, timespan: int,
+                    ckpt: checkpoint.Checkpoint):
+    """
+    Returns True if the measure of a slot of a topic aggregated by archiver
+    has been written: the readings of the slot are only deleted.
+    Late readings of a committed slot, dropped by the aggregator, are merged
+    into its measure instead.
+    """
+    committed = ckpt.committed_slot(timespan)
+    if (committed is not None) and (slot_start <= committed):
+        return False
+    meas_id = partitions.doc_id(topic, slot_start, dbs.db_datastore.partitioned)
+    try:
+        dbs.db_datastore.get(meas_id)
+        return True
+    except relax.ResourceNotFound:
+        logger.warning("Measure '{}' not written by archiver, calculated".format(meas_id))
+    except:
+        logger.error("Failed reading measure '{}'".format(meas_id))
+        logger.error("Reason: {}".format(sys.exc_info()))
+    return False
+
+
+def slot_measure(dbs: Databases, topic: str, slot_start: str, rows: list, timespan: int,
+                 ckpt: checkpoint.Checkpoint, aggregated: bool):
+    """
+    Returns the measure of a slot, None if it has been written by the
+    archiver aggregator
+    """
+    if aggregated and aggregated_slot(dbs, topic, slot_start, timespan, ckpt):
+        return None
+    return process_series(dbs, topic, slot_start, rows)
+
+
+def archive_series(dbs: Databases, topic: str, timespan: int,
+                   ckpt: checkpoint.Checkpoint, grace: float = 0,
+                   aggregated: bool = False):
+    """
+    Moves a timeslot of a topic from the realtime to the datastore database.
+    Raw readings are deleted only after the aggregate has been stored and
+    the checkpoint updated, so a restart resumes the interrupted slot.
+    Slots of topics 'aggregated' by archiver are only deleted once their
+    measure has been written.
+    """
+    # Complete the deletion of a slot already stored
+    if ckpt.state == checkpoint.STATE_INSERTED:
+        logger.info("Resuming deletion of slot {}".format(ckpt.doc.get('time_slot')))
+        if not delete_measures(dbs, ckpt.doc['docs']):
+            return False
+        return ckpt.save(state=checkpoint.STATE_COMMITTED, docs=[])
+
+    with profiling.span("query"):
+        slot = get_measures_slot(dbs, topic, timespan, grace=grace)
+    if slot is None:
+        logger.warning("No data to move")
+        return False
+    slot_start, rows, docs, slot_end = slot
+
+    # Calculate value
+    with profiling.span("aggregate"):
+        calc_meas = slot_measure(dbs, topic, slot_start, rows, timespan, ckpt, aggregated)
+    return commit_slot(dbs, slot_start, calc_meas, docs, timespan, ckpt)
+
+
+def commit_slot(dbs: Databases, slot_start: str, calc_meas: dict, docs: list,
+                timespan: int, ckpt: checkpoint.Checkpoint):
+    """
+    Stores the measure of a slot and deletes its raw readings, only deletes
+    them if the measure is None (written by the archiver aggregator).
+    A slot at or before the last committed one of the checkpoint holds
+    readings arrived after it was archived: they are merged into its
+    measure.
+    """
+    committed = ckpt.committed_slot(timespan)
+    late = (committed is not None) and (slot_start <= committed)
+
+    if calc_meas is not None:
+        logger.info("Moving {} timeslot {}".format(calc_meas['_id'], calc_meas['time_slot']))
+        # Insert value into the DB
+        with profiling.span("insert"):
+            stored = store_measure(dbs, calc_meas, late)
+        if not stored:
+            return False
+        logger.debug("Inserted measure: '{}'", calc_meas)
+        meas_id = calc_meas['_id']
+        time_slot = calc_meas['time_slot']
+    else:
+        meas_id = partitions.doc_id(ckpt.topic, slot_start, dbs.db_datastore.partitioned)
+        time_slot = {'start': slot_start}
+        logger.info("Deleting readings of {}, measure written by archiver".format(meas_id))
+
+    # Record the slot before deleting its raw readings
+    if not ckpt.save(state=checkpoint.STATE_INSERTED,
+                     window=timespan,
+                     slot_start=slot_start if not late else committed,
+                     time_slot=time_slot,
+                     measure_id=meas_id,
+                     docs=docs):
+        return False
+
+    # Delete measures fron reltime database
+    with profiling.span("delete"):
+        deleted = delete_measures(dbs, docs)
+    if not deleted:
+        return False
+    return ckpt.save(state=checkpoint.STATE_COMMITTED, docs=[])
+
+
 class TopicThread(threading.Thread):
-    def __init__(self, topic: str, timespan: int, dbs: Databases):
+    """
+    Archives the slots of a topic.
+
+    In pipelined mode three stages run concurrently on consecutive slots,
+    handing them over through bounded queues:
+    - fetch: queries slot k+1, starting from the end of slot k
+    - aggregate: processes slot k
+    - write: stores slot k-1, updates its checkpoint and deletes its raw
+      readings, in slot order
+    Slots are written in the same order as without pipeline and raw
+    readings are still deleted only after their measure has been stored.
+    """
+    def __init__(self, topic: str, timespan: int, dbs: Databases,
+                 pipeline_size: int = 0, grace: float = 0, aggregated: bool = False):
         super().__init__(name=topic)
         self.topic = topic
         self.dbs = dbs
         self.timespan = timespan
+        self.pipeline_size = pipeline_size
+        self.grace = grace
+        self.aggregated = aggregated
         self.stop_process = False
+        self.checkpoint = checkpoint.Checkpoint(dbs.db_datastore, topic)
 
     def stop(self):
         self.stop_process = True
 
+    def put(self, stage_queue: queue.Queue, item):
+        """
+        Hands over an item to the next stage. Returns False if stopped.
+        """
+        while not self.stop_process:
+            try:
+                stage_queue.put(item, timeout=STAGE_POLL)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def get(self, stage_queue: queue.Queue):
+        """
+        Returns the next item of the previous stage, None at the end or if
+        stopped
+        """
+        while not self.stop_process:
+            try:
+                return stage_queue.get(timeout=STAGE_POLL)
+            except queue.Empty:
+                continue
+        return None
+
+    def fetch_stage(self, fetched: queue.Queue):
+        after = None
+        while not self.stop_process:
+            profiling.poll()
+            with profiling.span("query"):
+                slot = get_measures_slot(self.dbs, self.topic, self.timespan, after,
+                                         self.grace)
+            if slot is None:
+                break
+            if not self.put(fetched, slot):
+                break
+            after = slot[3]
+        self.put(fetched, None)
+        profiling.release()
+
+    def aggregate_stage(self, fetched: queue.Queue, aggregated: queue.Queue):
+        while not self.stop_process:
+            profiling.poll()
+            slot = self.get(fetched)
+            if slot is None:
+                break
+            slot_start, rows, docs, slot_end = slot
+            with profiling.span("aggregate"):
+                calc_meas = slot_measure(self.dbs, self.topic, slot_start, rows, self.timespan,
+                                         self.checkpoint, self.aggregated)
+            if not self.put(aggregated, (slot_start, calc_meas, docs)):
+                break
+        self.put(aggregated, None)
+        profiling.release()
+
+    def run_pipelined(self):
+        fetched = queue.Queue(maxsize=self.pipeline_size)
+        aggregated = queue.Queue(maxsize=self.pipeline_size)
+        stages = [threading.Thread(target=self.fetch_stage, args=(fetched,),
+                                   name=self.topic + "-fetch"),
+                  threading.Thread(target=self.aggregate_stage, args=(fetched, aggregated),
+                                   name=self.topic + "-aggregate")]
+        for stage in stages:
+            stage.start()
+
+        while not self.stop_process:
+            profiling.poll()
+            item = self.get(aggregated)
+            if item is None:
+                break
+            slot_start, calc_meas, docs = item
+            if not commit_slot(self.dbs, slot_start, calc_meas, docs, self.timespan,
+                               self.checkpoint):
+                # Later slots can't be written before this one
+                logger.error("Pipeline of '{}' stopped".format(self.topic))
+                break
+
+        self.stop_process = True
+        for stage in stages:
+            stage.join()
+
     def run(self):
+        # Resume from last committed slot
+        self.checkpoint.load(self.timespan)
+
+        if self.pipeline_size > 0:
+            # Complete the slot interrupted before starting the pipeline
+            if self.checkpoint.state == checkpoint.STATE_INSERTED:
+                archive_series(self.dbs, self.topic, self.timespan, self.checkpoint,
+                               self.grace, self.aggregated)
+            if self.checkpoint.state != checkpoint.STATE_INSERTED:
+                self.run_pipelined()
+            profiling.release()
+            return
+
         # Archives topic's dataset 5 minutes at time
         data_available = True
         while data_available and (not self.stop_process):
+            profiling.poll()
             # Read from queue in order to stop gracefully
-            data_available = archive_series(self.dbs, self.topic, self.timespan)
+            data_available = archive_series(self.dbs, self.topic, self.timespan,
+                                            self.checkpoint, self.grace, self.aggregated)
+        profiling.release()
+
 
 
 
+def archive(ini: dict, dbs: Databases, iot_topics: dict, stop: threading.Event = None):
+    """
+    Archives the readings of all topics available in the realtime database
+    returning when all topic threads have exited. When 'stop' is set topic
+    threads are stopped after the slot they are writing.
+    Returns False if the default window is not valid.
+    """
+    # Default window, aligned slots need a divisor of the day
+    window = measures.default_window(ini, 'archive')
+    if window is None:
+        return False
+
+    # Pipelined archiving of each topic
+    pipeline_size = 0
+    if 'archive' in ini:
+        if ini['archive'].get('pipeline', 'no') == 'yes':
+            pipeline_size = ini['archive'].getint('pipeline_size', 2)
+            logger.info("Pipelined archiving, {} slots queued between stages".format(pipeline_size))
+
+    # Slots are archived after archiver has written their last bucket and
+    # its queued readings
+    min_grace = buckets.BUCKET_GRACE
+    if 'couchdb' in ini:
+        min_grace += ini['couchdb'].getint('bucket_seconds', BUCKET_SECONDS)
+    grace = min_grace
+    if 'archive' in ini:
+        grace = ini['archive'].getfloat('grace', min_grace)
+    if grace < min_grace:
+        logger.warning("Slot grace {} s raised to {} s".format(grace, min_grace))
+        grace = min_grace
+
+    # Get the list of topic availables
+    topics = get_topic_list(dbs)
+    logger.info("Available topics: '{}'".format(topics))
+
+    # Measures of topics stored both raw and aggregated are written by
+    # archiver at ingest time under the same ids, if its [aggregate] section
+    # is set: their readings are only deleted
+    both = [topic for topic in topics
+            if aggregator.store_mode(config.topic_metadata(iot_topics, topic)) == aggregator.STORE_BOTH]
+    if both != []:
+        if ini.has_section('aggregate'):
+            logger.info("Topics aggregated by archiver, readings deleted: {}".format(both))
+        else:
+            logger.warning("No [aggregate] section, topics stored both archived: {}".format(both))
+            both = []
+
+    # Thread dictionary
+    threads = dict()
+
+    # Create a thread for each topic
+    for topic in topics:
+        timespan = measures.topic_window(iot_topics, topic, window)
+        threads[topic] = TopicThread(topic, timespan, dbs, pipeline_size, grace,
+                                     topic in both)
+        threads[topic].start()
+        logger.info("Thread '{}' started, {} min windows".format(threads[topic].name, timespan))
+
+    # Thread monitoring
+    still_running = True
+    while still_running:
+        if (stop is not None) and stop.is_set():
+            for thr in threads:
+                threads[thr].stop()
+        thr_counter = 0
+        for thr in threads:
+            if threads[thr].is_alive():
+                thr_counter += 1
+            else:
+                logger.info("Thread '{}' exited".format(threads[thr].name))
+        if thr_counter == 0:
+            still_running = False
+        time.sleep(1)
+    return True
+
 
 @logger.catch
 def main():
@@ -415,6 +793,9 @@ def main():
     parser = argparse.ArgumentParser(description = PROGDESCR, prog = PROGNAME)
     parser.add_argument('-v', '--version', help='Print version and exit.',
                         action = 'version', version = VERSION)
+    parser.add_argument('-p', '--profile', metavar='SECONDS',
+                        help='Profile the first SECONDS of execution (SIGUSR2 toggles profiling).',
+                        type = float, default = 0)
 
     args = parser.parse_args()
     logger.debug("CLI arguments: '{}'".format(args))
@@ -423,15 +804,17 @@ def main():
     if ini is None:
         return
 
-    # Configure logging on file
+    # Configure logging on file and tracing
     config.config_logging(ini, PROGNAME)
+    tracing.configure(ini, PROGNAME)
+    profiling.configure(ini, PROGNAME, args.profile)
     logger.info("---------------------------------------------------------")
     logger.info("| '{}'  START                   ".format(PROGNAME))
     logger.info("---------------------------------------------------------")
 
     # Load IoT configuration
-    topics = config.load_iot_config(ini)
-    if topics == {}:
+    iot_topics = config.load_iot_config(ini)
+    if iot_topics == {}:
         logger.error("No topics to subscribe")
         return
 
@@ -441,32 +824,10 @@ def main():
         logger.error("No DB available")
         return
 
-    # Get the list of topic availables
-    topics = get_topic_list(dbs)
-    logger.info("Available topics: '{}'".format(topics))
-
-    # Thread dictionary
-    threads = dict()
-
-    # Create a thread for each topic
-    for topic in topics:
-        threads[topic] = TopicThread(topic, 10, dbs)
-        threads[topic].start()
-        logger.info("Thread '{}' started".format(threads[topic].name))
-
-    # Thread monitoring
-    still_running = True
-    while still_running:
-        thr_counter = 0
-        for thr in threads:
-            if threads[thr].is_alive():
-                thr_counter += 1
-            else:
-                logger.info("Thread '{}' exited".format(threads[thr].name))
-        if thr_counter == 0:
-            still_running = False
-        time.sleep(1)
+    if not archive(ini, dbs, iot_topics):
+        logger.error("Archiving not started")
 
+    profiling.shutdown()
     logger.info("{} exited".format(PROGNAME))
 
 
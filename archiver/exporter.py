@@ -0,0 +1,411 @@
+# File: exporter.py
+# Date: 18-10-2026
+# Author: Saruccio Culmone
+#
+# Streaming export of datastore and realtime data
+
+"""
+Exports the documents of a topic in a time range, one output file per
+topic, from the datastore (aggregated measures) or from the realtime
+database (readings, bucket documents expanded).
+
+Documents are read in pages of '_all_docs' over the id range
+'<topic>@<start>' .. '<topic>@<end>': each page starts from the id of the
+first document not returned by the previous one, so no 'skip' is used and
+every page costs the same. An end date without time includes the whole
+day. In the realtime database the range starts at the bucket holding
+'start' ('--bucket-seconds', default 'bucket_seconds' of [couchdb]) and
+readings out of the range are dropped. Rows are written as they arrive:
+
+- csv: one line per document with a header
+- jsonl: one JSON object per line
+- npy: NumPy structured array (timestamps as datetime64[s], numbers as
+  float64, NaN if missing); the header is rewritten at the end with the
+  array length. 'numpy' is needed only for this format
+
+Several topics are exported concurrently. With '--gzip' compression runs
+in a separate thread fed by a bounded queue, so it doesn't stall fetching.
+
+Server and database names are read from the dsarchiver INI file.
+"""
+
+import os
+import sys
+import csv
+import io
+import gzip
+import json
+import queue
+import argparse
+import datetime
+import threading
+import concurrent.futures
+from loguru import logger
+import configuration as config
+import dbclient
+import buckets
+import partitions
+
+
+# Program name and version
+PROGNAME = "exporter"
+PROGDESCR = "Export of IoT measures and readings"
+VERSION = "0.1.0"
+
+# Default documents per page
+PAGE_SIZE = 1000
+
+# Default topics exported concurrently
+JOBS = 4
+
+# Bytes buffered before a write to the output
+CHUNK_SIZE = 64 * 1024
+
+# Chunks queued to the compression thread
+GZIP_QUEUE = 16
+
+# Exported fields of each database: (name, path into the document, npy type)
+FIELDS = {
+    'datastore': [('topic', ['topic'], None),
+                  ('timestamp', ['timestamp'], 'datetime64[s]'),
+                  ('value', ['value'], 'f8'),
+                  ('accuracy', ['accuracy'], 'f8'),
+                  ('min_value', ['min_value', 'value'], 'f8'),
+                  ('min_timestamp', ['min_value', 'timestamp'], 'datetime64[s]'),
+                  ('max_value', ['max_value', 'value'], 'f8'),
+                  ('max_timestamp', ['max_value', 'timestamp'], 'datetime64[s]'),
+                  ('slot_start', ['time_slot', 'start'], 'datetime64[s]'),
+                  ('slot_end', ['time_slot', 'end'], 'datetime64[s]'),
+                  ('measure_type', ['measure_type'], None)],
+    'realtime': [('topic', ['topic'], None),
+                 ('timestamp', ['timestamp'], 'datetime64[s]'),
+                 ('value', ['value'], 'f8'),
+                 ('dev', ['dev'], None),
+                 ('type', ['type'], None)]
+}
+
+# Highest id character in CouchDB collation
+ID_MAX = "\ufff0"
+
+# Default seconds of realtime bucket documents
+BUCKET_SECONDS = 60
+
+
+def field_value(doc: dict, path: list):
+    value = doc
+    for key in path:
+        if not isinstance(value, dict):
+            return None
+        value = value.get(key)
+    return value
+
+
+def bucket_start(start: str, seconds: int):
+    """
+    Returns the start of the bucket holding the 'start' timestamp, 'start'
+    if it is empty or not in ISO format
+    """
+    if (start == "") or (seconds <= 0):
+        return start
+    try:
+        epoch = datetime.datetime.fromisoformat(start).timestamp()
+    except ValueError:
+        return start
+    return datetime.datetime.fromtimestamp(epoch - (epoch % seconds)).isoformat(timespec='seconds')
+
+
+def range_end(end: str):
+    """
+    Returns the end of the exported range, an end date without time
+    includes the whole day
+    """
+    try:
+        datetime.date.fromisoformat(end)
+    except ValueError:
+        return end
+    return end + ID_MAX
+
+
+def fetch_docs(db, topic: str, start: str, end: str, page_size: int):
+    """
+    Yields the documents of a topic with id key in [start, end] paging by
+    key
+    """
+    partitioned = db.partitioned
+    startkey = partitions.doc_id(topic, start, partitioned)
+    endkey = partitions.doc_id(topic, end, partitioned)
+    while True:
+        # One more row than the page gives the start of the next page
+        params = {'include_docs': True, 'limit': page_size + 1,
+                  'startkey': startkey, 'endkey': endkey}
+        rows = db.all_docs(params=params).json()['rows']
+        for row in rows[:page_size]:
+            if row.get('doc') is not None:
+                yield row['doc']
+        if len(rows) <= page_size:
+            return
+        startkey = rows[-1]['id']
+
+
+def readings(docs, start: str, end: str):
+    """
+    Yields the readings in [start, end] of realtime documents expanding
+    buckets, which may start before the range
+    """
+    for doc in docs:
+        if 'bucket' not in doc:
+            if start <= doc.get('timestamp', "") <= end:
+                yield doc
+            continue
+        for row in buckets.expand_bucket(doc):
+            reading = row['doc']
+            if start <= reading['timestamp'] <= end:
+                reading['topic'] = doc['topic']
+                yield reading
+
+
+class GzipOutput(threading.Thread):
+    """
+    Binary output compressed by a separate thread
+    """
+    def __init__(self, filepath: str):
+        super().__init__(name="gzip-" + os.path.basename(filepath), daemon=True)
+        self.fd = gzip.open(filepath, "wb")
+        self.chunks = queue.Queue(maxsize=GZIP_QUEUE)
+        self.error = None
+        self.start()
+
+    def write(self, data: bytes):
+        if self.error is not None:
+            raise IOError("Compression failed: {}".format(self.error))
+        self.chunks.put(data)
+
+    def run(self):
+        while True:
+            data = self.chunks.get()
+            if data is None:
+                break
+            if self.error is not None:
+                continue
+            try:
+                self.fd.write(data)
+            except:
+                self.error = sys.exc_info()[1]
+        self.fd.close()
+
+    def close(self):
+        self.chunks.put(None)
+        self.join()
+        if self.error is not None:
+            raise IOError("Compression failed: {}".format(self.error))
+
+
+class Output:
+    """
+    Buffered binary output, plain or compressed
+    """
+    def __init__(self, filepath: str, compress: bool):
+        self.fd = GzipOutput(filepath) if compress else open(filepath, "wb")
+        self.buffer = io.BytesIO()
+
+    def write(self, data: bytes):
+        self.buffer.write(data)
+        if self.buffer.tell() >= CHUNK_SIZE:
+            self.flush()
+
+    def flush(self):
+        self.fd.write(self.buffer.getvalue())
+        self.buffer = io.BytesIO()
+
+    def close(self):
+        self.flush()
+        self.fd.close()
+
+
+class CsvWriter:
+    def __init__(self, output: Output, fields: list):
+        self.output = output
+        self.names = [name for name, path, npy_type in fields]
+        self.text = io.StringIO()
+        self.writer = csv.writer(self.text)
+        self.write(self.names)
+
+    def write(self, values: list):
+        self.writer.writerow(["" if value is None else value for value in values])
+        self.output.write(self.text.getvalue().encode())
+        self.text.seek(0)
+        self.text.truncate()
+
+    def close(self):
+        self.output.close()
+
+
+class JsonlWriter:
+    def __init__(self, output: Output, fields: list):
+        self.output = output
+        self.names = [name for name, path, npy_type in fields]
+
+    def write(self, values: list):
+        self.output.write((json.dumps(dict(zip(self.names, values))) + "\n").encode())
+
+    def close(self):
+        self.output.close()
+
+
+class NpyWriter:
+    """
+    Streams records of a structured array, string fields excluded
+    """
+    def __init__(self, filepath: str, fields: list):
+        import numpy
+        self.numpy = numpy
+        self.columns = [index for index, (name, path, npy_type) in enumerate(fields)
+                        if npy_type is not None]
+        self.dtype = numpy.dtype([(fields[index][0], fields[index][2])
+                                  for index in self.columns])
+        self.fd = open(filepath, "wb")
+        # Header room for the longest array length, aligned to 64 bytes
+        self.count = sys.maxsize
+        self.header_len = -(-len(self.header()) // 64) * 64
+        self.count = 0
+        self.write_header()
+        self.record = numpy.zeros(1, dtype=self.dtype)
+
+    def header(self):
+        """
+        Returns the npy 1.0 header, magic string and length included,
+        without padding
+        """
+        header = "{{'descr': {!r}, 'fortran_order': False, 'shape': ({},), }}".format(
+                 self.numpy.lib.format.dtype_to_descr(self.dtype), self.count)
+        return b"\x93NUMPY\x01\x00" + b"\x00\x00" + header.encode("latin1") + b"\n"
+
+    def write_header(self):
+        header = self.header()
+        padding = b" " * (self.header_len - len(header))
+        length = (self.header_len - 10).to_bytes(2, "little")
+        self.fd.write(header[:8] + length + header[10:-1] + padding + b"\n")
+
+    def write(self, values: list):
+        for column, name in zip(self.columns, self.dtype.names):
+            value = values[column]
+            if self.dtype[name].kind == 'M':
+                try:
+                    self.record[name] = value if value is not None else "NaT"
+                except ValueError:
+                    self.record[name] = "NaT"
+            else:
+                try:
+                    self.record[name] = float(value)
+                except (TypeError, ValueError):
+                    self.record[name] = self.numpy.nan
+        self.fd.write(self.record.tobytes())
+        self.count += 1
+
+    def close(self):
+        self.fd.seek(0)
+        self.write_header()
+        self.fd.close()
+
+
+def create_writer(filepath: str, fmt: str, fields: list, compress: bool):
+    if fmt == 'npy':
+        return NpyWriter(filepath, fields)
+    output = Output(filepath, compress)
+    if fmt == 'csv':
+        return CsvWriter(output, fields)
+    return JsonlWriter(output, fields)
+
+
+def export_topic(db, dbkind: str, topic: str, args):
+    """
+    Exports a topic into its file.
+    Returns the number of exported rows.
+    """
+    ext = args.format + (".gz" if args.gzip else "")
+    filepath = os.path.join(args.outdir, "{}.{}".format(topic.replace("/", "_"), ext))
+    fields = FIELDS[dbkind]
+    start = args.start or ""
+    end = range_end(args.end or ID_MAX)
+
+    writer = create_writer(filepath, args.format, fields, args.gzip)
+    count = 0
+    try:
+        if dbkind == 'realtime':
+            # Buckets starting before 'start' or at 'end' are fetched too
+            docs = fetch_docs(db, topic, bucket_start(start, args.bucket_seconds),
+                              end + buckets.BUCKET_SUFFIX, args.page)
+            docs = readings(docs, start, end)
+        else:
+            docs = fetch_docs(db, topic, start, end, args.page)
+        for doc in docs:
+            writer.write([field_value(doc, path) for name, path, npy_type in fields])
+            count += 1
+    finally:
+        writer.close()
+    logger.info("Topic '{}': {} rows exported on '{}'".format(topic, count, filepath))
+    return count
+
+
+@logger.catch
+def main():
+    """
+    Export entry point
+    """
+    parser = argparse.ArgumentParser(description = PROGDESCR, prog = PROGNAME)
+    parser.add_argument('-v', '--version', help='Print version and exit.',
+                        action = 'version', version = VERSION)
+    parser.add_argument('topics', nargs='+', help='Topics to export.')
+    parser.add_argument('-D', '--db', choices=['datastore', 'realtime'], default = 'datastore',
+                        help='Database to export.')
+    parser.add_argument('-s', '--start', help='Start timestamp (ISO format).')
+    parser.add_argument('-e', '--end', help='End timestamp (ISO format), a date includes the whole day.')
+    parser.add_argument('-f', '--format', choices=['csv', 'jsonl', 'npy'], default = 'csv',
+                        help='Output format.')
+    parser.add_argument('-z', '--gzip', help='Compress output files.', action = 'store_true')
+    parser.add_argument('-o', '--outdir', help='Output directory.', default = ".")
+    parser.add_argument('-b', '--page', help='Documents per request.',
+                        type = int, default = PAGE_SIZE)
+    parser.add_argument('-j', '--jobs', help='Topics exported concurrently.',
+                        type = int, default = JOBS)
+    parser.add_argument('-c', '--config', help='Program whose INI file is read.',
+                        default = 'dsarchiver')
+    parser.add_argument('--bucket-seconds', help='Longest realtime bucket (default [couchdb] bucket_seconds).',
+                        type = int)
+
+    args = parser.parse_args()
+    logger.debug("CLI arguments: '{}'".format(args))
+    if (args.format == 'npy') and args.gzip:
+        logger.error("npy output can't be compressed")
+        return 1
+
+    ini = config.load_config(args.config)
+    if ini is None:
+        return 1
+    db_param = args.db + "_dbname"
+    if not config.verify_params(ini, 'couchdb', [db_param]):
+        return 1
+    if args.bucket_seconds is None:
+        args.bucket_seconds = ini['couchdb'].getint('bucket_seconds', BUCKET_SECONDS)
+
+    client = dbclient.connect(ini)
+    if client is None:
+        return 1
+    db = client.database(ini['couchdb'][db_param])
+
+    failed = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        futures = {executor.submit(export_topic, db, args.db, topic, args): topic
+                   for topic in args.topics}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                future.result()
+            except:
+                logger.error("Export of topic '{}' failed".format(futures[future]))
+                logger.error("Reason: {}".format(sys.exc_info()))
+                failed += 1
+    return 0 if failed == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,328 @@
+# File: importer.py
+# Date: 18-10-2026
+# Author: Saruccio Culmone
+#
+# Bulk import of historical readings into the realtime database
+
+"""
+Imports readings from files into the archiver database, as if they were
+received on MQTT.
+
+Supported formats:
+- csv: a header line with a 'topic' column, the other columns are the
+  reading keys ('value' is converted to number when possible)
+- jsonl: one JSON object per line, either a reading with its 'topic' key or
+  a spooled raw message {"topic": ..., "payload": <object or JSON string>}
+
+Readings get the same timestamp, '_id' and topic normalization of archiver
+and readings of topics not in the IoT configuration are skipped, as
+archiver does. Files are read line by line and written by a pool of
+'_bulk_docs' requests in flight, so memory use doesn't depend on file size.
+
+The byte offset of the last line whose batch, and all the previous ones,
+has been written is saved every CHECKPOINT_INTERVAL seconds in a '_local'
+document of the database: an interrupted import resumes from there.
+Readings written again after the checkpoint are reported as conflicts and
+skipped.
+
+Server, database and IoT configuration are read from archiver INI file.
+"""
+
+import os
+import sys
+import csv
+import json
+import time
+import queue
+import argparse
+import threading
+from loguru import logger
+import configuration as config
+import dbclient
+import checkpoint
+import partitions
+import archiver
+
+
+# Program name and version
+PROGNAME = "importer"
+PROGDESCR = "Bulk import of IoT readings"
+VERSION = "0.1.0"
+
+# Default readings per bulk request
+BATCH_SIZE = 500
+
+# Default bulk requests in flight
+INFLIGHT = 4
+
+# Seconds between checkpoint saves
+CHECKPOINT_INTERVAL = 5
+
+# Prefix of import checkpoint document ids
+CHECKPOINT_PREFIX = "_local/importer@"
+
+
+class Progress:
+    """
+    Completed batches and offset of the input before which all lines have
+    been written
+    """
+    def __init__(self, offset: int):
+        self.lock = threading.Lock()
+        self.offset = offset
+        self.next_batch = 0
+        self.completed = dict()
+        self.written = 0
+        self.conflicts = 0
+        self.failed = 0
+        self.error = None
+
+    def done(self, batch: int, end_offset: int, written: int, conflicts: int, failed: int):
+        with self.lock:
+            self.written += written
+            self.conflicts += conflicts
+            self.failed += failed
+            # Batches complete out of order: the offset advances only over
+            # contiguous batches
+            self.completed[batch] = end_offset
+            while self.next_batch in self.completed:
+                self.offset = self.completed.pop(self.next_batch)
+                self.next_batch += 1
+
+
+def bulk_writer(db, batches: queue.Queue, progress: Progress):
+    """
+    Writes the batches of the queue until a None batch is got
+    """
+    while True:
+        item = batches.get()
+        if item is None:
+            return
+        batch, docs, end_offset = item
+        if progress.error is not None:
+            continue
+        try:
+            results = db.bulk_docs(docs).json() if docs != [] else []
+        except:
+            progress.error = sys.exc_info()
+            continue
+
+        written = conflicts = failed = 0
+        for res in results:
+            error = res.get('error')
+            if error is None:
+                written += 1
+            elif error == 'conflict':
+                conflicts += 1
+            else:
+                logger.error("Failed import of '{}': {}".format(res.get('id'), res.get('reason')))
+                failed += 1
+        progress.done(batch, end_offset, written, conflicts, failed)
+
+
+def to_number(text: str):
+    """
+    Returns the number in a CSV field or the field itself
+    """
+    try:
+        return int(text)
+    except ValueError:
+        pass
+    try:
+        return float(text)
+    except ValueError:
+        return text
+
+
+def parse_csv(line: bytes, fieldnames: list, delimiter: str):
+    """
+    Returns the topic and the reading of a CSV line
+    """
+    row = next(csv.reader([line.decode()], delimiter=delimiter))
+    data = {name: value for name, value in zip(fieldnames, row) if value != ""}
+    if 'value' in data:
+        data['value'] = to_number(data['value'])
+    return (data.pop('topic', None), data)
+
+
+def parse_jsonl(line: bytes):
+    """
+    Returns the topic and the reading of a JSON line
+    """
+    record = json.loads(line)
+    if 'payload' in record:
+        payload = record['payload']
+        data = json.loads(payload) if isinstance(payload, str) else payload
+        return (record.get('topic'), data)
+    return (record.pop('topic', None), record)
+
+
+def read_readings(fd, fmt: str, offset: int, delimiter: str):
+    """
+    Yields (topic, reading, end offset) for each line of the binary file
+    starting from 'offset'. Lines not parsable yield a None reading.
+    """
+    fieldnames = None
+    if fmt == 'csv':
+        header = fd.readline()
+        fieldnames = [name.strip(" ") for name in
+                      next(csv.reader([header.decode()], delimiter=delimiter))]
+        offset = max(offset, len(header))
+    fd.seek(offset)
+
+    for line in fd:
+        offset += len(line)
+        if line.strip() == b"":
+            continue
+        try:
+            if fmt == 'csv':
+                topic, data = parse_csv(line, fieldnames, delimiter)
+            else:
+                topic, data = parse_jsonl(line)
+        except:
+            logger.warning("Line ending at byte {} not parsable".format(offset))
+            yield (None, None, offset)
+            continue
+        yield (topic, data, offset)
+
+
+def import_file(db, filepath: str, fmt: str, topics: dict, args):
+    """
+    Imports a file resuming from its checkpoint.
+    Returns True if the whole file has been read and written.
+    """
+    ckpt = checkpoint.Checkpoint(db, os.path.abspath(filepath), prefix=CHECKPOINT_PREFIX)
+    offset = 0
+    if (not args.restart) and ckpt.load():
+        offset = ckpt.doc.get('offset', 0)
+        if offset > os.path.getsize(filepath):
+            logger.warning("'{}' shorter than its checkpoint, import restarted".format(filepath))
+            offset = 0
+    logger.info("Importing '{}' from byte {}".format(filepath, offset))
+
+    progress = Progress(offset)
+    batches = queue.Queue(maxsize=args.inflight)
+    writers = [threading.Thread(target=bulk_writer, args=(db, batches, progress),
+                                name="bulk-{}".format(index), daemon=True)
+               for index in range(args.inflight)]
+    for writer in writers:
+        writer.start()
+
+    partitioned = db.partitioned
+    batch = 0
+    docs = []
+    skipped = invalid = 0
+    saved_offset = offset
+    last_save = time.monotonic()
+    start = last_save
+    with open(filepath, "rb") as fd:
+        for topic, data, end_offset in read_readings(fd, fmt, offset, args.delimiter):
+            if progress.error is not None:
+                break
+            if (topic is None) or (not isinstance(data, dict)):
+                invalid += 1
+                continue
+            if (not args.all_topics) and (config.topic_metadata(topics, topic) is None):
+                skipped += 1
+                continue
+
+            try:
+                archiver.normalize_reading(topic, data, time.time())
+                if partitioned:
+                    data['_id'] = partitions.doc_id(topic, data['timestamp'], True)
+            except:
+                # Timestamp not a string (e.g. epoch number)
+                logger.debug("Invalid reading of '{}': {}", topic, data)
+                invalid += 1
+                continue
+            docs.append(data)
+            if len(docs) < args.batch:
+                continue
+
+            batches.put((batch, docs, end_offset))
+            batch += 1
+            docs = []
+            if time.monotonic() - last_save >= CHECKPOINT_INTERVAL:
+                last_save = time.monotonic()
+                if progress.offset != saved_offset:
+                    saved_offset = progress.offset
+                    ckpt.save(offset=saved_offset)
+                logger.info("'{}': byte {}, written {}, conflicts {}, failed {} ({:.0f} docs/s)".format(
+                            filepath, saved_offset, progress.written, progress.conflicts,
+                            progress.failed, progress.written / (last_save - start)))
+        else:
+            # End of file: last batch ends at file end
+            batches.put((batch, docs, fd.tell()))
+
+    for writer in writers:
+        batches.put(None)
+    for writer in writers:
+        writer.join()
+    if progress.offset != saved_offset:
+        ckpt.save(offset=progress.offset)
+
+    logger.info("'{}': written {}, conflicts {}, failed {}, skipped topics {}, invalid lines {}".format(
+                filepath, progress.written, progress.conflicts, progress.failed, skipped, invalid))
+    if progress.error is not None:
+        logger.error("Import of '{}' interrupted at byte {}".format(filepath, progress.offset))
+        logger.error("Reason: {}".format(progress.error))
+        return False
+    return True
+
+
+# Unexpected errors are logged and exit with failure
+@logger.catch(default=1)
+def main():
+    """
+    Import entry point
+    """
+    parser = argparse.ArgumentParser(description = PROGDESCR, prog = PROGNAME)
+    parser.add_argument('-v', '--version', help='Print version and exit.',
+                        action = 'version', version = VERSION)
+    parser.add_argument('files', nargs='+', help='CSV or JSON-lines files to import.')
+    parser.add_argument('-f', '--format', choices=['csv', 'jsonl'],
+                        help='Files format (default from file extension).')
+    parser.add_argument('-d', '--delimiter', help='CSV delimiter.', default = ",")
+    parser.add_argument('-b', '--batch', help='Readings per bulk request.',
+                        type = int, default = BATCH_SIZE)
+    parser.add_argument('-j', '--inflight', help='Bulk requests in flight.',
+                        type = int, default = INFLIGHT)
+    parser.add_argument('-a', '--all-topics', help='Import topics not in IoT configuration too.',
+                        action = 'store_true')
+    parser.add_argument('-r', '--restart', help='Ignore checkpoints and import from start.',
+                        action = 'store_true')
+    parser.add_argument('-c', '--config', help='Program whose INI file is read.',
+                        default = archiver.PROGNAME)
+
+    args = parser.parse_args()
+    logger.debug("CLI arguments: '{}'".format(args))
+
+    ini = config.load_config(args.config)
+    if ini is None:
+        return 1
+    if not config.verify_params(ini, 'couchdb', ['dbname']):
+        return 1
+    topics = config.load_iot_config(ini)
+    if (topics == {}) and (not args.all_topics):
+        logger.error("No topics configured")
+        return 1
+
+    # Requests in flight are limited by the client 'pool_size' too
+    client = dbclient.connect(ini)
+    if client is None:
+        return 1
+    db = client.database(ini['couchdb']['dbname'])
+
+    all_ok = True
+    for filepath in args.files:
+        fmt = args.format
+        if fmt is None:
+            fmt = 'csv' if filepath.lower().endswith(".csv") else 'jsonl'
+        if not import_file(db, filepath, fmt, topics, args):
+            all_ok = False
+            break
+    return 0 if all_ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,337 @@
+# File: iotdev.py
+# Date: 18-10-2026
+# Author: Saruccio Culmone
+#
+# Single process runtime of the IoT programs
+
+"""
+Runs any subset of the IoT programs in a single process:
+- archiver: MQTT readings stored into the realtime database
+- dsarchiver: window measures of the realtime database stored into the
+  datastore, run again every 'interval' seconds
+- clock: MQTT clock publishing
+
+Hosted components share:
+- one INI file, 'iotdev.ini', with the sections of each of them
+- one MQTT connection: the clock publishes on the archiver client
+- one CouchDB client, with its connection pool and request statistics
+- logging, tracing and profiling
+
+Modules of a component are imported only if it is hosted, so the
+dependencies of the others (uncertainties stack of dsarchiver) are never
+loaded. The runtime exits when a component stops, to be restarted as a
+whole by its service.
+
+On SIGTERM/SIGINT the components are stopped in order:
+- clock publishing
+- archiver: MQTT disconnected, queued readings stored, open buckets and
+  aggregation windows written
+- dsarchiver: topic threads stopped after the slot they are writing
+then profiling is stopped and the runtime exits.
+
+Cold start time and peak resident memory of the hosted components run as
+separate interpreters and in a single one are compared by:
+
+    python iotdev.py --compare
+
+Only interpreter start and imports are measured, so neither broker nor
+database is needed.
+"""
+
+import time
+# Reference of the cold start time
+STARTED = time.monotonic()
+
+import sys
+import os
+import signal
+import argparse
+import importlib
+import subprocess
+import threading
+from loguru import logger
+import configuration as config
+import dbclient
+import tracing
+import profiling
+
+
+# Program name and version
+PROGNAME = "iotdev"
+PROGDESCR = "IoT runtime hosting archiver, dsarchiver and clock"
+VERSION = "0.1.0"
+
+# Hostable components and the modules each of them loads
+COMPONENTS = {'archiver': ['archiver'],
+              'dsarchiver': ['dsarchiver'],
+              'clock': ['mqtt_clock']}
+
+# Directory of the clock program
+CLOCK_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "mqtt_clock")
+
+# Default seconds between dsarchiver runs
+DSARCHIVER_INTERVAL = 300
+
+# Runs of each '--compare' measurement, the fastest is reported
+COMPARE_RUNS = 3
+
+
+def rss_mb():
+    """
+    Returns the resident memory of the process in MB
+    """
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def import_component(name: str):
+    """
+    Imports the main module of a component
+    """
+    if name == 'clock' and CLOCK_DIR not in sys.path:
+        sys.path.append(CLOCK_DIR)
+    return importlib.import_module(COMPONENTS[name][0])
+
+
+def mqtt_connect(ini: dict):
+    """
+    Returns an MQTT client connected to the [mqtt] broker, None in error
+    case. Used by the clock when archiver is not hosted.
+    """
+    import paho.mqtt.client as mqtt
+
+    if not config.verify_params(ini, 'mqtt', ['server', 'port', 'keepalive']):
+        return None
+    mqtt_params = ini['mqtt']
+    client = mqtt.Client()
+    try:
+        client.connect(mqtt_params['server'], int(mqtt_params['port']),
+                       int(mqtt_params['keepalive']))
+    except:
+        logger.error("Cannot connect MQTT broker '{}:{}'".format(mqtt_params['server'],
+                                                                 mqtt_params['port']))
+        logger.error("Reason: {}".format(sys.exc_info()))
+        return None
+    client.loop_start()
+    return client
+
+
+def run_dsarchiver(dsarchiver, ini: dict, db_client: dbclient.CouchDBClient,
+                   stop: threading.Event):
+    """
+    Runs dsarchiver every 'interval' seconds of the [dsarchiver] section
+    until 'stop' is set
+    """
+    interval = DSARCHIVER_INTERVAL
+    if 'dsarchiver' in ini:
+        interval = ini['dsarchiver'].getfloat('interval', DSARCHIVER_INTERVAL)
+    dbs = dsarchiver.couchdb_client(ini, db_client)
+    if dbs is None:
+        logger.error("No DB available")
+        return
+
+    while not stop.is_set():
+        iot_topics = config.load_iot_config(ini)
+        if iot_topics != {}:
+            started = time.monotonic()
+            if not dsarchiver.archive(ini, dbs, iot_topics, stop):
+                return
+            logger.info("dsarchiver run in {:.1f} s".format(time.monotonic() - started))
+        else:
+            logger.error("No topics configured, dsarchiver run skipped")
+        stop.wait(interval)
+
+
+def run_clock(mqtt_clock, ini: dict, client, stop: threading.Event):
+    """
+    Publishes the clock with the parameters of the [clock] section until
+    'stop' is set
+    """
+    rate = mqtt_clock.CLOCK_RATE
+    formats = ['italian']
+    stats = 0
+    if 'clock' in ini:
+        clock_params = ini['clock']
+        rate = clock_params.getfloat('rate', mqtt_clock.CLOCK_RATE)
+        formats = [fmt.strip(" ") for fmt in clock_params.get('formats', 'italian').split(",")
+                   if fmt.strip(" ") != ""]
+        stats = clock_params.getfloat('stats', 0)
+    unknown = [fmt for fmt in formats if fmt not in mqtt_clock.FORMATS]
+    if (rate <= 0) or (formats == []) or (unknown != []):
+        logger.error("Invalid clock rate {} or formats {}".format(rate, formats))
+        return
+    logger.info("Clock at {} Hz, formats {}".format(rate, formats))
+    mqtt_clock.run_clock(client, rate, formats, stats, stop=stop, log=logger.info)
+
+
+def measure_startup(modules: list):
+    """
+    Returns cold start time (s) and peak resident memory (MB) of an
+    interpreter importing the modules, the fastest of COMPARE_RUNS runs
+    """
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([os.path.dirname(os.path.abspath(__file__)), CLOCK_DIR,
+                                         env.get('PYTHONPATH', "")])
+    code = "import " + ", ".join(modules)
+    best = None
+    for run in range(COMPARE_RUNS):
+        start = time.monotonic()
+        proc = subprocess.Popen([sys.executable, "-c", code], env=env)
+        pid, status, usage = os.wait4(proc.pid, 0)
+        elapsed = time.monotonic() - start
+        if status != 0:
+            raise RuntimeError("Importing {} failed".format(modules))
+        if (best is None) or (elapsed < best[0]):
+            best = (elapsed, usage.ru_maxrss / 1024)
+    return best
+
+
+def compare(components: list):
+    """
+    Prints cold start time and peak resident memory of the components run
+    as separate processes and in a single one
+    """
+    print("{:<16} {:>10} {:>10}".format("component", "start (s)", "RSS (MB)"))
+    total_time = total_rss = 0.0
+    modules = []
+    for name in components:
+        elapsed, rss = measure_startup(COMPONENTS[name])
+        print("{:<16} {:>10.3f} {:>10.1f}".format(name, elapsed, rss))
+        total_time += elapsed
+        total_rss += rss
+        modules += COMPONENTS[name]
+    elapsed, rss = measure_startup(modules)
+    print("{:<16} {:>10.3f} {:>10.1f}".format("separate", total_time, total_rss))
+    print("{:<16} {:>10.3f} {:>10.1f}".format(PROGNAME, elapsed, rss))
+
+
+@logger.catch
+def main():
+    """
+    Runtime entry point
+    """
+    parser = argparse.ArgumentParser(description = PROGDESCR, prog = PROGNAME)
+    parser.add_argument('-v', '--version', help='Print version and exit.',
+                        action = 'version', version = VERSION)
+    parser.add_argument('-C', '--components', nargs='+', choices = COMPONENTS.keys(),
+                        help='Hosted components (default [runtime] components).')
+    parser.add_argument('--compare', help='Compare cold start and memory with separate processes and exit.',
+                        action = 'store_true')
+    parser.add_argument('-p', '--profile', metavar='SECONDS',
+                        help='Profile the first SECONDS of execution (SIGUSR2 toggles profiling).',
+                        type = float, default = 0)
+
+    args = parser.parse_args()
+    logger.debug("CLI arguments: '{}'".format(args))
+
+    if args.compare:
+        compare(args.components or list(COMPONENTS.keys()))
+        return 0
+
+    ini = config.load_config(PROGNAME)
+    if ini is None:
+        return 1
+
+    components = args.components
+    if components is None:
+        components = [name.strip(" ") for name in
+                      ini.get('runtime', 'components', fallback=",".join(COMPONENTS)).split(",")
+                      if name.strip(" ") != ""]
+    unknown = [name for name in components if name not in COMPONENTS]
+    if (components == []) or (unknown != []):
+        logger.error("Invalid components {}".format(components))
+        return 1
+
+    # Only hosted components are imported
+    modules = {name: import_component(name) for name in components}
+
+    # Configure logging on file and tracing
+    instance = None
+    if 'archiver' in modules:
+        instance = modules['archiver'].instance_id(ini)
+    config.config_logging(ini, PROGNAME, instance)
+    tracing.configure(ini, PROGNAME)
+    profiling.configure(ini, PROGNAME, args.profile)
+    logger.info("---------------------------------------------------------")
+    logger.info("| '{}'  START {}".format(PROGNAME, components))
+    logger.info("---------------------------------------------------------")
+
+    # Shared CouchDB client
+    db_client = None
+    if ('archiver' in modules) or ('dsarchiver' in modules):
+        db_client = dbclient.connect(ini)
+        if db_client is None:
+            return 1
+
+    # Shared MQTT connection
+    stop = threading.Event()
+    threads = dict()
+    mqtt_client = None
+    mqtt_iface = None
+    if 'archiver' in modules:
+        started = modules['archiver'].start(ini, PROGNAME)
+        if started is None:
+            return 1
+        mqtt_iface, mqtt_client = started
+        threads['archiver'] = threading.Thread(target=logger.catch(modules['archiver'].couchdb_client),
+                                               args=(ini, mqtt_iface, db_client), name="archiver")
+    if 'clock' in modules:
+        if mqtt_client is None:
+            mqtt_client = mqtt_connect(ini)
+            if mqtt_client is None:
+                return 1
+        threads['clock'] = threading.Thread(target=logger.catch(run_clock),
+                                            args=(modules['clock'], ini, mqtt_client, stop),
+                                            name="clock")
+    if 'dsarchiver' in modules:
+        threads['dsarchiver'] = threading.Thread(target=logger.catch(run_dsarchiver),
+                                                 args=(modules['dsarchiver'], ini, db_client, stop),
+                                                 name="dsarchiver")
+
+    # Signals only set the stop event, components are stopped by the main thread
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda signum, frame: threading.Thread(target=stop.set).start())
+
+    for thread in threads.values():
+        thread.start()
+    logger.info("Components started in {:.2f} s, resident memory {:.1f} MB".format(
+                time.monotonic() - STARTED, rss_mb()))
+
+    # Component monitoring
+    while (not stop.is_set()) and all(thread.is_alive() for thread in threads.values()):
+        stop.wait(1)
+    exit_code = 0
+    if stop.is_set():
+        logger.info("Stop requested")
+    else:
+        exit_code = 1
+        for thread in threads.values():
+            if not thread.is_alive():
+                logger.error("Component '{}' exited".format(thread.name))
+    stop.set()
+
+    # Clock first, it publishes on the archiver client
+    if 'clock' in threads:
+        threads['clock'].join()
+    if 'archiver' in threads:
+        modules['archiver'].shutdown(mqtt_client, mqtt_iface)
+        threads['archiver'].join()
+    elif mqtt_client is not None:
+        mqtt_client.disconnect()
+        mqtt_client.loop_stop()
+    if 'dsarchiver' in threads:
+        threads['dsarchiver'].join()
+    profiling.shutdown()
+    logger.info("{} exited".format(PROGNAME))
+    return exit_code
+
+
+if __name__ == "__main__":
+    sys.exit(main())
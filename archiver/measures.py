@@ -0,0 +1,117 @@
+# File: measures.py
+# Date: 18-10-2026
+# Author: Saruccio Culmone
+#
+# Aggregation windows and device accuracy shared by archiver and dsarchiver
+
+"""
+Aggregation windows and device accuracy of measures.
+
+Windows are aligned to wall-clock multiples of their length from midnight,
+so the window of a reading, and the '_id' of its measure, depend only on
+the reading timestamp and the window length.
+"""
+
+import sys
+import datetime
+from loguru import logger
+import configuration as config
+
+
+# Default aggregation window (minutes)
+WINDOW = 10
+
+# Windows are aligned to multiples of their length from midnight
+DAY_MINUTES = 24 * 60
+
+
+def local_time(moment: datetime.datetime):
+    """
+    Returns a timestamp as naive local time, the one of readings without
+    offset, so that readings with and without offset can be compared
+    """
+    if moment.tzinfo is None:
+        return moment
+    return moment.astimezone().replace(tzinfo=None)
+
+
+def align_window(timestamp: datetime.datetime, window: int):
+    """
+    Returns the start of the wall-clock aligned window of a timestamp
+    """
+    midnight = timestamp.replace(hour=0, minute=0, second=0, microsecond=0)
+    windows = (timestamp - midnight) // datetime.timedelta(minutes=window)
+    return midnight + windows * datetime.timedelta(minutes=window)
+
+
+def valid_window(window: int):
+    """
+    Returns True if the window (minutes) divides the day
+    """
+    return (window > 0) and (DAY_MINUTES % window == 0)
+
+
+def default_window(ini: dict, section: str):
+    """
+    Returns the default window (minutes) of an INI section or None if it
+    doesn't divide the day
+    """
+    window = WINDOW
+    try:
+        if section in ini:
+            window = ini[section].getint('window', WINDOW)
+        if not valid_window(window):
+            raise ValueError("window doesn't divide the day")
+    except:
+        logger.error("Invalid window '{}' of section [{}]".format(ini[section].get('window'),
+                                                                  section))
+        logger.error("Reason: {}".format(sys.exc_info()))
+        return None
+    return window
+
+
+def topic_window(iot_topics: dict, topic: str, default: int):
+    """
+    Returns the aggregation window (minutes) of a topic from the 'window'
+    column of the IoT configuration or the default one.
+    Windows must divide the day to keep their alignment.
+    """
+    metadata = config.topic_metadata(iot_topics, topic)
+    window = ((metadata or {}).get('window') or "").strip(" ")
+    if window == "":
+        return default
+    try:
+        window = int(window)
+        if not valid_window(window):
+            raise ValueError("window doesn't divide the day")
+    except:
+        logger.error("Invalid window '{}' of topic '{}', using {} min".format(window, topic,
+                                                                           default))
+        logger.error("Reason: {}".format(sys.exc_info()))
+        return default
+    return window
+
+
+def accuracy(device: dict, value_type: str, reading: float):
+    """
+    Returns the accuracy of the reading depending on device type accuracy
+    ranges
+    """
+    if device is None:
+        return 0.0
+
+    # Get accuracy ranges
+    try:
+        accuracies = device[value_type]['accuracy']
+    except:
+        logger.error("Device has no accuracy data for '{}' values".format(value_type))
+        return 0.0
+
+    accuracy_value = 0.0
+    for accuracy in accuracies:
+        range_inf = accuracy['range_inf']
+        range_sup = accuracy['range_sup']
+        if (reading >= range_inf) and (reading < range_sup):
+            accuracy_value = accuracy['value']
+            break
+    return accuracy_value
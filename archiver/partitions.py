@@ -0,0 +1,54 @@
+# File: partitions.py
+# Date: 18-10-2026
+# Author: Saruccio Culmone
+#
+# Partitioned database layout keyed by topic
+
+"""
+Document ids and queries of partitioned CouchDB databases.
+
+In a partitioned database every document id is '<partition>:<key>' and the
+documents of a partition are stored in the same shard. Readings of a topic
+use the topic as partition and their timestamp as key, so per-topic queries
+on '/_partition/<topic>/_design/...' views scan only that shard instead of
+the global index.
+
+In non-partitioned databases ids keep the '<topic>@<key>' form. The layout
+is read from the database itself, so programs need no configuration.
+"""
+
+import time2relax as relax
+
+
+# Separator of partition and key in document ids
+PARTITION_SEP = ":"
+
+
+def partition_key(topic: str):
+    """
+    Returns the partition name of a topic: partition names can't contain
+    the separator nor start with '_'
+    """
+    partition = topic.replace(PARTITION_SEP, "_")
+    if partition.startswith("_"):
+        partition = "t" + partition
+    return partition
+
+
+def doc_id(topic: str, key: str, partitioned: bool):
+    """
+    Returns the id of a topic document identified by 'key'
+    """
+    if partitioned:
+        return partition_key(topic) + PARTITION_SEP + key
+    return topic + "@" + key
+
+
+def topic_view(db: relax.CouchDB, topic: str, ddoc_id: str, func_id: str, **kwargs):
+    """
+    Queries a view for the documents of a topic, on its partition only if
+    the database is partitioned
+    """
+    if db.partitioned:
+        return db.partition_view(partition_key(topic), ddoc_id, func_id, **kwargs)
+    return db.ddoc_view(ddoc_id, func_id, **kwargs)
@@ -0,0 +1,202 @@
+# File: partmigrate.py
+# Date: 18-10-2026
+# Author: Saruccio Culmone
+#
+# Copy of a realtime database into the partitioned layout
+
+"""
+Copies the readings of a non-partitioned realtime database into a
+partitioned database, created if missing, with ids '<topic>:<timestamp>'
+(bucket documents '<topic>:<bucket start>#bucket').
+
+Documents are streamed in pages of '_all_docs' and written with '_bulk_docs'
+while the next page is read, so memory use is bounded by two pages.
+Documents already in the target are skipped: an interrupted migration is
+resumed running it again. The source database is left untouched.
+
+CouchDB server and credentials are read from the [couchdb] section of the
+INI file of another program, dsarchiver by default.
+"""
+
+import sys
+import time
+import queue
+import argparse
+import threading
+import time2relax as relax
+from loguru import logger
+import configuration as config
+import dbclient
+import designdocs
+import partitions
+import buckets
+
+
+# Program name and version
+PROGNAME = "partmigrate"
+PROGDESCR = "Copy of a realtime database into a partitioned database"
+VERSION = "0.1.0"
+
+# Default number of documents per page
+BATCH_SIZE = 1000
+
+# Pages read ahead of the writer
+READ_AHEAD = 2
+
+
+def create_partitioned(db: relax.CouchDB):
+    """
+    Creates the partitioned database if missing.
+    Returns False if the database exists and is not partitioned.
+    """
+    try:
+        db.request("PUT", "", _init=False, params={'partitioned': True})
+        logger.info("Partitioned database '{}' created".format(db.name))
+    except relax.PreconditionFailed:
+        logger.info("Database '{}' already exists".format(db.name))
+    if not db.partitioned:
+        logger.error("Database '{}' is not partitioned".format(db.name))
+        return False
+    return True
+
+
+def partitioned_doc(doc: dict):
+    """
+    Returns the copy of a reading or bucket document with partitioned id
+    and without revision, None if the document has no topic key
+    """
+    topic = doc.get('topic')
+    if 'bucket' in doc:
+        key = doc['bucket'].get('start')
+    else:
+        key = doc.get('timestamp')
+    if (topic is None) or (key is None):
+        return None
+    new_doc = {name: value for name, value in doc.items() if name not in ['_id', '_rev']}
+    if 'bucket' in doc:
+        new_doc['_id'] = buckets.bucket_id(topic, key, True)
+    else:
+        new_doc['_id'] = partitions.doc_id(topic, key, True)
+    return new_doc
+
+
+def read_pages(source: relax.CouchDB, batch: int, pages: queue.Queue):
+    """
+    Puts the pages of source documents into the queue, None at the end.
+    Pages are read by key, never skipping over already read documents.
+    """
+    params = {'include_docs': True, 'limit': batch}
+    startkey = None
+    while True:
+        if startkey is not None:
+            params['startkey'] = startkey
+            params['skip'] = 1
+        rows = source.all_docs(params=params).json()['rows']
+        if rows == []:
+            break
+        pages.put([row['doc'] for row in rows if not row['id'].startswith("_design/")])
+        startkey = rows[-1]['id']
+        if len(rows) < batch:
+            break
+    pages.put(None)
+
+
+def migrate(source: relax.CouchDB, target: relax.CouchDB, batch: int):
+    """
+    Copies the source documents into the target database.
+    Returns the tuple of copied, skipped and failed documents counters.
+    """
+    pages = queue.Queue(maxsize=READ_AHEAD)
+    failure = []
+
+    def reader():
+        try:
+            read_pages(source, batch, pages)
+        except:
+            failure.append(sys.exc_info())
+            pages.put(None)
+
+    threading.Thread(target=reader, name="reader", daemon=True).start()
+
+    copied = skipped = failed = 0
+    start = time.monotonic()
+    while True:
+        page = pages.get()
+        if page is None:
+            break
+        docs = []
+        for doc in page:
+            new_doc = partitioned_doc(doc)
+            if new_doc is None:
+                logger.warning("Document '{}' without topic skipped".format(doc['_id']))
+                skipped += 1
+                continue
+            docs.append(new_doc)
+        if docs == []:
+            continue
+
+        results = target.bulk_docs(docs).json()
+        for res in results:
+            error = res.get('error')
+            if error is None:
+                copied += 1
+            elif error == 'conflict':
+                # Copied by a previous run
+                skipped += 1
+            else:
+                logger.error("Failed copy of '{}': {}".format(res.get('id'), res.get('reason')))
+                failed += 1
+        elapsed = time.monotonic() - start
+        logger.info("Copied {}, skipped {}, failed {} docs ({:.0f} docs/s)".format(
+                    copied, skipped, failed, (copied + skipped + failed) / elapsed))
+
+    if failure != []:
+        logger.error("Reading '{}' failed".format(source.name))
+        logger.error("Reason: {}".format(failure[0]))
+        failed += 1
+    return (copied, skipped, failed)
+
+
+@logger.catch
+def main():
+    """
+    Migration entry point
+    """
+    parser = argparse.ArgumentParser(description = PROGDESCR, prog = PROGNAME)
+    parser.add_argument('-v', '--version', help='Print version and exit.',
+                        action = 'version', version = VERSION)
+    parser.add_argument('source', help='Name of the database to copy.')
+    parser.add_argument('target', help='Name of the partitioned database.')
+    parser.add_argument('-c', '--config', help='Program whose INI file has the [couchdb] section.',
+                        default = 'dsarchiver')
+    parser.add_argument('-b', '--batch', help='Documents per bulk request.',
+                        type = int, default = BATCH_SIZE)
+
+    args = parser.parse_args()
+    logger.debug("CLI arguments: '{}'".format(args))
+
+    ini = config.load_config(args.config)
+    if ini is None:
+        return 1
+
+    client = dbclient.connect(ini)
+    if client is None:
+        return 1
+    source = client.database(args.source)
+    target = client.database(args.target)
+    if source.partitioned:
+        logger.error("Database '{}' is already partitioned".format(args.source))
+        return 1
+    if not create_partitioned(target):
+        return 1
+    if not designdocs.install_design_docs(target):
+        return 1
+
+    copied, skipped, failed = migrate(source, target, args.batch)
+    logger.info("Migration of '{}' into '{}' ended: copied {}, skipped {}, failed {}".format(
+                args.source, args.target, copied, skipped, failed))
+    return 0 if failed == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,308 @@
+# File: profiling.py
+# Date: 18-10-2026
+# Author: Saruccio Culmone
+#
+# On-demand profiling of running daemons
+
+"""
+Profiling controls for archiver and dsarchiver.
+
+A profiling session is started and stopped by SIGUSR2 or started at launch
+for a number of seconds by the '--profile' CLI option. During a session:
+
+- cProfile runs in every thread calling 'poll' in its loop; at the end the
+  merged profile is written to '<progname>-<time>.prof' with a text summary
+- tracemalloc traces allocations; the top allocation lines are written to
+  '<progname>-<time>-memory.txt'
+- 'span' contexts time the processing stages, aggregated and logged every
+  SPAN_INTERVAL seconds
+
+Files are written in the log directory. When no session is active 'poll'
+and 'span' only check a flag.
+"""
+
+import os
+import sys
+import time
+import signal
+import pstats
+import cProfile
+import datetime
+import threading
+import tracemalloc
+from loguru import logger
+
+
+# Seconds between logs of stage timings
+SPAN_INTERVAL = 60
+
+# Seconds waited after stop for threads to hand over their profiles
+STOP_GRACE = 6
+
+# Number of lines written in summaries
+TOP_LINES = 30
+
+# Frames kept for each traced allocation
+TRACE_FRAMES = 5
+
+
+class Session:
+    """
+    Profiles and stage timings collected from start to stop
+    """
+    def __init__(self, progname: str, outdir: str):
+        self.name = "{}-{}".format(progname, datetime.datetime.now().strftime("%Y%m%d-%H%M%S"))
+        self.outdir = outdir
+        self.lock = threading.Lock()
+        self.profiles = []
+        self.written = False
+        self.reset_stages()
+
+    def reset_stages(self):
+        self.stages = dict()
+        self.stages_start = time.monotonic()
+
+    def add_profile(self, profile: cProfile.Profile):
+        with self.lock:
+            if self.written:
+                logger.warning("Profile of thread '{}' discarded, session already written".format(
+                               threading.current_thread().name))
+                return
+            self.profiles.append(profile)
+
+    def record(self, stage: str, elapsed: float):
+        with self.lock:
+            count, total, maximum = self.stages.get(stage, (0, 0.0, 0.0))
+            self.stages[stage] = (count + 1, total + elapsed, max(maximum, elapsed))
+            if time.monotonic() - self.stages_start >= SPAN_INTERVAL:
+                self.log_stages()
+
+    def log_stages(self):
+        period = time.monotonic() - self.stages_start
+        for stage in sorted(self.stages):
+            count, total, maximum = self.stages[stage]
+            logger.info("Stage '{}' in {:.0f} s: n= {}, total= {:.3f} s, avg= {:.3f} ms, max= {:.3f} ms".format(
+                        stage, period, count, total, 1000 * total / count, 1000 * maximum))
+        self.reset_stages()
+
+    def write_memory(self):
+        """
+        Writes the top allocation lines and stops tracemalloc
+        """
+        if not tracemalloc.is_tracing():
+            return
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        filepath = os.path.join(self.outdir, self.name + "-memory.txt")
+        try:
+            with open(filepath, "w") as memfd:
+                stats = snapshot.statistics('lineno')
+                memfd.write("# Top {} allocations of {} lines, total {:.1f} KiB\n".format(
+                            TOP_LINES, len(stats), sum(stat.size for stat in stats) / 1024))
+                for stat in stats[:TOP_LINES]:
+                    memfd.write("{}\n".format(stat))
+            logger.info("Allocations written on '{}'".format(filepath))
+        except:
+            logger.error("Writing '{}' failed".format(filepath))
+            logger.error("Reason: {}".format(sys.exc_info()))
+
+    def write(self, grace: float = STOP_GRACE):
+        """
+        Waits threads hand over their profiles and writes session files
+        """
+        time.sleep(grace)
+        with self.lock:
+            self.written = True
+            profiles = list(self.profiles)
+            if self.stages != {}:
+                self.log_stages()
+
+        if profiles == []:
+            logger.warning("No thread profile collected")
+            return
+        filepath = os.path.join(self.outdir, self.name + ".prof")
+        try:
+            stats = pstats.Stats(profiles[0])
+            for profile in profiles[1:]:
+                stats.add(profile)
+            stats.dump_stats(filepath)
+            with open(filepath + ".txt", "w") as txtfd:
+                stats.stream = txtfd
+                stats.sort_stats('cumulative').print_stats(TOP_LINES)
+                stats.sort_stats('tottime').print_stats(TOP_LINES)
+            logger.info("Profile of {} threads written on '{}'".format(len(profiles), filepath))
+        except:
+            logger.error("Writing '{}' failed".format(filepath))
+            logger.error("Reason: {}".format(sys.exc_info()))
+
+
+class NoSpan:
+    """
+    Span used when profiling is off
+    """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+class Span:
+    """
+    Timing of a processing stage
+    """
+    __slots__ = ['session', 'stage', 'start']
+
+    def __init__(self, session: Session, stage: str):
+        self.session = session
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.session.record(self.stage, time.perf_counter() - self.start)
+        return False
+
+
+NO_SPAN = NoSpan()
+
+# Profiling state
+active = False
+session = None
+progname = "iotdev"
+outdir = "."
+control_lock = threading.Lock()
+thread_state = threading.local()
+
+
+def span(stage: str):
+    """
+    Returns the context timing a stage
+    """
+    if not active:
+        return NO_SPAN
+    return Span(session, stage)
+
+
+def poll():
+    """
+    Starts or stops the profiler of the calling thread following the
+    session state. To be called by each thread in its processing loop.
+    """
+    profile = getattr(thread_state, 'profile', None)
+    if (profile is None) and (not active):
+        return
+
+    current = session if active else None
+    if (profile is not None) and (thread_state.session is not current):
+        profile.disable()
+        thread_state.session.add_profile(profile)
+        thread_state.profile = None
+        profile = None
+
+    if (profile is None) and (current is not None):
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Another profiler is active in this thread
+            thread_state.profile = None
+            return
+        thread_state.profile = profile
+        thread_state.session = current
+
+
+def release():
+    """
+    Hands over the profile of the calling thread, to be called by threads
+    before exiting
+    """
+    profile = getattr(thread_state, 'profile', None)
+    if profile is not None:
+        profile.disable()
+        thread_state.session.add_profile(profile)
+        thread_state.profile = None
+
+
+def start():
+    """
+    Starts a profiling session
+    """
+    global active, session
+    with control_lock:
+        if active:
+            logger.warning("Profiling already active")
+            return
+        session = Session(progname, outdir)
+        tracemalloc.start(TRACE_FRAMES)
+        active = True
+    logger.info("Profiling '{}' started".format(session.name))
+    poll()
+
+
+def stop(wait: bool = False):
+    """
+    Stops the profiling session writing its files in background or, if
+    'wait', before returning when all threads have released their profiles
+    """
+    global active
+    with control_lock:
+        if not active:
+            logger.warning("Profiling not active")
+            return
+        active = False
+        stopped = session
+    logger.info("Profiling '{}' stopped".format(stopped.name))
+    poll()
+    stopped.write_memory()
+    if wait:
+        stopped.write(0)
+        return
+    threading.Thread(target=stopped.write, name="profile-writer", daemon=True).start()
+
+
+def shutdown():
+    """
+    Writes the active session, if any, before program exit
+    """
+    if active:
+        stop(wait=True)
+
+
+def switch():
+    """
+    Starts or stops profiling
+    """
+    if active:
+        stop()
+    else:
+        start()
+        # Profile of this short-lived thread
+        release()
+
+
+def toggle(signum=None, frame=None):
+    """
+    SIGUSR2 handler, switches profiling in a thread so that no lock is
+    taken by the signal handler
+    """
+    threading.Thread(target=switch, name="profile-toggle").start()
+
+
+def configure(ini: dict, name: str, duration: float = 0):
+    """
+    Installs the SIGUSR2 handler and starts profiling for 'duration'
+    seconds if not 0. Must be called from the main thread.
+    """
+    global progname, outdir
+    progname = name
+    if 'config' in ini:
+        outdir = ini['config'].get('logdir', ".")
+    signal.signal(signal.SIGUSR2, toggle)
+    if duration > 0:
+        start()
+        timer = threading.Timer(duration, stop)
+        timer.daemon = True
+        timer.start()
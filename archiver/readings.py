@@ -0,0 +1,148 @@
+# File: readings.py
+# Date: 18-10-2026
+# Author: Saruccio Culmone
+#
+# Compact representation of queued readings
+
+"""
+Readings waiting to be written are kept as Reading records instead of
+'(topic, dict)' tuples:
+
+- fields are '__slots__', no per-reading dictionary
+- topic, device and type strings are interned, so each distinct string is
+  stored once for all the queued readings
+- the timestamp is stored as integer microseconds when it can be rebuilt
+  exactly from them, as received otherwise
+- '_id' and 'topic' are not stored and payload keys other than the common
+  ones are kept in a side dictionary only if present
+
+The CouchDB document is rebuilt by 'to_doc' at write time.
+
+Running this module measures the memory used by a number of queued
+readings (default one million) in both representations:
+
+    python readings.py [count]
+"""
+
+import sys
+import datetime
+
+
+# Marker of payload keys not present in the reading
+MISSING = object()
+
+# Payload keys stored in the record fields
+FIELD_KEYS = ('timestamp', 'value', 'dev', 'type')
+
+# Keys rebuilt at write time
+DERIVED_KEYS = ('_id', 'topic')
+
+# Timestamps are stored as microseconds from this naive datetime
+EPOCH = datetime.datetime(1970, 1, 1)
+MICROSECOND = datetime.timedelta(microseconds=1)
+
+
+def encode_timestamp(timestamp):
+    """
+    Returns the timestamp as integer microseconds or unchanged if it
+    can't be rebuilt identical from them
+    """
+    if not isinstance(timestamp, str):
+        return timestamp
+    try:
+        parsed = datetime.datetime.fromisoformat(timestamp)
+    except ValueError:
+        return timestamp
+    if parsed.tzinfo is not None:
+        return timestamp
+    micros = (parsed - EPOCH) // MICROSECOND
+    if decode_timestamp(micros) != timestamp:
+        return timestamp
+    return micros
+
+
+def decode_timestamp(timestamp):
+    if isinstance(timestamp, int):
+        return (EPOCH + timestamp * MICROSECOND).isoformat()
+    return timestamp
+
+
+def intern(value):
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+class Reading:
+    """
+    Queued reading of a topic
+    """
+    __slots__ = ('topic', 'timestamp', 'value', 'dev', 'type', 'extra')
+
+    def __init__(self, topic: str, data: dict):
+        self.topic = sys.intern(topic)
+        self.timestamp = encode_timestamp(data.get('timestamp'))
+        self.value = data.get('value', MISSING)
+        self.dev = intern(data.get('dev', MISSING))
+        self.type = intern(data.get('type', MISSING))
+        extra = None
+        for key, value in data.items():
+            if (key in FIELD_KEYS) or (key in DERIVED_KEYS):
+                continue
+            if extra is None:
+                extra = dict()
+            extra[key] = value
+        self.extra = extra
+
+    def to_doc(self):
+        """
+        Returns the CouchDB document of the reading
+        """
+        timestamp = decode_timestamp(self.timestamp)
+        doc = {'_id': self.topic + "@" + timestamp,
+               'topic': self.topic,
+               'timestamp': timestamp}
+        if self.value is not MISSING:
+            doc['value'] = self.value
+        if self.dev is not MISSING:
+            doc['dev'] = self.dev
+        if self.type is not MISSING:
+            doc['type'] = self.type
+        if self.extra is not None:
+            doc.update(self.extra)
+        return doc
+
+    def __repr__(self):
+        return "Reading({!r})".format(self.to_doc())
+
+
+def benchmark(count: int):
+    """
+    Prints the memory used by 'count' queued readings as tuples of topic
+    and dictionary and as Reading records
+    """
+    import tracemalloc
+    import collections
+
+    def message(index: int):
+        # New strings for each message, as received from MQTT
+        topic = "".join(["home/sensor", str(index % 50), "/temperature"])
+        timestamp = (EPOCH + datetime.timedelta(seconds=1600000000 + index)).isoformat()
+        return topic, {'_id': topic + "@" + timestamp, 'topic': topic,
+                       'timestamp': timestamp, 'value': 20.0 + (index % 100) / 10,
+                       'dev': "".join(["dev", str(index % 50)]), 'type': "".join(["temp", "erature"])}
+
+    for name, record in [("(topic, dict)", lambda topic, data: (topic, data)),
+                         ("Reading", Reading)]:
+        tracemalloc.start()
+        queue = collections.deque()
+        for index in range(count):
+            topic, data = message(index)
+            queue.appendleft(record(topic, data))
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        print("{:>14}: {:8.1f} MB for {} readings, {:6.1f} MB per million".format(
+              name, size / 1e6, count, size / count))
+        del queue
+
+
+if __name__ == "__main__":
+    benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 1000000)
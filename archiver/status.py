@@ -0,0 +1,199 @@
+# File: status.py
+# Date: 18-10-2026
+# Author: Saruccio Culmone
+#
+# Latest value of each topic served without querying CouchDB
+
+"""
+In-memory table of the latest reading received on each topic.
+
+The table is written only by the MQTT callback thread: each update replaces
+the topic entry with a new immutable tuple, so readers take no lock and
+always see a consistent entry.
+
+The current state is made available:
+- on a local HTTP/JSON endpoint:
+    GET /latest           all topics
+    GET /latest/<topic>   one topic (404 if never received)
+- optionally as retained MQTT messages '<prefix>/<topic>', republished
+  every 'mqtt_interval' seconds for the topics changed in the meantime
+
+Configuration is read from the optional [status] section:
+- http_address: address of the endpoint (default 127.0.0.1)
+- http_port: port of the endpoint (default 0, endpoint disabled)
+- mqtt_prefix: prefix of retained status topics (default empty, disabled)
+- mqtt_interval: seconds between republishes (default 5)
+"""
+
+import sys
+import json
+import time
+import threading
+import datetime
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from loguru import logger
+
+
+# Metadata columns not exposed with the readings
+HIDDEN_METADATA = ['topic', 'compression']
+
+
+class LatestValues:
+    """
+    Latest reading of each topic
+    """
+    def __init__(self):
+        # topic -> (value, timestamp, received epoch, metadata)
+        self.entries = dict()
+
+    def update(self, topic: str, data: dict, metadata: dict):
+        """
+        Replaces the entry of a topic, to be called by a single writer thread
+        """
+        self.entries[topic] = (data.get('value'), data.get('timestamp'), time.time(), metadata)
+
+    def entry(self, topic: str):
+        """
+        Returns the JSON serializable entry of a topic or None if unknown
+        """
+        entry = self.entries.get(topic)
+        if entry is None:
+            return None
+        return as_dict(topic, entry)
+
+    def snapshot(self):
+        """
+        Returns the JSON serializable entries of all topics
+        """
+        return {topic: as_dict(topic, entry) for topic, entry in list(self.entries.items())}
+
+
+def as_dict(topic: str, entry: tuple):
+    value, timestamp, received, metadata = entry
+    return {'topic': topic,
+            'value': value,
+            'timestamp': timestamp,
+            'received': datetime.datetime.fromtimestamp(received).isoformat(timespec='seconds'),
+            'metadata': {key: val for key, val in metadata.items()
+                         if key not in HIDDEN_METADATA}}
+
+
+class StatusHandler(BaseHTTPRequestHandler):
+    """
+    Serves the latest values table
+    """
+    def do_GET(self):
+        latest = self.server.latest
+        path = urllib.parse.unquote(urllib.parse.urlsplit(self.path).path)
+        if path in ["/latest", "/latest/"]:
+            self.reply(200, latest.snapshot())
+        elif path.startswith("/latest/"):
+            entry = latest.entry(path[len("/latest/"):])
+            if entry is None:
+                self.reply(404, {'error': "not_found"})
+            else:
+                self.reply(200, entry)
+        else:
+            self.reply(404, {'error': "not_found"})
+
+    def reply(self, code: int, body: dict):
+        payload = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        logger.debug("Status request from {}: {}", self.address_string(), format % args)
+
+
+def start_server(latest: LatestValues, address: str, port: int):
+    """
+    Starts the HTTP endpoint in a background thread.
+    Returns the server or None in error case.
+    """
+    try:
+        server = ThreadingHTTPServer((address, port), StatusHandler)
+    except:
+        logger.error("Status endpoint on {}:{} failed".format(address, port))
+        logger.error("Reason: {}".format(sys.exc_info()))
+        return None
+    server.daemon_threads = True
+    server.latest = latest
+    threading.Thread(target=server.serve_forever, name="status-http", daemon=True).start()
+    logger.info("Status endpoint on http://{}:{}/latest".format(address, port))
+    return server
+
+
+class StatusPublisher(threading.Thread):
+    """
+    Republishes the changed entries as retained MQTT messages
+    """
+    def __init__(self, latest: LatestValues, prefix: str, interval: float):
+        super().__init__(name="status-publisher", daemon=True)
+        self.latest = latest
+        self.client = None
+        self.prefix = prefix.rstrip("/")
+        self.interval = interval
+        self.published = dict()
+
+    def publish_changed(self):
+        count = 0
+        for topic, entry in list(self.latest.entries.items()):
+            if self.published.get(topic) is entry:
+                continue
+            payload = json.dumps(as_dict(topic, entry))
+            info = self.client.publish("{}/{}".format(self.prefix, topic), payload, retain=True)
+            if info.rc != 0:
+                logger.warning("Status publish of '{}' failed, rc= {}".format(topic, info.rc))
+                continue
+            self.published[topic] = entry
+            count += 1
+        return count
+
+    def start_publishing(self, client):
+        """
+        Starts republishing on a connected MQTT client
+        """
+        self.client = client
+        self.start()
+        logger.info("Status republished as retained '{}/<topic>' every {} s".format(
+                    self.prefix, self.interval))
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                count = self.publish_changed()
+            except:
+                logger.error("Status publish failed")
+                logger.error("Reason: {}".format(sys.exc_info()))
+                continue
+            if count > 0:
+                logger.debug("Status published for {} topics", count)
+
+
+def configure(ini: dict, latest: LatestValues):
+    """
+    Starts the HTTP endpoint if enabled in [status] section.
+    Returns the MQTT status publisher, to be started once the client is
+    connected, or None if not enabled.
+    """
+    status_params = ini['status'] if 'status' in ini else dict()
+    try:
+        address = status_params.get('http_address', "127.0.0.1").strip(" ")
+        port = int(status_params.get('http_port', 0))
+        prefix = status_params.get('mqtt_prefix', "").strip(" ")
+        interval = float(status_params.get('mqtt_interval', 5))
+    except:
+        logger.error("Invalid [status] parameters")
+        logger.error("Reason: {}".format(sys.exc_info()))
+        return None
+
+    if port > 0:
+        start_server(latest, address, port)
+    if prefix == "":
+        return None
+    return StatusPublisher(latest, prefix, interval)
@@ -0,0 +1,184 @@
+# File: test_resubscribe.py
+# Date: 18-10-2026
+# Author: Saruccio Culmone
+#
+# Time to resubscribe of archiver after a broker restart
+
+"""
+Restarts a local mosquitto broker, with persistence enabled, under a
+connected archiver and measures the time from its reconnection to the first
+reading received on the last configured topic:
+- persistent session: the broker restores the subscriptions from its
+  database, no SUBSCRIBE is sent
+- clean session: all topics are subscribed again
+
+Skipped if mosquitto is not installed.
+"""
+
+import os
+import sys
+import time
+import json
+import shutil
+import socket
+import subprocess
+import collections
+import configparser
+import pytest
+import paho.mqtt.client as mqtt
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import archiver
+
+
+# Configured topics, subscribed in packets of SUBSCRIBE_BATCH
+TOPICS = 2000
+SUBSCRIBE_BATCH = 100
+
+# Seconds waited for broker start, subscriptions and readings
+TIMEOUT = 10
+
+# Time to resubscribe bound of a persistent session (s)
+RESUBSCRIBE_MAX = 1.0
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for(condition, timeout: float = TIMEOUT):
+    """
+    Returns the seconds waited for the condition, fails on timeout
+    """
+    start = time.monotonic()
+    while not condition():
+        if time.monotonic() - start > timeout:
+            pytest.fail("Condition not met in {} s".format(timeout))
+        time.sleep(0.001)
+    return time.monotonic() - start
+
+
+class Broker:
+    """
+    Local mosquitto broker saving its sessions on shutdown
+    """
+    def __init__(self, workdir):
+        self.port = free_port()
+        self.conf = workdir / "mosquitto.conf"
+        self.conf.write_text("listener {} 127.0.0.1\nallow_anonymous true\n"
+                             "persistence true\npersistence_location {}/\n".format(self.port,
+                                                                                 workdir))
+        self.proc = None
+
+    def listening(self):
+        try:
+            socket.create_connection(("127.0.0.1", self.port), timeout=0.1).close()
+            return True
+        except OSError:
+            return False
+
+    def start(self):
+        self.proc = subprocess.Popen(["mosquitto", "-c", str(self.conf)],
+                                     stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        wait_for(self.listening)
+
+    def stop(self):
+        self.proc.terminate()
+        self.proc.wait()
+
+    def restart(self):
+        self.stop()
+        self.start()
+
+
+@pytest.fixture
+def broker(tmp_path):
+    """
+    Local mosquitto broker with persistence
+    """
+    if shutil.which("mosquitto") is None:
+        pytest.skip("mosquitto not installed")
+    broker = Broker(tmp_path)
+    broker.start()
+    try:
+        yield broker
+    finally:
+        broker.stop()
+
+
+def archiver_ini(port: int, persistent: bool, client_id: str):
+    ini = configparser.ConfigParser()
+    ini.read_dict({'mqtt': {'server': "127.0.0.1", 'port': str(port), 'keepalive': "60",
+                            'user': "", 'password': "",
+                            'persistent_session': "yes" if persistent else "no",
+                            'client_id': client_id, 'qos': "1",
+                            'subscribe_batch': str(SUBSCRIBE_BATCH),
+                            'reconnect_min': "1", 'reconnect_max': "1"}})
+    return ini
+
+
+def time_to_resubscribe(broker: Broker, persistent: bool):
+    """
+    Returns the seconds from reconnection of archiver after a broker restart
+    to the first reading received, published every millisecond by a probe
+    client, and the MQTT interface
+    """
+    topics = {"test/sensor{}/value".format(index): {} for index in range(TOPICS)}
+    iface = archiver.MQTTInterface(collections.deque(), topics)
+    # Replaced by the SUBSCRIBE packets ids once sent
+    iface.pending_subacks = {-1}
+    client = archiver.mqtt_client(archiver_ini(broker.port, persistent, "test-" + str(persistent)),
+                                  iface)
+    assert client
+    wait_for(lambda: (iface.subscribe_start > 0) and (iface.pending_subacks == set()))
+
+    # Reconnection time
+    connected = []
+    def on_connect(*args, **kwargs):
+        connected.append(time.monotonic())
+        archiver.on_connect(*args, **kwargs)
+    client.on_connect = on_connect
+
+    iface.subscribe_start = 0.0
+    iface.pending_subacks = {-1}
+    broker.restart()
+
+    # Last subscribed topic
+    topic = "test/sensor{}/value".format(TOPICS - 1)
+    probe = mqtt.Client()
+    probe.connect("127.0.0.1", broker.port)
+    probe.loop_start()
+    received = []
+
+    def reading_received():
+        probe.publish(topic, json.dumps({'value': 1.0}), qos=0)
+        if len(iface.queue) > 0:
+            received.append(time.monotonic())
+        return received != []
+
+    try:
+        wait_for(reading_received)
+    finally:
+        client.disconnect()
+        client.loop_stop()
+        probe.disconnect()
+        probe.loop_stop()
+    assert iface.queue.pop().topic == topic
+    return received[0] - connected[0], iface
+
+
+def test_persistent_session_resubscribe(broker):
+    elapsed, iface = time_to_resubscribe(broker, persistent=True)
+    # Session restored by the broker without subscribing again
+    assert iface.subscribe_start == 0.0
+    assert iface.pending_subacks == {-1}
+    assert elapsed < RESUBSCRIBE_MAX
+
+
+def test_clean_session_resubscribe(broker):
+    elapsed, iface = time_to_resubscribe(broker, persistent=False)
+    # All topics subscribed again
+    assert iface.subscribe_start > 0
+    assert iface.pending_subacks == set()
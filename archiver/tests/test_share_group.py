@@ -0,0 +1,82 @@
+# File: test_share_group.py
+# Date: 18-10-2026
+# Author: Saruccio Culmone
+#
+# Clustered archiver instances in a shared subscription group
+
+"""
+Connects two archiver instances in the same 'share_group' to a local
+mosquitto broker and publishes numbered readings on the configured topics:
+the instances must split the stream, each reading received by exactly one
+of them.
+
+Skipped if mosquitto is not installed.
+"""
+
+import os
+import sys
+import json
+import time
+import collections
+import paho.mqtt.client as mqtt
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import archiver
+from test_resubscribe import archiver_ini, wait_for, broker
+
+# Configured topics and readings published on them
+TOPICS = 10
+READINGS = 1000
+
+# Shared subscription group of the instances
+SHARE_GROUP = "archivers"
+
+# Seconds waited for readings delivered twice after the last one
+SETTLE = 0.5
+
+
+def group_instance(port: int, name: str, topics: dict):
+    """
+    Returns the MQTT client and interface of an archiver instance of the
+    group, once its topics are subscribed
+    """
+    ini = archiver_ini(port, False, name)
+    ini['mqtt']['share_group'] = SHARE_GROUP
+    ini['mqtt']['instance'] = name
+    iface = archiver.MQTTInterface(collections.deque(), topics)
+    # Replaced by the SUBSCRIBE packets ids once sent
+    iface.pending_subacks = {-1}
+    client = archiver.mqtt_client(ini, iface)
+    assert client
+    wait_for(lambda: (iface.subscribe_start > 0) and (iface.pending_subacks == set()))
+    return client, iface
+
+
+def test_share_group_split(broker):
+    topics = {"test/sensor{}/value".format(index): {} for index in range(TOPICS)}
+    instances = [group_instance(broker.port, "test-share-{}".format(index), topics)
+                 for index in range(2)]
+
+    probe = mqtt.Client()
+    probe.connect("127.0.0.1", broker.port)
+    probe.loop_start()
+    try:
+        for seq in range(READINGS):
+            topic = "test/sensor{}/value".format(seq % TOPICS)
+            probe.publish(topic, json.dumps({'value': seq}), qos=1).wait_for_publish()
+        wait_for(lambda: sum(len(iface.queue) for _, iface in instances) >= READINGS)
+        time.sleep(SETTLE)
+    finally:
+        probe.disconnect()
+        probe.loop_stop()
+        for client, _ in instances:
+            client.disconnect()
+            client.loop_stop()
+
+    received = [[reading.value for reading in iface.queue] for _, iface in instances]
+    # Each instance got a share of the stream
+    assert all(len(share) > 0 for share in received)
+    # Each reading received once
+    merged = received[0] + received[1]
+    assert len(merged) == READINGS
+    assert sorted(merged) == list(range(READINGS))
@@ -0,0 +1,190 @@
+# File: tracing.py
+# Date: 18-10-2026
+# Author: Saruccio Culmone
+#
+# Sampled hot-path tracing with in-memory flight recorder
+
+"""
+Tracing of hot-path events without the cost of DEBUG logging.
+
+Events are kept in a fixed size in-memory ring buffer together with their
+format string and arguments: the message is formatted only when the buffer
+is dumped to file, on SIGUSR1 or when an error is logged. Each event type
+can be sampled recording only a fraction of its occurrences.
+
+Configuration is read from the optional [trace] section:
+- buffer_size: number of events kept (default 10000, 0 disables tracing)
+- sample_rates: comma separated '<event>:<rate>' with rate in 0..1
+  (default 1 for each event)
+- dump_on_error: yes|no dump the buffer when an error is logged
+  (default yes, at most once every 60 seconds)
+"""
+
+import os
+import sys
+import time
+import signal
+import datetime
+import threading
+import collections
+from loguru import logger
+
+
+# Default number of events kept
+BUFFER_SIZE = 10000
+
+# Minimum seconds between two dumps triggered by errors
+ERROR_DUMP_INTERVAL = 60
+
+
+class FlightRecorder:
+    """
+    Ring buffer of sampled events
+    """
+    def __init__(self, progname: str, size: int, rates: dict, dump_dir: str):
+        self.progname = progname
+        self.events = collections.deque(maxlen=size)
+        self.dump_dir = dump_dir
+        self.dump_lock = threading.Lock()
+        self.last_error_dump = 0.0
+        self.dump_on_error = False
+        # Each occurrence adds its rate to the credit of the event, which is
+        # recorded when the credit reaches 1: the recorded fraction is the rate
+        self.rates = {name: min(max(rate, 0.0), 1.0) for name, rate in rates.items()}
+        self.credits = dict()
+
+    def event(self, name: str, fmt: str, *args):
+        """
+        Records an event if selected by its sampling rate.
+        'fmt' is formatted with 'args' only at dump time.
+        """
+        rate = self.rates.get(name, 1.0)
+        if rate < 1.0:
+            if rate == 0.0:
+                return
+            credit = self.credits.get(name, 0.0) + rate
+            if credit < 1.0:
+                self.credits[name] = credit
+                return
+            self.credits[name] = credit - 1.0
+        self.events.append((time.time(), threading.current_thread().name, name, fmt, args))
+
+    def dump(self, reason: str):
+        """
+        Writes the recorded events to a file in the dump directory.
+        Returns the file path or None in error case.
+        """
+        with self.dump_lock:
+            events = list(self.events)
+            now = datetime.datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+            filepath = os.path.join(self.dump_dir, "{}-trace-{}.log".format(self.progname, now))
+            try:
+                with open(filepath, "w") as dumpfd:
+                    dumpfd.write("# {} events, reason: {}\n".format(len(events), reason))
+                    for timestamp, thread, name, fmt, args in events:
+                        try:
+                            message = fmt.format(*args)
+                        except:
+                            message = "{} {}".format(fmt, args)
+                        dumpfd.write("{} | {} | {} | {}\n".format(
+                                     datetime.datetime.fromtimestamp(timestamp).isoformat(),
+                                     thread, name, message))
+            except:
+                logger.warning("Trace dump on '{}' failed".format(filepath))
+                logger.warning("Reason: {}".format(sys.exc_info()))
+                return None
+
+        logger.info("Trace dumped {} events on '{}'".format(len(events), filepath))
+        return filepath
+
+    def error_sink(self, message):
+        """
+        Loguru sink dumping the buffer on errors
+        """
+        now = time.monotonic()
+        if (self.last_error_dump > 0) and (now - self.last_error_dump < ERROR_DUMP_INTERVAL):
+            return
+        self.last_error_dump = now
+        self.dump("error: {}".format(message.record['message']))
+
+
+# Recorder used by 'event', None if tracing is disabled
+recorder = None
+
+# Handler id of the error sink
+error_handler = None
+
+
+def event(name: str, fmt: str, *args):
+    """
+    Records an event on the flight recorder if enabled
+    """
+    if recorder is not None:
+        recorder.event(name, fmt, *args)
+
+
+def parse_rates(text: str):
+    """
+    Parses '<event>:<rate>, ...' returning a dictionary of rates
+    """
+    rates = dict()
+    for item in text.split(","):
+        item = item.strip(" ")
+        if item == "":
+            continue
+        name, rate = item.split(":")
+        rates[name.strip(" ")] = min(1.0, max(0.0, float(rate)))
+    return rates
+
+
+def configure(ini: dict, progname: str):
+    """
+    Configures the flight recorder from the [trace] section and installs
+    the SIGUSR1 dump handler. Must be called from the main thread.
+    Returns True if tracing is enabled.
+    """
+    global recorder
+
+    trace_params = ini['trace'] if 'trace' in ini else dict()
+    dump_dir = ini['config'].get('logdir', ".") if 'config' in ini else "."
+    try:
+        size = int(trace_params.get('buffer_size', BUFFER_SIZE))
+        rates = parse_rates(trace_params.get('sample_rates', ""))
+    except:
+        logger.error("Invalid [trace] parameters")
+        logger.error("Reason: {}".format(sys.exc_info()))
+        return False
+
+    if size <= 0:
+        logger.info("Tracing disabled")
+        recorder = None
+        return False
+
+    recorder = FlightRecorder(progname, size, rates, dump_dir)
+    recorder.dump_on_error = (trace_params.get('dump_on_error', 'yes') == 'yes')
+    logger.info("Tracing: {} events buffer, sample rates {}".format(size, rates))
+
+    # Dump is done out of the signal handler, the interrupted thread may
+    # hold the dump lock
+    signal.signal(signal.SIGUSR1,
+                  lambda signum, frame: threading.Thread(target=recorder.dump,
+                                                         args=("SIGUSR1",)).start())
+    add_error_sink()
+    return True
+
+
+def add_error_sink():
+    """
+    Adds the loguru sink dumping the recorder on errors, replacing the one
+    previously added. To be called again after logging is configured.
+    """
+    global error_handler
+    if error_handler is not None:
+        try:
+            logger.remove(error_handler)
+        except ValueError:
+            # Already removed with all handlers
+            pass
+        error_handler = None
+    if (recorder is not None) and recorder.dump_on_error:
+        error_handler = logger.add(recorder.error_sink, level="ERROR", format="{message}")
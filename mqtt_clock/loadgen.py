@@ -0,0 +1,223 @@
+# File: loadgen.py
+# Date: 18-10-2026
+# Author: Saruccio Culmone
+#
+# MQTT fleet load generator
+
+"""
+Simulates a fleet of devices publishing readings on the topics of an IoT
+configuration file (the same 'iot_config.csv' used by archiver), to test
+the ingestion capacity.
+
+Devices are spread over the configured topics and publish at the same rate
+JSON payloads shaped like real readings. Each period is split in batches
+published on ticks of the drift-free clock scheduler, so the load is evenly
+distributed instead of bursting once per period.
+
+archiver stores each reading with '_id' '<topic>@<timestamp>', so readings
+of different devices must not share topic and timestamp or all but one are
+rejected as conflicts:
+- topics with wildcards ('+', '#') give each device its own topic, topics
+  without them can't be shared by several devices
+- payload timestamps ('--timestamp') have millisecond resolution, without
+  them archiver uses the arrival second and device rates above 1 Hz collide
+"""
+
+import sys
+import csv
+import json
+import time
+import random
+import datetime
+import threading
+import mqtt_clock
+
+
+# Default interval between batches (s)
+BATCH_INTERVAL = 0.01
+
+# Payload value simulation
+VALUE_BASE = 20.0
+VALUE_STEP = 0.1
+
+
+def load_topics(filepath: str):
+    """
+    Reads topics from an IoT configuration file skipping header and
+    commented out lines
+    """
+    topics = []
+    with open(filepath, "r", newline='') as csvfd:
+        for row in csv.reader(csvfd, delimiter=";"):
+            if row == []:
+                continue
+            topic = row[0].strip(" ")
+            if (topic == "") or (topic == "topic") or (topic[0] == "#"):
+                continue
+            if topic not in topics:
+                topics.append(topic)
+    return topics
+
+
+def shared_topics(topics: list, devices: int):
+    """
+    Returns the topics without wildcards that would be published on by more
+    than one of the devices spread over them
+    """
+    return [topic for index, topic in enumerate(topics)
+            if ('+' not in topic.split("/")) and ('#' not in topic.split("/"))
+            and (len(range(index, devices, len(topics))) > 1)]
+
+
+class Device:
+    """
+    Virtual device publishing a random walk on its topic
+    """
+    __slots__ = ['name', 'topic', 'type', 'value']
+
+    def __init__(self, index: int, topic: str):
+        self.name = "sim-{:05d}".format(index)
+        # Wildcards are replaced by the device name
+        levels = [self.name if level in ('+', '#') else level
+                  for level in topic.split("/")]
+        self.topic = "/".join(levels)
+        self.type = levels[-1]
+        self.value = VALUE_BASE + random.uniform(-5, 5)
+
+    def payload(self, timestamp: str = None):
+        self.value += random.uniform(-VALUE_STEP, VALUE_STEP)
+        data = {'value': round(self.value, 2), 'dev': self.name, 'type': self.type}
+        if timestamp is not None:
+            data['timestamp'] = timestamp
+        return json.dumps(data)
+
+
+class PublishStats:
+    """
+    Achieved rate and publish latency. With QoS 0 latency is the time spent
+    in publish(), with QoS > 0 the time until broker acknowledge.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Publish time of messages waiting acknowledge and acknowledge time
+        # of messages acknowledged before their publish was recorded
+        self.pending = dict()
+        self.acked = dict()
+        self.reset()
+
+    def reset(self):
+        self.started = time.monotonic()
+        self.published = 0
+        self.failed = 0
+        self.latencies = []
+
+    def record(self, latency: float):
+        with self.lock:
+            self.published += 1
+            self.latencies.append(latency)
+
+    def sent(self, mid: int, start: float):
+        with self.lock:
+            acked = self.acked.pop(mid, None)
+            if acked is None:
+                self.pending[mid] = start
+                return
+            self.published += 1
+            self.latencies.append(acked - start)
+
+    def on_publish(self, client, userdata, mid):
+        now = time.monotonic()
+        with self.lock:
+            start = self.pending.pop(mid, None)
+            if start is None:
+                self.acked[mid] = now
+                return
+            self.published += 1
+            self.latencies.append(now - start)
+
+    def summary(self):
+        with self.lock:
+            period = time.monotonic() - self.started
+            latencies = sorted(self.latencies)
+            published = self.published
+            failed = self.failed
+            self.reset()
+        if latencies == []:
+            return "rate= 0 msg/s, failed= {}".format(failed)
+        count = len(latencies)
+        return ("rate= {:.0f} msg/s, failed= {}, latency avg= {:.3f} ms, "
+                "p50= {:.3f} ms, p99= {:.3f} ms, max= {:.3f} ms".format(
+                published / period, failed,
+                1000 * sum(latencies) / count,
+                1000 * latencies[count // 2],
+                1000 * latencies[min(count - 1, (count * 99) // 100)],
+                1000 * latencies[-1]))
+
+
+def run(client, args):
+    """
+    Publishes the simulated load until duration expires (forever if 0)
+    """
+    try:
+        topics = load_topics(args.load)
+    except:
+        print("ERROR - Cannot read topics from '{}'".format(args.load))
+        print("Reason: {}".format(sys.exc_info()))
+        sys.exit(1)
+    if topics == []:
+        print("ERROR - No topics in '{}'".format(args.load))
+        sys.exit(1)
+
+    shared = shared_topics(topics, args.devices)
+    if shared != []:
+        print("ERROR - {} devices on {} topics: topics without wildcards would be shared, "
+              "their readings rejected by archiver as conflicts: {}".format(
+              args.devices, len(topics), shared[:5]))
+        sys.exit(1)
+    if (not args.timestamp) and (args.device_rate > 1):
+        print("WARNING - Readings without timestamp at {} Hz: archiver ids have 1 s "
+              "resolution, use --timestamp".format(args.device_rate))
+
+    devices = [Device(i, topics[i % len(topics)]) for i in range(args.devices)]
+
+    # Each period is divided in batches of devices
+    batches = max(1, min(len(devices), round(1.0 / (args.device_rate * BATCH_INTERVAL))))
+    groups = [devices[i::batches] for i in range(batches)]
+    print("Load: {} devices on {} topics at {} Hz, {} msg/s in {} batches per period".format(
+          len(devices), len(topics), args.device_rate,
+          round(len(devices) * args.device_rate), batches))
+
+    stats = PublishStats()
+    if args.qos > 0:
+        client.on_publish = stats.on_publish
+        client.max_inflight_messages_set(len(devices))
+
+    scheduler = mqtt_clock.TickScheduler(args.device_rate * batches)
+    stats_interval = args.stats if args.stats > 0 else 5.0
+    start = time.monotonic()
+    next_stats = start + stats_interval
+    batch = 0
+    while (args.duration == 0) or (time.monotonic() - start < args.duration):
+        wall = scheduler.wait()
+        timestamp = None
+        if args.timestamp:
+            timestamp = datetime.datetime.fromtimestamp(wall).isoformat(timespec='milliseconds')
+
+        for device in groups[batch]:
+            payload = device.payload(timestamp)
+            sent = time.monotonic()
+            info = client.publish(device.topic, payload=payload, qos=args.qos)
+            if info.rc != 0:
+                stats.failed += 1
+            elif args.qos > 0:
+                stats.sent(info.mid, sent)
+            else:
+                stats.record(time.monotonic() - sent)
+        batch = (batch + 1) % batches
+
+        if time.monotonic() >= next_stats:
+            next_stats += stats_interval
+            print("Load: {}".format(stats.summary()))
+            print("Scheduler: {}".format(scheduler.stats.summary()))
+
+    print("Load: {}".format(stats.summary()))
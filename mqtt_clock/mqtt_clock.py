@@ -7,14 +7,16 @@
 import sys
 import os
 import time
+import math
 import datetime
 import argparse
+import threading
 import paho.mqtt.client as mqtt
 
 
 # Name and program version
 PROGNAME = "MQTT Clock"
-VERSION = "1.0.0"
+VERSION = "1.1.0"
 
 # Parameters
 MQTT_PORT = 1883
@@ -23,19 +25,159 @@ MQTT_KEEPALIVE = 60
 # Date and time topic
 DATETIME_TOPIC = "datetime"
 
+# Default publishing rate (Hz)
+CLOCK_RATE = 1.0
+
+# Seconds between checks of wall clock adjustments
+CLOCK_RESYNC = 10.0
+
+# Default simulated devices and their publishing rate (Hz)
+LOAD_DEVICES = 100
+LOAD_RATE = 1.0
+
 # Environment variable enabling main loop tracing
 MQTT_CLOCK_TRACE = "MQTT_CLOCK_TRACE"
 
-def datetime_formatted():
+def datetime_formatted(now: datetime.datetime = None):
     """
     Put now() string in italian format
     """
-    data_str = str(datetime.datetime.now())
-    dotpos = data_str.rfind(".")
-    sdate, stime = data_str[:dotpos].split(" ")
+    if now is None:
+        now = datetime.datetime.now()
+    data_str = str(now.replace(microsecond=0))
+    sdate, stime = data_str.split(" ")
     Y, M, D = sdate.split("-")
     return D+"-"+M+"-"+Y+"\n"+stime
 
+
+def datetime_iso(now: datetime.datetime):
+    """
+    ISO 8601 local time with milliseconds
+    """
+    return now.isoformat(timespec='milliseconds')
+
+
+def datetime_epoch_ms(now: datetime.datetime):
+    """
+    Milliseconds since epoch
+    """
+    return str(round(now.timestamp() * 1000))
+
+
+# Payload formats: name -> (topic, formatting function)
+FORMATS = {
+    'italian': (DATETIME_TOPIC, datetime_formatted),
+    'iso': (DATETIME_TOPIC + "/iso", datetime_iso),
+    'epoch_ms': (DATETIME_TOPIC + "/epoch_ms", datetime_epoch_ms),
+}
+
+
+class TickStats:
+    """
+    Lateness of ticks with respect to their deadline
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.ticks = 0
+        self.missed = 0
+        self.total = 0.0
+        self.total_sq = 0.0
+        self.max = 0.0
+
+    def record(self, lateness: float):
+        self.ticks += 1
+        self.total += lateness
+        self.total_sq += lateness * lateness
+        self.max = max(self.max, lateness)
+
+    def summary(self):
+        """
+        Returns statistics string and resets counters
+        """
+        if self.ticks == 0:
+            return "ticks= 0, missed= {}".format(self.missed)
+        mean = self.total / self.ticks
+        jitter = math.sqrt(max(0.0, self.total_sq / self.ticks - mean * mean))
+        text = "ticks= {}, missed= {}, lateness avg= {:.3f} ms, max= {:.3f} ms, jitter= {:.3f} ms".format(
+               self.ticks, self.missed, 1000 * mean, 1000 * self.max, 1000 * jitter)
+        self.reset()
+        return text
+
+
+class TickScheduler:
+    """
+    Generates ticks at 'rate' Hz aligned to wall clock boundaries.
+    Deadlines are absolute on the monotonic clock, so time spent between
+    ticks doesn't accumulate. Wall clock adjustments are followed every
+    CLOCK_RESYNC seconds.
+    """
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.period = 1.0 / rate
+        self.stats = TickStats()
+        self.sync()
+        # First tick on the next wall clock boundary
+        self.tick = math.floor(time.time() * rate) + 1
+
+    def sync(self):
+        """
+        Measures the offset between wall and monotonic clock
+        """
+        self.offset = time.time() - time.monotonic()
+        self.synced = time.monotonic()
+
+    def wait(self):
+        """
+        Sleeps until next tick returning its wall clock time
+        """
+        now = time.monotonic()
+        if now - self.synced >= CLOCK_RESYNC:
+            self.sync()
+
+        deadline = self.tick / self.rate - self.offset
+        if now - deadline >= self.period:
+            # Skip ticks already expired
+            missed = math.floor((now - deadline) / self.period)
+            self.stats.missed += missed
+            self.tick += missed
+            deadline = self.tick / self.rate - self.offset
+
+        if deadline > now:
+            time.sleep(deadline - now)
+        self.stats.record(time.monotonic() - deadline)
+
+        wall = self.tick / self.rate
+        self.tick += 1
+        return wall
+
+
+def run_clock(client: mqtt.Client, rate: float, formats: list, stats: float = 0,
+              tracing_enabled: bool = False, stop: threading.Event = None, log = print):
+    """
+    Publishes the clock in the given formats on a connected client, shared
+    with other components when hosted by the iotdev runtime, until 'stop'
+    is set. Statistics and traced payloads are written by 'log'.
+    """
+    # data topics
+    publishers = [FORMATS[fmt] for fmt in formats]
+    scheduler = TickScheduler(rate)
+    next_stats = time.monotonic() + stats
+    while (stop is None) or (not stop.is_set()):
+        wall = scheduler.wait()
+        now = datetime.datetime.fromtimestamp(wall)
+        for data_topic, formatter in publishers:
+            data_str = formatter(now)
+            if tracing_enabled:
+                log("{}".format(data_str))
+            client.publish(data_topic, payload=data_str, qos=0, retain=False)
+
+        if (stats > 0) and (time.monotonic() >= next_stats):
+            next_stats += stats
+            log("Stats: {}".format(scheduler.stats.summary()))
+
+
 def main():
     """
     Main function
@@ -53,8 +195,45 @@ def main():
                         help = "MQTT keepalive (default {})".format(MQTT_KEEPALIVE),
                         type = int,
                         default = MQTT_KEEPALIVE)
+    parser.add_argument('-r', '--rate',
+                        help = "Publishing rate in Hz (default {})".format(CLOCK_RATE),
+                        type = float, default = CLOCK_RATE)
+    parser.add_argument('-f', '--format',
+                        help = "Payload format, can be repeated (default italian)",
+                        choices = FORMATS.keys(), action = 'append')
+    parser.add_argument('-s', '--stats',
+                        help = "Seconds between timing statistics prints (default 0, disabled)",
+                        type = float, default = 0)
+
+    # Load generation mode
+    load = parser.add_argument_group("load generation",
+                                     "Simulates devices publishing readings instead of the clock")
+    load.add_argument('-l', '--load', metavar = 'IOT_CONFIG',
+                      help = "IoT configuration file (CSV) with the topics to publish on")
+    load.add_argument('-n', '--devices',
+                      help = "Number of simulated devices (default {})".format(LOAD_DEVICES),
+                      type = int, default = LOAD_DEVICES)
+    load.add_argument('-m', '--device-rate',
+                      help = "Readings per second of each device (default {})".format(LOAD_RATE),
+                      type = float, default = LOAD_RATE)
+    load.add_argument('-d', '--duration',
+                      help = "Seconds of load (default 0, forever)",
+                      type = float, default = 0)
+    load.add_argument('-t', '--timestamp', help = "Add timestamp with milliseconds to payloads",
+                      action = 'store_true')
+    load.add_argument('-q', '--qos', help = "Publish QoS (default 0)",
+                      type = int, choices = [0, 1, 2], default = 0)
 
     args = parser.parse_args()
+    if (args.rate <= 0) or (args.device_rate <= 0):
+        parser.error("rate must be positive")
+    if args.devices <= 0:
+        parser.error("devices must be positive")
+    formats = args.format
+    if formats is None:
+        formats = ['italian']
+    # Publish each format once
+    formats = list(dict.fromkeys(formats))
 
     # Control whether tracing is enabled or not
     tracing_enabled = False
@@ -75,14 +254,14 @@ def main():
 
     client.loop_start()
 
-    # data topic
-    data_topic = DATETIME_TOPIC
-    while True:
-        data_str = datetime_formatted()
-        if tracing_enabled:
-            print("{}".format(data_str))
-        client.publish(data_topic, payload=data_str, qos=0, retain=False)
-        time.sleep(1)
+    if args.load is not None:
+        import loadgen
+        loadgen.run(client, args)
+        client.loop_stop()
+        client.disconnect()
+        return
+
+    run_clock(client, args.rate, formats, args.stats, tracing_enabled)
 
 if __name__ == "__main__":
     main()